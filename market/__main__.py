@@ -3,22 +3,54 @@ import argparse
 import uvicorn
 
 from market.config import settings
+from market.server import serve
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--app-host', default=settings.app_host)
 parser.add_argument('--app-port', default=settings.app_port, type=int)
+parser.add_argument('--workers', default=settings.app_workers, type=int)
+parser.add_argument(
+    '--loop', default=settings.app_loop,
+    choices=['auto', 'asyncio', 'uvloop']
+)
+parser.add_argument(
+    '--http', default=settings.app_http,
+    choices=['auto', 'h11', 'httptools']
+)
+parser.add_argument('--backlog', default=settings.app_backlog, type=int)
+parser.add_argument(
+    '--timeout-keep-alive', default=settings.app_timeout_keep_alive, type=int
+)
+parser.add_argument(
+    '--limit-max-requests', default=settings.app_limit_max_requests, type=int
+)
 
 
 def main():
     args = parser.parse_args()
-    uvicorn.run(
-        'market.app:get_app',
+    options = dict(
         factory=True,
         host=args.app_host,
         port=args.app_port,
-        reload=settings.is_debug
+        loop=args.loop,
+        http=args.http,
+        backlog=args.backlog,
+        timeout_keep_alive=args.timeout_keep_alive
     )
+    if settings.is_debug or (
+        args.workers == 1 and args.limit_max_requests is None
+    ):
+        uvicorn.run(
+            'market.app:get_app', reload=settings.is_debug, **options
+        )
+        return
+    serve(uvicorn.Config(
+        'market.app:get_app',
+        workers=args.workers,
+        limit_max_requests=args.limit_max_requests,
+        **options
+    ))
 
 
 if __name__ == '__main__':
@@ -3,6 +3,10 @@ from fastapi.exceptions import RequestValidationError
 from starlette.exceptions import HTTPException
 
 from market import __version__ as api_version
+from market.cache import create_invalidation_listener, create_response_cache
+from market.db.connection import dispose_engine
+from market.group_commit import create_import_group_commit
+from market.import_queue import create_import_queue_worker
 from market.handlers import (
     router, 
     http_error_handler, 
@@ -20,6 +24,22 @@ def get_app() -> FastAPI:
         '4XX': {'model': ErrorSchema},
     })
 
+    app.state.response_cache = create_response_cache()
+    if app.state.response_cache.enabled:
+        listener = create_invalidation_listener(app.state.response_cache)
+        app.add_event_handler('startup', listener.start)
+        app.add_event_handler('shutdown', listener.stop)
+
+    app.state.import_group_commit = create_import_group_commit()
+
+    app.state.import_queue = create_import_queue_worker(
+        app.state.response_cache
+    )
+    app.add_event_handler('startup', app.state.import_queue.start)
+    app.add_event_handler('shutdown', app.state.import_queue.stop)
+
+    app.add_event_handler('shutdown', dispose_engine)
+
     app.include_router(router)
 
     app.add_exception_handler(
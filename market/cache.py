@@ -0,0 +1,348 @@
+import asyncio
+from collections import defaultdict, OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+import json
+import logging
+import time
+from typing import (
+    AsyncIterator, Awaitable, Callable, Collection, DefaultDict,
+    FrozenSet, Hashable, Iterable, List, Optional, Sequence, Set
+)
+from uuid import UUID
+
+import asyncpg
+from fastapi import Request
+from sqlalchemy.engine import make_url
+
+from market.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+# Все ответы /sales помечаются одним тегом и сбрасываются по дате
+SALES_CACHE_TAG = 'sales'
+
+# Канал, через который процессы API сообщают друг другу об изменениях
+INVALIDATION_CHANNEL = 'response_cache_invalidation'
+
+# Размер сообщения NOTIFY ограничен 8000 байтами
+INVALIDATION_MESSAGE_IDS = 150
+
+
+@dataclass
+class CacheEntry:
+    value: bytes
+    tags: FrozenSet[Hashable]
+    expires_at: float
+
+
+class ResponseCache:
+    """
+    Кэш готовых ответов с вытеснением давно не использованных записей
+    и ограничением по времени жизни и суммарному размеру.
+
+    Запись помечается тегами (например, идентификаторами узлов),
+    по которым ее можно сбросить при изменении данных. Ответ, загрузка
+    которого пересеклась со сбросом, в кэш не попадает: он мог быть
+    прочитан до того, как изменения были зафиксированы.
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        self.generation = 0
+        self._entries: 'OrderedDict[Hashable, CacheEntry]' = OrderedDict()
+        self._keys_by_tag: DefaultDict[Hashable, Set[Hashable]] = \
+            defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry.value
+
+    def set(
+        self,
+        key: Hashable,
+        value: bytes,
+        tags: Iterable[Hashable] = ()
+    ) -> None:
+        if len(value) > self.max_size:
+            return
+        if key in self._entries:
+            self._remove(key)
+        entry = CacheEntry(
+            value, frozenset(tags), time.monotonic() + self.ttl
+        )
+        self._entries[key] = entry
+        self.size += len(value)
+        for tag in entry.tags:
+            self._keys_by_tag[tag].add(key)
+        while self.size > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    async def get_or_load(
+        self,
+        key: Hashable,
+        load: Callable[[], Awaitable[bytes]],
+        tags: Iterable[Hashable] = ()
+    ) -> bytes:
+        value = self.get(key)
+        if value is not None:
+            return value
+        generation = self.generation
+        value = await load()
+        if generation == self.generation:
+            self.set(key, value, tags)
+        return value
+
+    async def get_or_load_many(
+        self,
+        keys: Sequence[Hashable],
+        load: Callable[[List[Hashable]], Awaitable[List[bytes]]],
+        tags: Callable[[Hashable], Iterable[Hashable]] = lambda key: ()
+    ) -> List[bytes]:
+        """
+        То же, что и get_or_load, для нескольких ключей: значения,
+        которых нет в кэше, загружаются одним вызовом load в порядке
+        ключей. tags возвращает теги записи по ее ключу.
+        """
+        values = [self.get(key) for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is None]
+        if not missing:
+            return values
+        generation = self.generation
+        loaded = await load(missing)
+        if generation == self.generation:
+            for key, value in zip(missing, loaded):
+                self.set(key, value, tags(key))
+        loaded_values = iter(loaded)
+        return [
+            next(loaded_values) if value is None else value
+            for value in values
+        ]
+
+    def get_or_stream(
+        self,
+        key: Hashable,
+        stream: Callable[[], AsyncIterator[bytes]],
+        tags: Iterable[Hashable] = ()
+    ) -> AsyncIterator[bytes]:
+        """
+        То же, что и get_or_load, но ответ передается дальше по частям
+        по мере чтения. В кэш попадает только ответ, прочитанный целиком,
+        если его размер не превышает max_size.
+        """
+        value = self.get(key)
+        if value is not None:
+            return _iterate_value(value)
+        if not self.enabled:
+            return stream()
+        return self._stream_and_set(key, stream(), tags)
+
+    async def _stream_and_set(
+        self,
+        key: Hashable,
+        chunks: AsyncIterator[bytes],
+        tags: Iterable[Hashable]
+    ) -> AsyncIterator[bytes]:
+        generation = self.generation
+        parts: Optional[List[bytes]] = []
+        size = 0
+        async for chunk in chunks:
+            yield chunk
+            if parts is None:
+                continue
+            size += len(chunk)
+            if size > self.max_size:
+                parts = None
+            else:
+                parts.append(chunk)
+        if parts is not None and generation == self.generation:
+            self.set(key, b''.join(parts), tags)
+
+    def invalidate(
+        self,
+        tags: Iterable[Hashable],
+        predicate: Optional[Callable[[Hashable], bool]] = None
+    ) -> None:
+        """
+        Сбрасывает записи с любым из тегов. Если передан predicate,
+        сбрасываются только записи, ключи которых ему удовлетворяют.
+        """
+        self.generation += 1
+        for tag in tags:
+            for key in list(self._keys_by_tag.get(tag, ())):
+                if predicate is None or predicate(key):
+                    self._remove(key)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self._entries.clear()
+        self._keys_by_tag.clear()
+        self.size = 0
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self._entries.pop(key)
+        self.size -= len(entry.value)
+        for tag in entry.tags:
+            keys = self._keys_by_tag[tag]
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_tag[tag]
+
+
+async def _iterate_value(value: bytes) -> AsyncIterator[bytes]:
+    yield value
+
+
+def invalidate_shop_units(
+    cache: ResponseCache,
+    shop_unit_ids: Optional[Iterable[UUID]],
+    update_date: Optional[datetime] = None
+) -> None:
+    """
+    Сбрасывает ответы для измененных узлов. None вместо идентификаторов
+    сбрасывает кэш целиком, отсутствие даты - все ответы /sales.
+    """
+    if shop_unit_ids is None:
+        cache.clear()
+        return
+    cache.invalidate(shop_unit_ids)
+    if update_date is None:
+        cache.invalidate([SALES_CACHE_TAG])
+        return
+    # Импорт меняет продажи только за сутки, в которые попадает его дата
+    cache.invalidate(
+        [SALES_CACHE_TAG],
+        lambda key: update_date <= key[1] <= update_date + timedelta(days=1)
+    )
+
+
+def make_invalidation_messages(
+    shop_unit_ids: Optional[Collection[UUID]],
+    update_date: Optional[datetime] = None
+) -> List[str]:
+    """Сообщения NOTIFY с аргументами для invalidate_shop_units."""
+    date = None if update_date is None else update_date.isoformat()
+    if shop_unit_ids is None:
+        return [json.dumps({'ids': None, 'date': date})]
+    shop_unit_ids = [str(shop_unit_id) for shop_unit_id in shop_unit_ids]
+    return [
+        json.dumps({
+            'ids': shop_unit_ids[i:i + INVALIDATION_MESSAGE_IDS],
+            'date': date
+        })
+        for i in range(0, max(len(shop_unit_ids), 1), INVALIDATION_MESSAGE_IDS)
+    ]
+
+
+class CacheInvalidationListener:
+    """
+    Отдельное подключение к PostgreSQL, которое слушает канал
+    INVALIDATION_CHANNEL и сбрасывает записи кэша, измененные
+    в других процессах.
+
+    Пока подключения нет, уведомления теряются, поэтому при его потере
+    и после восстановления кэш сбрасывается целиком.
+    """
+
+    def __init__(
+        self,
+        cache: ResponseCache,
+        dsn: str,
+        reconnect_delay: float = 1
+    ) -> None:
+        self.cache = cache
+        self.dsn = dsn
+        self.reconnect_delay = reconnect_delay
+        self._connection: Optional[asyncpg.Connection] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    async def start(self) -> None:
+        await self._connect()
+
+    async def stop(self) -> None:
+        self._closed = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    async def _connect(self) -> None:
+        connection = await asyncpg.connect(self.dsn)
+        connection.add_termination_listener(self._on_termination)
+        await connection.add_listener(
+            INVALIDATION_CHANNEL, self._on_notification
+        )
+        self._connection = connection
+
+    async def _reconnect(self) -> None:
+        while not self._closed:
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                await self._connect()
+            except (OSError, asyncpg.PostgresError):
+                logger.exception('Failed to reconnect cache listener')
+                continue
+            self.cache.clear()
+            self._reconnect_task = None
+            return
+
+    def _on_termination(self, connection: asyncpg.Connection) -> None:
+        self._connection = None
+        if self._closed:
+            return
+        logger.warning('Cache listener connection lost')
+        self.cache.clear()
+        self._reconnect_task = asyncio.create_task(self._reconnect())
+
+    def _on_notification(
+        self,
+        connection: asyncpg.Connection,
+        pid: int,
+        channel: str,
+        payload: str
+    ) -> None:
+        message = json.loads(payload)
+        shop_unit_ids = message['ids']
+        if shop_unit_ids is not None:
+            shop_unit_ids = map(UUID, shop_unit_ids)
+        update_date = message['date']
+        if update_date is not None:
+            update_date = datetime.fromisoformat(update_date)
+        invalidate_shop_units(self.cache, shop_unit_ids, update_date)
+
+
+def create_response_cache() -> ResponseCache:
+    return ResponseCache(
+        settings.response_cache_max_size, settings.response_cache_ttl
+    )
+
+
+def create_invalidation_listener(
+    cache: ResponseCache
+) -> CacheInvalidationListener:
+    url = make_url(settings.db_url).set(drivername='postgresql')
+    return CacheInvalidationListener(
+        cache, url.render_as_string(hide_password=False)
+    )
+
+
+def get_response_cache(request: Request) -> ResponseCache:
+    return request.app.state.response_cache
@@ -1,19 +1,60 @@
-from contextlib import asynccontextmanager
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Optional
 
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
 from market.config import settings
+from market.db.metrics import InstrumentedPool
 
 
-engine = create_async_engine(settings.db_url, echo=settings.is_debug)
-Session = sessionmaker(
-    bind=engine, class_=AsyncSession, autocommit=False, autoflush=False
-)
+# Движок создается при первом обращении, а не при импорте модуля,
+# чтобы у каждого процесса-обработчика был собственный пул соединений
+_engine: Optional[AsyncEngine] = None
+_Session: Optional[sessionmaker] = None
+
+
+def create_engine(db_url: str) -> AsyncEngine:
+    return create_async_engine(
+        db_url,
+        echo=settings.is_debug,
+        poolclass=InstrumentedPool,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_recycle=settings.db_pool_recycle,
+        pool_pre_ping=settings.db_pool_pre_ping,
+        query_cache_size=settings.db_query_cache_size,
+        connect_args={
+            'prepared_statement_cache_size':
+                settings.db_prepared_statement_cache_size,
+            'statement_cache_size': settings.db_statement_cache_size
+        }
+    )
+
+
+def get_engine() -> AsyncEngine:
+    global _engine, _Session
+    if _engine is None:
+        _engine = create_engine(settings.db_url)
+        _Session = sessionmaker(
+            bind=_engine, class_=AsyncSession,
+            autocommit=False, autoflush=False
+        )
+    return _engine
+
+
+async def dispose_engine() -> None:
+    global _engine, _Session
+    if _engine is not None:
+        await _engine.dispose()
+        _engine = _Session = None
+
+
+def create_session() -> AsyncSession:
+    get_engine()
+    return _Session()
 
 
-@asynccontextmanager
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
-    async with Session() as session:
+    async with create_session() as session:
         yield session
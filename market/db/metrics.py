@@ -0,0 +1,79 @@
+import os
+import time
+from typing import List, Sequence
+
+from sqlalchemy import exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+
+# Границы интервалов гистограммы времени получения соединения, секунды
+CHECKOUT_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+
+class PoolMetrics:
+    """Счетчики получения соединений из пула."""
+
+    def __init__(self, buckets: Sequence[float] = CHECKOUT_TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.checkouts = 0
+        self.checkout_time = 0.0
+        self.timeouts = 0
+
+    def observe_checkout(self, duration: float) -> None:
+        self.checkouts += 1
+        self.checkout_time += duration
+        for i, bound in enumerate(self.buckets):
+            if duration <= bound:
+                self.bucket_counts[i] += 1
+
+    def observe_timeout(self) -> None:
+        self.timeouts += 1
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Пул соединений, который замеряет время их получения."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            self.metrics.observe_timeout()
+            raise
+        self.metrics.observe_checkout(time.perf_counter() - start)
+        return connection
+
+
+def render_pool_metrics(pool: InstrumentedPool) -> str:
+    """Метрики пула в текстовом формате Prometheus."""
+    metrics = pool.metrics
+    # Процессы-обработчики отвечают на /metrics по очереди,
+    # поэтому метрики каждого процесса помечаются его pid
+    labels = f'pid="{os.getpid()}"'
+    lines: List[str] = [
+        '# TYPE db_pool_size gauge',
+        f'db_pool_size{{{labels}}} {pool.size()}',
+        '# TYPE db_pool_checked_out gauge',
+        f'db_pool_checked_out{{{labels}}} {pool.checkedout()}',
+        '# TYPE db_pool_overflow gauge',
+        f'db_pool_overflow{{{labels}}} {pool.overflow()}',
+        '# TYPE db_pool_checkout_timeouts_total counter',
+        f'db_pool_checkout_timeouts_total{{{labels}}} {metrics.timeouts}',
+        '# TYPE db_pool_checkout_seconds histogram',
+    ]
+    for bound, count in zip(metrics.buckets, metrics.bucket_counts):
+        lines.append(
+            f'db_pool_checkout_seconds_bucket{{{labels},le="{bound}"}} {count}'
+        )
+    lines += [
+        f'db_pool_checkout_seconds_bucket{{{labels},le="+Inf"}} '
+        f'{metrics.checkouts}',
+        f'db_pool_checkout_seconds_sum{{{labels}}} {metrics.checkout_time}',
+        f'db_pool_checkout_seconds_count{{{labels}}} {metrics.checkouts}',
+    ]
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,126 @@
+"""Added category aggregate table
+
+Revision ID: 2e77723d909a
+Revises: f8e5309c9741
+Create Date: 2026-10-17 10:12:41.532107
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import sql
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '2e77723d909a'
+down_revision = 'f8e5309c9741'
+branch_labels = None
+depends_on = None
+
+
+def data_upgrade() -> None:
+    shop_unit = sql.table('shop_unit',
+        sql.column('id', postgresql.UUID),
+        sql.column('type', sa.Text),
+        sql.column('parent_id', postgresql.UUID)
+    )
+    shop_unit_import = sql.table('shop_unit_import',
+        sql.column('id', postgresql.UUID),
+        sql.column('date', sa.DateTime),
+        sql.column('parent_id', postgresql.UUID),
+        sql.column('price', sa.Integer),
+        sql.column('expiration_date', sa.DateTime)
+    )
+    category_aggregate = sql.table('category_aggregate',
+        sql.column('id', postgresql.UUID),
+        sql.column('sum_price', sa.BigInteger),
+        sql.column('offer_count', sa.Integer),
+        sql.column('last_change_date', sa.DateTime)
+    )
+
+    subtree = sql.select(
+        shop_unit.c.id.label('category_id'),
+        shop_unit.c.id,
+        shop_unit.c.type
+    ).where(
+        sql.cast(shop_unit.c.type, sa.Text) == 'CATEGORY'
+    ).cte(recursive=True)
+    tmp = sql.select(
+        subtree.c.category_id,
+        shop_unit.c.id,
+        shop_unit.c.type
+    ).join(
+        subtree,
+        shop_unit.c.parent_id == subtree.c.id
+    )
+    subtree = subtree.union_all(tmp)
+
+    # Дата категории также меняется, когда из нее уходят дочерние узлы
+    removing_children_dates = sql.select(
+        shop_unit_import.c.parent_id.label('id'),
+        sql.func.max(shop_unit_import.c.expiration_date).label('date')
+    ).where(
+        shop_unit_import.c.expiration_date.is_not(None)
+    ).group_by(
+        shop_unit_import.c.parent_id
+    ).subquery()
+
+    # Как и при импорте, предкам передаются только даты товаров
+    # и ухода дочерних узлов, собственная дата категории меняет
+    # только ее саму
+    contributed_date = sql.case(
+        (sql.or_(
+            sql.cast(subtree.c.type, sa.Text) == 'OFFER',
+            subtree.c.id == subtree.c.category_id
+        ), shop_unit_import.c.date)
+    )
+    totals = sql.select(
+        subtree.c.category_id,
+        sql.func.coalesce(sql.func.sum(shop_unit_import.c.price), 0),
+        sql.func.count(shop_unit_import.c.price),
+        sql.func.max(sql.func.greatest(
+            contributed_date, removing_children_dates.c.date
+        ))
+    ).join_from(
+        subtree,
+        shop_unit_import,
+        sql.and_(
+            shop_unit_import.c.id == subtree.c.id,
+            shop_unit_import.c.expiration_date.is_(None)
+        )
+    ).join(
+        removing_children_dates,
+        removing_children_dates.c.id == subtree.c.id,
+        isouter=True
+    ).group_by(
+        subtree.c.category_id
+    )
+    q = sql.insert(category_aggregate).from_select(
+        ['id', 'sum_price', 'offer_count', 'last_change_date'], totals
+    )
+    op.execute(q)
+
+
+def upgrade() -> None:
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.create_table('category_aggregate',
+    sa.Column('id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('sum_price', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('offer_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('last_change_date', sa.DateTime(), nullable=False),
+    sa.CheckConstraint('sum_price >= 0 AND offer_count >= 0', name=op.f('ck_category_aggregate_totals_validation')),
+    sa.ForeignKeyConstraint(['id'], ['shop_unit.id'], name=op.f('fk_category_aggregate_id_shop_unit'), onupdate='CASCADE', ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id', name=op.f('pk_category_aggregate'))
+    )
+    op.create_index(op.f('ix_shop_unit_parent_id'), 'shop_unit', ['parent_id'], unique=False)
+    op.create_index(op.f('ix_shop_unit_import_parent_id'), 'shop_unit_import', ['parent_id'], unique=False)
+    # ### end Alembic commands ###
+    data_upgrade()
+
+
+def downgrade() -> None:
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.drop_index(op.f('ix_shop_unit_import_parent_id'), table_name='shop_unit_import')
+    op.drop_index(op.f('ix_shop_unit_parent_id'), table_name='shop_unit')
+    op.drop_table('category_aggregate')
+    # ### end Alembic commands ###
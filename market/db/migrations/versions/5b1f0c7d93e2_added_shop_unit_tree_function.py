@@ -0,0 +1,112 @@
+"""Added shop unit tree function
+
+Revision ID: 5b1f0c7d93e2
+Revises: 466003a3bbca
+Create Date: 2026-10-17 19:12:36.584120
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1f0c7d93e2'
+down_revision = '466003a3bbca'
+branch_labels = None
+depends_on = None
+
+
+# JSON узла в формате ShopUnitSchema
+SHOP_UNIT_JSON_FUNCTION = """
+CREATE FUNCTION shop_unit_json(
+    unit shop_unit, aggregate category_aggregate, children json
+) RETURNS json
+LANGUAGE sql STABLE AS $$
+    SELECT json_build_object(
+        'id', unit.id,
+        'name', unit.name,
+        'type', unit.type,
+        'parentId', unit.parent_id,
+        'price', coalesce(
+            aggregate.sum_price / nullif(aggregate.offer_count, 0),
+            unit.price
+        ),
+        'date', to_char(
+            coalesce(aggregate.last_change_date, unit.date),
+            'YYYY-MM-DD"T"HH24:MI:SS.MS"Z"'
+        ),
+        'children', CASE
+            WHEN unit.type = 'CATEGORY' THEN coalesce(children, '[]'::json)
+        END
+    )
+$$
+"""
+
+# Дерево собирается снизу вверх по уровням поддерева: на каждом уровне
+# узлы группируются по родителю, а их JSON становится списком детей
+# для уровня выше. Функция объявлена STABLE, поэтому все запросы внутри
+# нее видят один снимок данных. Размер уровней сильно различается,
+# поэтому общий план запроса не переиспользуется. Узлы соединяются только
+# с массивом идентификаторов, а JSON детей берется по позиции, чтобы
+# при вложенных циклах не разворачивать массив JSON повторно.
+SHOP_UNIT_TREE_FUNCTION = """
+CREATE FUNCTION shop_unit_tree(root_id uuid) RETURNS json
+LANGUAGE plpgsql STABLE
+SET plan_cache_mode = force_custom_plan AS $$
+DECLARE
+    max_level integer;
+    parent_ids uuid[] := '{}';
+    children json[] := '{}';
+    tree json;
+BEGIN
+    SELECT max(depth) INTO max_level
+    FROM shop_unit_closure
+    WHERE ancestor_id = root_id;
+    IF max_level IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    FOR current_depth IN REVERSE max_level..1 LOOP
+        SELECT array_agg(nodes.parent_id), array_agg(nodes.children)
+        INTO parent_ids, children
+        FROM (
+            SELECT
+                shop_unit.parent_id,
+                json_agg(shop_unit_json(
+                    shop_unit, category_aggregate, children[subtrees.position]
+                ) ORDER BY shop_unit.id) AS children
+            FROM shop_unit_closure
+            JOIN shop_unit
+                ON shop_unit.id = shop_unit_closure.descendant_id
+            LEFT JOIN category_aggregate
+                ON category_aggregate.id = shop_unit.id
+            LEFT JOIN unnest(parent_ids) WITH ORDINALITY
+                AS subtrees(id, position)
+                ON subtrees.id = shop_unit.id
+            WHERE shop_unit_closure.ancestor_id = root_id
+                AND shop_unit_closure.depth = current_depth
+            GROUP BY shop_unit.parent_id
+        ) AS nodes;
+    END LOOP;
+
+    SELECT shop_unit_json(shop_unit, category_aggregate, children[1])
+    INTO tree
+    FROM shop_unit
+    LEFT JOIN category_aggregate
+        ON category_aggregate.id = shop_unit.id
+    WHERE shop_unit.id = root_id;
+    RETURN tree;
+END
+$$
+"""
+
+
+def upgrade() -> None:
+    op.execute(SHOP_UNIT_JSON_FUNCTION)
+    op.execute(SHOP_UNIT_TREE_FUNCTION)
+
+
+def downgrade() -> None:
+    op.execute('DROP FUNCTION shop_unit_tree(uuid)')
+    op.execute(
+        'DROP FUNCTION shop_unit_json(shop_unit, category_aggregate, json)'
+    )
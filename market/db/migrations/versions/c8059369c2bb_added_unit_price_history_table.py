@@ -0,0 +1,113 @@
+"""Added unit price history table
+
+Revision ID: c8059369c2bb
+Revises: 5b1f0c7d93e2
+Create Date: 2026-10-17 19:33:18.451906
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8059369c2bb'
+down_revision = '5b1f0c7d93e2'
+branch_labels = None
+depends_on = None
+
+
+# Пересчитывает историю цен узлов по истории импортов. Для каждого узла
+# обходится история его поддерева: версия потомка учитывается в тот период,
+# когда она была актуальна и входила в поддерево. Цена меняется на границах
+# этих периодов: в начале периода товар добавляет свою цену к сумме,
+# в конце - вычитает.
+UNIT_PRICE_HISTORY_REBUILD_FUNCTION = """
+CREATE FUNCTION unit_price_history_rebuild(unit_ids uuid[]) RETURNS void
+LANGUAGE sql VOLATILE AS $$
+    DELETE FROM unit_price_history WHERE id = ANY(unit_ids);
+
+    WITH RECURSIVE subtree_history(
+        root_id, id, type, price, observed_period
+    ) AS (
+        SELECT id, id, type, price, actuality_period
+        FROM shop_unit_import
+        WHERE id = ANY(unit_ids)
+        UNION ALL
+        SELECT
+            subtree_history.root_id,
+            shop_unit_import.id,
+            shop_unit_import.type,
+            shop_unit_import.price,
+            shop_unit_import.actuality_period * subtree_history.observed_period
+        FROM subtree_history
+        JOIN shop_unit_import
+            ON shop_unit_import.parent_id = subtree_history.id
+            AND shop_unit_import.actuality_period
+                && subtree_history.observed_period
+    ), changes AS (
+        SELECT root_id, date, sum(price) AS price, sum(offer) AS offer
+        FROM (
+            SELECT
+                root_id,
+                lower(observed_period) AS date,
+                price,
+                (type = 'OFFER')::integer AS offer
+            FROM subtree_history
+            UNION ALL
+            SELECT
+                root_id,
+                upper(observed_period),
+                -price,
+                -(type = 'OFFER')::integer
+            FROM subtree_history
+            WHERE NOT upper_inf(observed_period)
+        ) AS events
+        GROUP BY root_id, date
+    ), totals AS (
+        SELECT
+            root_id,
+            date,
+            lead(date) OVER history AS valid_to,
+            sum(price) OVER history AS sum_price,
+            sum(offer) OVER history AS offer_count
+        FROM changes
+        WINDOW history AS (PARTITION BY root_id ORDER BY date)
+    )
+    INSERT INTO unit_price_history (id, valid_from, valid_to, price)
+    SELECT
+        root_id,
+        date,
+        valid_to,
+        -- Целочисленное деление, как и для цены категории в /nodes
+        sum_price::bigint / nullif(offer_count, 0)::bigint
+    FROM totals
+$$
+"""
+
+
+def upgrade() -> None:
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.create_table('unit_price_history',
+    sa.Column('id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('valid_from', sa.DateTime(), nullable=False),
+    sa.Column('valid_to', sa.DateTime(), nullable=True),
+    sa.Column('price', sa.Integer(), nullable=True),
+    sa.CheckConstraint('valid_to IS NULL OR valid_to > valid_from', name=op.f('ck_unit_price_history_period_validation')),
+    sa.ForeignKeyConstraint(['id'], ['shop_unit.id'], name=op.f('fk_unit_price_history_id_shop_unit'), onupdate='CASCADE', ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id', 'valid_from', name=op.f('pk_unit_price_history'))
+    )
+    op.create_index('ix_unit_price_history_actual', 'unit_price_history', ['id'], unique=True, postgresql_where=sa.text('valid_to IS NULL'))
+    # ### end Alembic commands ###
+    op.execute(UNIT_PRICE_HISTORY_REBUILD_FUNCTION)
+    op.execute(
+        'SELECT unit_price_history_rebuild(array(SELECT id FROM shop_unit))'
+    )
+
+
+def downgrade() -> None:
+    op.execute('DROP FUNCTION unit_price_history_rebuild(uuid[])')
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.drop_index('ix_unit_price_history_actual', table_name='unit_price_history', postgresql_where=sa.text('valid_to IS NULL'))
+    op.drop_table('unit_price_history')
+    # ### end Alembic commands ###
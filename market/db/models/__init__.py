@@ -1,2 +1,6 @@
 from .base import Base
-from .shop_unit import ShopUnit, ShopUnitType, ShopUnitImport
+from .shop_unit import (
+    CategoryAggregate, ShopUnit, ShopUnitClosure,
+    ShopUnitType, ShopUnitImport, UnitPriceHistory
+)
+from .import_job import ImportJob, ImportJobStatus
@@ -0,0 +1,51 @@
+from enum import Enum, unique
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from .base import Base
+
+
+@unique
+class ImportJobStatus(str, Enum):
+    PENDING = 'PENDING'
+    DONE = 'DONE'
+    FAILED = 'FAILED'
+
+
+ImportJobStatusEnum = postgresql.ENUM(
+    ImportJobStatus, name='import_job_status_enum', create_type=False
+)
+
+
+class ImportJob(Base):
+    """
+    Выгрузка, принятая /imports/async. Ожидающие выгрузки применяются
+    в фоне по возрастанию даты обновления.
+    """
+    __tablename__ = 'import_job'
+
+    id = sa.Column(postgresql.UUID(as_uuid=True), primary_key=True)
+    status = sa.Column(
+        ImportJobStatusEnum, nullable=False,
+        default=ImportJobStatus.PENDING
+    )
+    update_date = sa.Column(sa.DateTime, nullable=False)
+    # Элементы выгрузки в порядке вставки: (id, type, parent_id,
+    # parent_type, name, price)
+    items = sa.Column(postgresql.JSONB, nullable=False)
+    item_count = sa.Column(sa.Integer, nullable=False)
+    created_at = sa.Column(
+        sa.DateTime, nullable=False,
+        server_default=sa.func.timezone('UTC', sa.func.now())
+    )
+    finished_at = sa.Column(sa.DateTime)
+    error = sa.Column(sa.Text)
+
+    __table_args__ = (
+        # Очередь ожидающих выгрузок
+        sa.Index(
+            'ix_import_job_pending', update_date, created_at,
+            postgresql_where=status == ImportJobStatus.PENDING
+        ),
+    )
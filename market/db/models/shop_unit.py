@@ -1,6 +1,7 @@
 from enum import Enum, unique
 
 import sqlalchemy as sa
+from sqlalchemy import orm
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.hybrid import hybrid_property
 
@@ -24,10 +25,17 @@ class ShopUnit(Base):
     id = sa.Column(postgresql.UUID(as_uuid=True), primary_key=True)
     type = sa.Column(ShopUnitTypeEnum, nullable=False)
 
-    parent_id = sa.Column(postgresql.UUID(as_uuid=True))
+    parent_id = sa.Column(postgresql.UUID(as_uuid=True), index=True)
     parent_type = sa.Column(ShopUnitTypeEnum)
 
+    # Актуальная версия узла, чтобы не обращаться за ней к истории импортов
+    name = sa.Column(sa.Text, nullable=False)
+    price = sa.Column(sa.Integer)
+    date = sa.Column(sa.DateTime, nullable=False)
+
     __table_args__ = (
+        # Для постраничного чтения /sales по ключу (date, id)
+        sa.Index('ix_shop_unit_date_id', date, id),
         sa.UniqueConstraint(id, type),
         sa.ForeignKeyConstraint(
             [parent_id, parent_type], [id, type],
@@ -37,10 +45,42 @@ class ShopUnit(Base):
             'parent_id IS NULL AND parent_type IS NULL '
             f'OR parent_id IS NOT NULL AND parent_type = \'{ShopUnitType.CATEGORY}\'',
             name='parent_type_validation'
+        ),
+        sa.CheckConstraint(
+            f'type = \'{ShopUnitType.CATEGORY}\' AND price IS NULL '
+            f'OR type = \'{ShopUnitType.OFFER}\' AND price IS NOT NULL',
+            name='price_validation'
         )
     )
 
 
+class ShopUnitClosure(Base):
+    __tablename__ = 'shop_unit_closure'
+
+    ancestor_id = sa.Column(
+        postgresql.UUID(as_uuid=True),
+        sa.ForeignKey(ShopUnit.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True
+    )
+    descendant_id = sa.Column(
+        postgresql.UUID(as_uuid=True),
+        sa.ForeignKey(ShopUnit.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True,
+        index=True
+    )
+    depth = sa.Column(sa.Integer, nullable=False)
+
+    __table_args__ = (
+        # Для чтения поддерева /nodes до заданной глубины
+        sa.Index('ix_shop_unit_closure_ancestor_id_depth', ancestor_id, depth),
+        sa.CheckConstraint(
+            'depth > 0 AND ancestor_id != descendant_id '
+            'OR depth = 0 AND ancestor_id = descendant_id',
+            name='depth_validation'
+        ),
+    )
+
+
 class ShopUnitImport(Base):
     __tablename__ = 'shop_unit_import'
 
@@ -49,17 +89,23 @@ class ShopUnitImport(Base):
     date = sa.Column(sa.DateTime, primary_key=True, nullable=False)
     parent_id = sa.Column(
         postgresql.UUID(as_uuid=True),
-        sa.ForeignKey(ShopUnit.id, ondelete='SET NULL', onupdate='CASCADE')
+        sa.ForeignKey(ShopUnit.id, ondelete='SET NULL', onupdate='CASCADE'),
+        index=True
     )
     name = sa.Column(sa.Text, nullable=False)
     price = sa.Column(sa.Integer)
     expiration_date = sa.Column(sa.DateTime)
-
-    @hybrid_property
-    def actuality_period(self):
-        return sa.func.tsrange(self.date, self.expiration_date, '[)')
+    actuality_period = orm.deferred(sa.Column(
+        postgresql.TSRANGE,
+        sa.Computed('tsrange(date, expiration_date, \'[)\')', persisted=True)
+    ))
 
     __table_args__ = (
+        sa.Index('ix_shop_unit_import_date_id', date, id),
+        sa.Index(
+            'ix_shop_unit_import_actuality_period', actuality_period,
+            postgresql_using='gist'
+        ),
         sa.ForeignKeyConstraint(
             [id, type], [ShopUnit.id, ShopUnit.type],
             ondelete='CASCADE', onupdate='CASCADE'
@@ -79,3 +125,55 @@ class ShopUnitImport(Base):
             name='expiration_date_validation'
         )
     )
+
+
+class CategoryAggregate(Base):
+    __tablename__ = 'category_aggregate'
+
+    id = sa.Column(
+        postgresql.UUID(as_uuid=True),
+        sa.ForeignKey(ShopUnit.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True
+    )
+    sum_price = sa.Column(sa.BigInteger, nullable=False, server_default='0')
+    offer_count = sa.Column(sa.Integer, nullable=False, server_default='0')
+    last_change_date = sa.Column(sa.DateTime, nullable=False)
+
+    @hybrid_property
+    def price(self):
+        return self.sum_price / sa.func.nullif(self.offer_count, 0)
+
+    __table_args__ = (
+        sa.CheckConstraint(
+            'sum_price >= 0 AND offer_count >= 0',
+            name='totals_validation'
+        ),
+    )
+
+
+class UnitPriceHistory(Base):
+    """
+    Цена узла во времени: в период [valid_from, valid_to) цена узла
+    была равна price. Строка с пустым valid_to - текущая цена.
+    """
+    __tablename__ = 'unit_price_history'
+
+    id = sa.Column(
+        postgresql.UUID(as_uuid=True),
+        sa.ForeignKey(ShopUnit.id, ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True
+    )
+    valid_from = sa.Column(sa.DateTime, primary_key=True)
+    valid_to = sa.Column(sa.DateTime)
+    price = sa.Column(sa.Integer)
+
+    __table_args__ = (
+        sa.Index(
+            'ix_unit_price_history_actual', id,
+            unique=True, postgresql_where=valid_to.is_(None)
+        ),
+        sa.CheckConstraint(
+            'valid_to IS NULL OR valid_to > valid_from',
+            name='period_validation'
+        ),
+    )
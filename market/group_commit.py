@@ -0,0 +1,113 @@
+import asyncio
+from typing import List, Optional, Tuple
+
+from fastapi import Request
+
+from market.config import settings
+from market.schemas import ShopUnitsListImportSchema
+from market.services import MarketService
+
+
+class ImportGroupCommit:
+    """
+    Объединяет небольшие импорты, пришедшие в процесс почти одновременно,
+    в одну транзакцию.
+
+    Первый импорт группы ждет delay секунд, пока к нему присоединяются
+    следующие, затем применяет группу своим подключением. Остальные
+    запросы ждут результат своего импорта. Как и commit_delay
+    в PostgreSQL, первый импорт ждет, только если процесс уже применяет
+    не меньше siblings других импортов, иначе группа применяется сразу.
+    Импорты больше max_items элементов применяются отдельно,
+    а не поместившиеся в группу начинают новую.
+    """
+
+    def __init__(
+        self,
+        delay: float,
+        max_items: int,
+        siblings: int = 1
+    ) -> None:
+        self.delay = delay
+        self.max_items = max_items
+        self.siblings = siblings
+        self._group: Optional[
+            List[Tuple[ShopUnitsListImportSchema, asyncio.Future]]
+        ] = None
+        self._group_items = 0
+        # Сколько импортов или групп процесс применяет сейчас
+        self._active = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.delay > 0 and self.max_items > 0
+
+    async def import_shop_units(
+        self,
+        payload: ShopUnitsListImportSchema,
+        service: MarketService
+    ) -> None:
+        count = len(payload.items)
+        if not self.enabled or not count or count > self.max_items:
+            self._active += 1
+            try:
+                await service.import_shop_units(payload)
+            finally:
+                self._active -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        if self._group is not None and \
+                self._group_items + count <= self.max_items:
+            self._group.append((payload, future))
+            self._group_items += count
+            await future
+            return
+
+        group = [(payload, future)]
+        self._group = group
+        self._group_items = count
+        self._active += 1
+        try:
+            if self._active > self.siblings:
+                await asyncio.sleep(self.delay)
+            if self._group is group:
+                self._group = None
+            results = await service.import_shop_units_group(
+                [payload for payload, _ in group]
+            )
+        except BaseException as e:
+            if self._group is group:
+                self._group = None
+            for _, member in group[1:]:
+                if member.done():
+                    continue
+                if isinstance(e, asyncio.CancelledError):
+                    member.cancel()
+                else:
+                    member.set_exception(e)
+            raise
+        finally:
+            self._active -= 1
+
+        for (_, member), error in zip(group[1:], results[1:]):
+            if member.done():
+                continue
+            if error is None:
+                member.set_result(None)
+            else:
+                member.set_exception(error)
+        if results[0] is not None:
+            raise results[0]
+
+
+def create_import_group_commit() -> ImportGroupCommit:
+    return ImportGroupCommit(
+        settings.import_group_commit_delay,
+        settings.import_group_commit_max_items,
+        settings.import_group_commit_siblings
+    )
+
+
+def get_import_group_commit(request: Request) -> ImportGroupCommit:
+    return request.app.state.import_group_commit
@@ -1,6 +1,7 @@
 from fastapi import APIRouter
 
 from .api import router as shop_router
+from .metrics import router as metrics_router
 from .exceptions import (
     request_validation_error_handler,
     http_error_handler
@@ -9,3 +10,4 @@ from .exceptions import (
 
 router = APIRouter()
 router.include_router(shop_router)
+router.include_router(metrics_router)
@@ -1,18 +1,23 @@
 from datetime import datetime
 from http import HTTPStatus
-from typing import Optional
+from typing import AsyncIterator, Optional
 from uuid import UUID
 
 from fastapi import (
     APIRouter, Depends, HTTPException,
-    Path, Query, Response
+    Path, Query, Request, Response
 )
+from fastapi.responses import StreamingResponse
 
+from market.group_commit import ImportGroupCommit, get_import_group_commit
+from market.import_queue import ImportQueueWorker, get_import_queue
 from market.schemas import (
-    ShopUnitsListImportSchema,
-    ShopUnitSchema, ShopUnitsListSchema
+    ImportJobSchema, ShopUnitsListImportSchema, ShopUnitsImportStream,
+    ShopUnitSchema, ShopUnitsListSchema,
+    ShopUnitIdsSchema, ShopUnitsTreesSchema
 )
 from market.schemas.base import datetime_iso8601_decoder
+from market.schemas.pagination import PageCursor, decode_cursor
 from market.services import MarketService
 
 
@@ -26,12 +31,65 @@ router = APIRouter()
 )
 async def import_shop_units(
     payload: ShopUnitsListImportSchema,
+    service: MarketService = Depends(),
+    group_commit: ImportGroupCommit = Depends(get_import_group_commit)
+):
+    await group_commit.import_shop_units(payload, service)
+    return Response()
+
+
+@router.post(
+    '/imports/stream',
+    response_class=Response,
+    tags=['Дополнительные задачи']
+)
+async def import_shop_units_stream(
+    request: Request,
     service: MarketService = Depends()
 ):
-    await service.import_shop_units(payload)
+    """
+    То же, что и /imports, но тело запроса разбирается по мере получения
+    и сразу загружается в базу данных. Подходит для больших выгрузок.
+    """
+    stream = ShopUnitsImportStream(request.stream())
+    await service.import_shop_units_stream(stream)
     return Response()
 
 
+@router.post(
+    '/imports/async',
+    response_model=ImportJobSchema,
+    status_code=HTTPStatus.ACCEPTED,
+    tags=['Дополнительные задачи']
+)
+async def create_import_job(
+    payload: ShopUnitsListImportSchema,
+    service: MarketService = Depends(),
+    import_queue: ImportQueueWorker = Depends(get_import_queue)
+):
+    """
+    То же, что и /imports, но выгрузка только сохраняется в очередь
+    и применяется в фоне. Выгрузки применяются по возрастанию updateDate,
+    подряд идущие небольшие выгрузки - одной транзакцией.
+    Результат можно узнать по id через GET /imports/{id}.
+    """
+    job = await service.create_import_job(payload)
+    import_queue.wake()
+    return job
+
+
+@router.get(
+    '/imports/{id}',
+    response_model=ImportJobSchema,
+    tags=['Дополнительные задачи']
+)
+async def get_import_job(
+    id_: UUID = Path(alias='id'),
+    service: MarketService = Depends()
+):
+    return await service.get_import_job(id_)
+
+
 @router.delete(
     '/delete/{id}',
     response_class=Response,
@@ -52,9 +110,34 @@ async def delete_shop_unit(
 )
 async def get_nodes(
     id_: UUID = Path(alias='id'),
+    depth: Optional[int] = Query(None, ge=0),
+    service: MarketService = Depends()
+):
+    """
+    Дерево узла. Если задана глубина depth, возвращаются только узлы
+    не глубже depth уровней от запрошенного: у категорий на последнем
+    уровне children равно null, а цена и дата учитывают все поддерево.
+    """
+    content = await service.get_shop_unit_nodes(id_, depth)
+    return Response(content, media_type='application/json')
+
+
+@router.post(
+    '/nodes/batch',
+    response_model=ShopUnitsTreesSchema,
+    tags=['Дополнительные задачи']
+)
+async def get_nodes_batch(
+    payload: ShopUnitIdsSchema,
     service: MarketService = Depends()
 ):
-    return await service.get_shop_unit_nodes(id_)
+    """
+    То же, что и /nodes/{id}, для нескольких узлов сразу: деревья
+    возвращаются в порядке ids, повторы отбрасываются. Все поддеревья
+    читаются одним запросом. Если хотя бы одного узла нет, возвращается 404.
+    """
+    content = await service.get_shop_unit_nodes_batch(payload.ids)
+    return Response(content, media_type='application/json')
 
 
 def get_strict_date(**kwargs):
@@ -72,6 +155,45 @@ def get_strict_date(**kwargs):
     return parser
 
 
+def get_page_limit(
+    limit: Optional[int] = Query(
+        None, ge=1, description='Размер страницы'
+    )
+) -> Optional[int]:
+    return limit
+
+
+def get_page_cursor(
+    cursor: Optional[str] = Query(
+        None, description='Курсор страницы из nextCursor предыдущей страницы'
+    )
+) -> Optional[PageCursor]:
+    if cursor is None:
+        return None
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, 'Validation Failed')
+
+
+async def make_streaming_response(
+    chunks: AsyncIterator[bytes]
+) -> StreamingResponse:
+    # Первая часть читается до отправки заголовков, чтобы ошибки
+    # вроде отсутствующего узла вернулись с правильным статусом
+    first_chunk = await chunks.__anext__()
+
+    async def content() -> AsyncIterator[bytes]:
+        try:
+            yield first_chunk
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+    return StreamingResponse(content(), media_type='application/json')
+
+
 @router.get(
     '/sales', 
     response_model=ShopUnitsListSchema,
@@ -79,9 +201,17 @@ def get_strict_date(**kwargs):
 )
 async def get_sales(
     date_: datetime = Depends(get_strict_date(default=..., alias='date')),
+    limit: Optional[int] = Depends(get_page_limit),
+    cursor: Optional[PageCursor] = Depends(get_page_cursor),
     service: MarketService = Depends()
 ):
-    return await service.get_sales(date_)
+    """
+    С параметрами limit и cursor товары возвращаются постранично
+    в порядке даты обновления, а в ответе есть поле nextCursor.
+    """
+    return await make_streaming_response(
+        service.get_sales(date_, limit, cursor)
+    )
 
 
 @router.get(
@@ -93,8 +223,14 @@ async def get_node_statistic(
     id_: UUID = Path(alias='id'),
     date_start: datetime = Depends(get_strict_date(default=None, alias='dateStart')),
     date_end: datetime = Depends(get_strict_date(default=None, alias='dateEnd')),
+    limit: Optional[int] = Depends(get_page_limit),
+    cursor: Optional[PageCursor] = Depends(get_page_cursor),
     service: MarketService = Depends()
 ):
-    return await service.get_shop_unit_statistic(
-        id_, date_start, date_end
-    )
+    """
+    С параметрами limit и cursor статистика возвращается постранично,
+    а в ответе есть поле nextCursor.
+    """
+    return await make_streaming_response(service.get_shop_unit_statistic(
+        id_, date_start, date_end, limit, cursor
+    ))
@@ -0,0 +1,18 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from market.db.connection import get_engine
+from market.db.metrics import render_pool_metrics
+
+
+router = APIRouter()
+
+
+@router.get(
+    '/metrics',
+    response_class=PlainTextResponse,
+    include_in_schema=False
+)
+async def get_metrics(engine: AsyncEngine = Depends(get_engine)):
+    return render_pool_metrics(engine.pool)
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from typing import Callable, Optional
+
+from fastapi import Request
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from market.cache import ResponseCache
+from market.config import settings
+from market.db.connection import create_session
+from market.services import MarketService
+
+
+logger = logging.getLogger(__name__)
+
+
+class ImportQueueWorker:
+    """
+    Фоновая задача, которая применяет выгрузки из очереди /imports/async.
+
+    Задача запускается в каждом процессе API, но очередь в каждый момент
+    обрабатывает только один из них. Процесс, принявший выгрузку,
+    будит свою задачу сразу, остальные проверяют очередь
+    раз в poll_interval секунд.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], AsyncSession],
+        cache: ResponseCache,
+        poll_interval: float = 1
+    ) -> None:
+        self.session_factory = session_factory
+        self.cache = cache
+        self.poll_interval = poll_interval
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def apply(self) -> int:
+        async with self.session_factory() as session:
+            return await MarketService(session, self.cache).apply_import_jobs()
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                processed = await self.apply()
+            except Exception:
+                logger.exception('Failed to apply import jobs')
+                processed = 0
+            if processed:
+                continue
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), self.poll_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+
+
+def create_import_queue_worker(cache: ResponseCache) -> ImportQueueWorker:
+    return ImportQueueWorker(
+        create_session, cache, settings.import_queue_poll_interval
+    )
+
+
+def get_import_queue(request: Request) -> ImportQueueWorker:
+    return request.app.state.import_queue
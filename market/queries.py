@@ -0,0 +1,275 @@
+"""
+Запросы на чтение, которые строятся один раз при импорте модуля.
+
+Значения подставляются через именованные параметры при выполнении,
+поэтому на каждый запрос SQLAlchemy не собирает дерево выражения заново
+и находит уже скомпилированный запрос в кэше.
+"""
+from typing import (
+    Any, AsyncIterator, Callable, Dict, List, NamedTuple, Tuple
+)
+
+import asyncpg
+import sqlalchemy as sa
+from sqlalchemy import sql
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql.asyncpg import PGDialect_asyncpg
+from sqlalchemy.sql.expression import Select, Subquery
+
+from market.db.models import (
+    CategoryAggregate, ShopUnit, ShopUnitClosure,
+    ShopUnitImport, ShopUnitType, UnitPriceHistory
+)
+
+
+class CompiledQuery:
+    """
+    Запрос, заранее скомпилированный в SQL для asyncpg.
+
+    Выполняется напрямую на соединении asyncpg и возвращает его записи:
+    для каждой строки не создаются объекты Row и не вызываются
+    обработчики типов SQLAlchemy. Колонки с перечислениями возвращаются
+    строками.
+    """
+
+    def __init__(self, statement: Select) -> None:
+        self.compiled = statement.compile(dialect=PGDialect_asyncpg())
+        placeholders = tuple(
+            f'${i}' for i in range(1, len(self.compiled.positiontup) + 1)
+        )
+        self.sql = self.compiled.string % placeholders
+
+    def _arguments(self, params: Dict[str, Any]) -> Tuple[Any, ...]:
+        values = self.compiled.construct_params(params)
+        return tuple(values[name] for name in self.compiled.positiontup)
+
+    async def fetch(
+        self,
+        connection: asyncpg.Connection,
+        params: Dict[str, Any]
+    ) -> List[asyncpg.Record]:
+        return await connection.fetch(self.sql, *self._arguments(params))
+
+    async def cursor(
+        self,
+        connection: asyncpg.Connection,
+        params: Dict[str, Any],
+        fetch_size: int
+    ) -> AsyncIterator[List[asyncpg.Record]]:
+        """
+        Строки результата пачками не больше fetch_size через курсор
+        на стороне сервера. Курсор существует только внутри транзакции.
+        """
+        cursor = await connection.cursor(self.sql, *self._arguments(params))
+        while True:
+            rows = await cursor.fetch(fetch_size)
+            if not rows:
+                return
+            yield rows
+
+
+class ListQueries(NamedTuple):
+    """
+    Запрос списка узлов целиком и постранично: первая страница
+    и страницы после курсора.
+    """
+    full: CompiledQuery
+    first_page: CompiledQuery
+    next_page: CompiledQuery
+
+
+shop_unit_id = sql.bindparam(
+    'shop_unit_id', type_=postgresql.UUID(as_uuid=True)
+)
+shop_unit_ids = sql.bindparam(
+    'shop_unit_ids', type_=postgresql.ARRAY(postgresql.UUID(as_uuid=True))
+)
+# Глубина, до которой читается поддерево /nodes
+max_depth = sql.bindparam('max_depth', type_=sa.Integer)
+date_start = sql.bindparam('date_start', type_=sa.DateTime)
+date_end = sql.bindparam('date_end', type_=sa.DateTime)
+# Постраничное чтение: размер страницы (NULL - без ограничения)
+# и ключ (date, id) последней строки предыдущей страницы
+limit = sql.bindparam('limit', type_=sa.Integer)
+cursor_date = sql.bindparam('cursor_date', type_=sa.DateTime)
+cursor_id = sql.bindparam('cursor_id', type_=postgresql.UUID(as_uuid=True))
+
+
+SHOP_UNIT_EXISTS = sql.select(
+    sql.exists(ShopUnit.id).where(ShopUnit.id == shop_unit_id)
+)
+
+# Типы существующих узлов для проверки выгрузки до записи
+SHOP_UNIT_TYPES = CompiledQuery(sql.select(
+    ShopUnit.id,
+    ShopUnit.type
+).where(
+    ShopUnit.id == sql.any_(shop_unit_ids)
+))
+
+# Документ целиком собирает функция shop_unit_tree
+SHOP_UNIT_TREE_JSON = sql.select(
+    sql.cast(sql.func.shop_unit_tree(shop_unit_id), sa.Text)
+)
+
+
+def _select_shop_unit_nodes(subtree: Subquery) -> Select:
+    # Узлы поддерева с ценой и датой с учетом агрегатов категорий
+    return sql.select(
+        ShopUnit.id,
+        ShopUnit.name,
+        ShopUnit.type,
+        ShopUnit.parent_id,
+        sql.func.coalesce(
+            CategoryAggregate.price, ShopUnit.price
+        ).label('price'),
+        sql.func.coalesce(
+            CategoryAggregate.last_change_date, ShopUnit.date
+        ).label('date')
+    ).join_from(
+        subtree,
+        ShopUnit,
+        ShopUnit.id == subtree.c.id
+    ).join(
+        CategoryAggregate,
+        CategoryAggregate.id == subtree.c.id,
+        isouter=True
+    )
+
+
+def _build_shop_unit_nodes(limit_depth: bool = False) -> Select:
+    subtree = sql.select(
+        ShopUnitClosure.descendant_id.label('id'),
+        ShopUnitClosure.depth.label('level')
+    ).where(
+        ShopUnitClosure.ancestor_id == shop_unit_id
+    )
+    if limit_depth:
+        # Читаются только отображаемые уровни: цены и даты категорий
+        # на границе уже посчитаны в category_aggregate
+        subtree = subtree.where(ShopUnitClosure.depth <= max_depth)
+    subtree = subtree.subquery()
+
+    return _select_shop_unit_nodes(subtree).order_by(
+        subtree.c.level, ShopUnit.parent_id, ShopUnit.id
+    )
+
+
+def _build_shop_unit_nodes_batch() -> Select:
+    # Поддеревья, вложенные в другие запрошенные поддеревья,
+    # читаются один раз
+    subtree = sql.select(
+        ShopUnitClosure.descendant_id.label('id')
+    ).where(
+        ShopUnitClosure.ancestor_id == sql.any_(shop_unit_ids)
+    ).distinct().subquery()
+
+    return _select_shop_unit_nodes(subtree).order_by(ShopUnit.id)
+
+
+def _build_sales(
+    paginate: bool = False,
+    after_cursor: bool = False
+) -> Select:
+    # Актуальные версии берем из shop_unit, а из истории - только
+    # версии за те же сутки, которые устарели уже после date_end
+    actual = sql.select(
+        ShopUnit.id,
+        ShopUnit.name,
+        ShopUnit.type,
+        ShopUnit.parent_id,
+        ShopUnit.price,
+        ShopUnit.date
+    ).where(
+        ShopUnit.type == ShopUnitType.OFFER,
+        ShopUnit.date.between(date_start, date_end)
+    )
+    expired = sql.select(
+        ShopUnitImport.id,
+        ShopUnitImport.name,
+        ShopUnitImport.type,
+        ShopUnitImport.parent_id,
+        ShopUnitImport.price,
+        ShopUnitImport.date
+    ).where(
+        ShopUnitImport.type == ShopUnitType.OFFER,
+        ShopUnitImport.date.between(date_start, date_end),
+        ShopUnitImport.expiration_date > date_end
+    )
+    if not paginate:
+        return actual.union_all(expired)
+
+    # Каждая часть читается диапазоном индекса по (date, id)
+    # не дальше размера страницы, после чего части сливаются
+    parts = []
+    for part, table in ((actual, ShopUnit), (expired, ShopUnitImport)):
+        if after_cursor:
+            part = part.where(
+                sql.tuple_(table.date, table.id)
+                > sql.tuple_(cursor_date, cursor_id)
+            )
+        parts.append(part.order_by(table.date, table.id).limit(limit))
+    sales = sql.union_all(*parts).subquery()
+    return sql.select(sales).order_by(
+        sales.c.date, sales.c.id
+    ).limit(limit)
+
+
+def _build_shop_unit_statistic(
+    paginate: bool = False,
+    after_cursor: bool = False
+) -> Select:
+    # Цены узла за период берутся из готовой истории цен,
+    # а остальные поля - из версии узла, актуальной на момент изменения
+    period = sql.func.tsrange(date_start, date_end, '[)')
+    q = sql.select(
+        ShopUnitImport.id,
+        ShopUnitImport.name,
+        ShopUnitImport.type,
+        ShopUnitImport.parent_id,
+        UnitPriceHistory.price,
+        UnitPriceHistory.valid_from.label('date')
+    ).join_from(
+        UnitPriceHistory,
+        ShopUnitImport,
+        sql.and_(
+            ShopUnitImport.id == UnitPriceHistory.id,
+            ShopUnitImport.actuality_period
+            .op('@>')(UnitPriceHistory.valid_from)
+        )
+    ).where(
+        UnitPriceHistory.id == shop_unit_id,
+        period.op('@>')(UnitPriceHistory.valid_from),
+        # Пока в категории нет товаров, в статистику попадают
+        # только изменения самой категории
+        sql.or_(
+            UnitPriceHistory.price.isnot(None),
+            ShopUnitImport.date == UnitPriceHistory.valid_from
+        )
+    ).order_by(
+        UnitPriceHistory.valid_from
+    )
+    # Все строки относятся к одному узлу,
+    # поэтому ключом страницы служит только дата
+    if after_cursor:
+        q = q.where(UnitPriceHistory.valid_from > cursor_date)
+    if paginate:
+        q = q.limit(limit)
+    return q
+
+
+def _compile_list_queries(build: Callable[..., Select]) -> ListQueries:
+    return ListQueries(
+        CompiledQuery(build()),
+        CompiledQuery(build(paginate=True)),
+        CompiledQuery(build(paginate=True, after_cursor=True))
+    )
+
+
+SHOP_UNIT_NODES = CompiledQuery(_build_shop_unit_nodes())
+SHOP_UNIT_NODES_TO_DEPTH = CompiledQuery(
+    _build_shop_unit_nodes(limit_depth=True)
+)
+SHOP_UNIT_NODES_BATCH = CompiledQuery(_build_shop_unit_nodes_batch())
+SALES = _compile_list_queries(_build_sales)
+SHOP_UNIT_STATISTIC = _compile_list_queries(_build_shop_unit_statistic)
@@ -7,5 +7,9 @@ from .shop_unit import (
     ShopUnitsListImportSchema, 
     ShopUnitSchema, 
     ShopUnitsListSchema,
-    ShopUnitImportSchema
+    ShopUnitImportSchema,
+    ShopUnitIdsSchema,
+    ShopUnitsTreesSchema
 )
+from .import_job import ImportJobSchema
+from .import_stream import ShopUnitsImportStream
@@ -0,0 +1,157 @@
+from typing import (
+    Any, AsyncIterable, AsyncIterator, Dict,
+    Iterable, List, Optional, Sequence
+)
+from uuid import UUID
+
+import orjson
+
+from market.db.models import ShopUnitType
+
+from .base import datetime_iso8601_encoder
+from .pagination import encode_cursor
+
+
+def _default(value: Any) -> Any:
+    # asyncpg возвращает собственный подкласс UUID,
+    # который orjson не сериализует
+    if isinstance(value, UUID):
+        return str(value)
+    raise TypeError
+
+
+def _encode_shop_unit(row: Iterable[Any]) -> Dict[str, Any]:
+    # Колонки строки идут в порядке полей ShopUnitStatisticSchema
+    id_, name, type_, parent_id, price, date = row
+    return {
+        'id': id_,
+        'name': name,
+        'type': type_,
+        'parentId': parent_id,
+        'price': price,
+        'date': datetime_iso8601_encoder(date)
+    }
+
+
+def dump_shop_unit_tree(
+    rows: Iterable[Iterable[Any]],
+    depth: Optional[int] = None
+) -> bytes:
+    """
+    JSON дерева узлов в формате ShopUnitSchema без создания pydantic-моделей.
+    Строки должны быть упорядочены так, чтобы родитель шел раньше детей,
+    первая строка - корень дерева.
+
+    Если задана глубина depth, дети категорий на этой глубине
+    не раскрываются: вместо списка children у них null.
+    """
+    root: Optional[Dict[str, Any]] = None
+    nodes: Dict[Any, Dict[str, Any]] = {}
+    levels: Dict[Any, int] = {}
+    for row in rows:
+        node = _encode_shop_unit(row)
+        if root is None:
+            root = node
+            level = 0
+        else:
+            level = levels[node['parentId']] + 1
+            nodes[node['parentId']]['children'].append(node)
+        if node['type'] == ShopUnitType.CATEGORY and (
+            depth is None or level < depth
+        ):
+            node['children'] = []
+        else:
+            node['children'] = None
+        nodes[node['id']] = node
+        levels[node['id']] = level
+    return orjson.dumps(root, default=_default)
+
+
+def dump_shop_unit_trees(
+    rows: Iterable[Iterable[Any]],
+    root_ids: Iterable[Any]
+) -> List[bytes]:
+    """
+    JSON деревьев узлов с корнями root_ids в формате ShopUnitSchema.
+    Строки - поддеревья корней без повторов в любом порядке, дети узла
+    идут в порядке строк. KeyError, если корня нет среди строк.
+    """
+    nodes: Dict[Any, Dict[str, Any]] = {}
+    for row in rows:
+        node = _encode_shop_unit(row)
+        if node['type'] == ShopUnitType.CATEGORY:
+            node['children'] = []
+        else:
+            node['children'] = None
+        nodes[node['id']] = node
+    # Вложенное поддерево входит в дерево своего предка и отдельно
+    for node in nodes.values():
+        parent = nodes.get(node['parentId'])
+        if parent is not None:
+            parent['children'].append(node)
+    return [
+        orjson.dumps(nodes[root_id], default=_default)
+        for root_id in root_ids
+    ]
+
+
+def dump_shop_units_list(rows: Iterable[Iterable[Any]]) -> bytes:
+    """JSON списка узлов в формате ShopUnitsListSchema."""
+    return orjson.dumps(
+        {'items': list(map(_encode_shop_unit, rows))}, default=_default
+    )
+
+
+def _dump_items(rows: Iterable[Iterable[Any]]) -> bytes:
+    # Элементы списка через запятую, без квадратных скобок
+    return orjson.dumps(
+        list(map(_encode_shop_unit, rows)), default=_default
+    )[1:-1]
+
+
+async def stream_shop_units_list(
+    batches: AsyncIterable[Iterable[Iterable[Any]]]
+) -> AsyncIterator[bytes]:
+    """
+    JSON списка узлов в формате ShopUnitsListSchema по частям:
+    заголовок, затем по одной части на каждую пачку строк.
+    """
+    yield b'{"items":['
+    separator = b''
+    async for rows in batches:
+        items = _dump_items(rows)
+        if items:
+            yield separator + items
+            separator = b','
+    yield b']}'
+
+
+async def stream_shop_units_page(
+    batches: AsyncIterable[Sequence[Sequence[Any]]],
+    limit: Optional[int]
+) -> AsyncIterator[bytes]:
+    """
+    Страница списка узлов: не больше limit строк и курсор следующей
+    страницы nextCursor. Строки должны быть упорядочены по (date, id).
+    Запрос читает на одну строку больше limit: по ней видно,
+    что следующая страница не пуста.
+    """
+    yield b'{"items":['
+    separator = b''
+    count = 0
+    last_row = None
+    has_next_page = False
+    async for rows in batches:
+        if limit is not None and count + len(rows) > limit:
+            rows = rows[:limit - count]
+            has_next_page = True
+        if rows:
+            yield separator + _dump_items(rows)
+            separator = b','
+            count += len(rows)
+            last_row = rows[-1]
+
+    next_cursor = None
+    if has_next_page:
+        next_cursor = encode_cursor(last_row[5], last_row[0])
+    yield b'],"nextCursor":' + orjson.dumps(next_cursor) + b'}'
@@ -0,0 +1,16 @@
+from datetime import datetime
+from typing import Optional
+from uuid import UUID
+
+from market.db.models import ImportJobStatus
+
+from .base import BaseSchema
+
+
+class ImportJobSchema(BaseSchema):
+    id: UUID
+    status: ImportJobStatus
+    update_date: datetime
+    created_at: datetime
+    finished_at: Optional[datetime]
+    error: Optional[str]
@@ -0,0 +1,166 @@
+import codecs
+from datetime import datetime
+import json
+import re
+from typing import (
+    Any, AsyncIterable, AsyncIterator, Optional, Tuple
+)
+from uuid import UUID
+
+from market.db.models import ShopUnitType
+
+from .base import datetime_iso8601_decoder
+
+
+WHITESPACE_PATTERN = re.compile(r'[ \t\n\r]*')
+
+# Размер одного значения ограничен, чтобы некорректный документ
+# не накапливался в буфере целиком
+MAX_VALUE_SIZE = 1 << 20
+
+# (id, type, parent_id, parent_type, name, price)
+ShopUnitRecord = Tuple[
+    UUID, ShopUnitType, Optional[UUID],
+    Optional[ShopUnitType], str, Optional[int]
+]
+
+
+class ShopUnitsImportStream:
+    """
+    Потоковый разбор тела запроса на импорт.
+
+    Элементы items проверяются без создания pydantic-моделей
+    и отдаются по одному, поэтому расход памяти не зависит от размера
+    выгрузки. Дата обновления и количество элементов известны
+    после того, как документ разобран целиком.
+    """
+
+    def __init__(self, chunks: AsyncIterable[bytes]) -> None:
+        self._chunks = chunks.__aiter__()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self.update_date: Optional[datetime] = None
+        self.count = 0
+
+    def __aiter__(self) -> AsyncIterator[ShopUnitRecord]:
+        return self._parse()
+
+    async def _read(self) -> bool:
+        if self._eof:
+            return False
+        try:
+            chunk = await self._chunks.__anext__()
+        except StopAsyncIteration:
+            self._eof = True
+            text = self._text_decoder.decode(b'', final=True)
+        else:
+            text = self._text_decoder.decode(chunk)
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
+        return True
+
+    async def _peek(self) -> str:
+        # Пропускает пробельные символы, в конце документа возвращает ''
+        while True:
+            self._pos = WHITESPACE_PATTERN.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not await self._read():
+                return ''
+
+    async def _expect(self, char: str) -> None:
+        if await self._peek() != char:
+            raise ValueError(f'Expected {char!r}')
+        self._pos += 1
+
+    async def _decode(self) -> Any:
+        await self._peek()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(
+                    self._buffer, self._pos
+                )
+            except json.JSONDecodeError:
+                if len(self._buffer) - self._pos > MAX_VALUE_SIZE:
+                    raise
+                if not await self._read():
+                    raise
+                continue
+            # Число в конце буфера может продолжиться в следующем фрагменте
+            if end == len(self._buffer) and await self._read():
+                continue
+            self._pos = end
+            return value
+
+    async def _parse(self) -> AsyncIterator[ShopUnitRecord]:
+        keys = set()
+        await self._expect('{')
+        if await self._peek() != '}':
+            while True:
+                key = await self._decode()
+                if not isinstance(key, str) or key in keys:
+                    raise ValueError('Invalid key')
+                keys.add(key)
+                await self._expect(':')
+                if key == 'items':
+                    async for record in self._parse_items():
+                        yield record
+                elif key == 'updateDate':
+                    value = await self._decode()
+                    if not isinstance(value, str):
+                        raise ValueError('Invalid updateDate')
+                    self.update_date = datetime_iso8601_decoder(value)
+                else:
+                    await self._decode()
+                if await self._peek() != ',':
+                    break
+                self._pos += 1
+        await self._expect('}')
+        if await self._peek():
+            raise ValueError('Extra data')
+        if 'items' not in keys or self.update_date is None:
+            raise ValueError('Missing required field')
+
+    async def _parse_items(self) -> AsyncIterator[ShopUnitRecord]:
+        await self._expect('[')
+        if await self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            record = self._parse_item(await self._decode())
+            self.count += 1
+            yield record
+            if await self._peek() != ',':
+                break
+            self._pos += 1
+        await self._expect(']')
+
+    @staticmethod
+    def _parse_item(value: Any) -> ShopUnitRecord:
+        if not isinstance(value, dict):
+            raise ValueError('Invalid item')
+        try:
+            id_ = UUID(value['id'])
+            type_ = ShopUnitType(value['type'])
+            name = value['name']
+            parent_id = value.get('parentId')
+            if parent_id is not None:
+                parent_id = UUID(parent_id)
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError('Invalid item')
+        if not isinstance(name, str):
+            raise ValueError('Invalid name')
+
+        price = value.get('price')
+        if price is not None and (
+            isinstance(price, bool) or not isinstance(price, int)
+        ):
+            raise ValueError('Invalid price')
+        if (price is None) != (type_ == ShopUnitType.CATEGORY):
+            raise ValueError('Invalid price')
+
+        parent_type = None if parent_id is None else ShopUnitType.CATEGORY
+        return id_, type_, parent_id, parent_type, name, price
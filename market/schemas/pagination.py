@@ -0,0 +1,22 @@
+import base64
+from datetime import datetime
+from typing import Tuple
+from uuid import UUID
+
+
+# Ключ последней строки страницы: (date, id)
+PageCursor = Tuple[datetime, UUID]
+
+
+def encode_cursor(date_: datetime, id_: UUID) -> str:
+    value = f'{date_.isoformat()}|{id_}'.encode()
+    return base64.urlsafe_b64encode(value).decode().rstrip('=')
+
+
+def decode_cursor(value: str) -> PageCursor:
+    # Ошибки base64, кодировки и разбора - подклассы ValueError
+    padding = '=' * (-len(value) % 4)
+    date_, id_ = base64.urlsafe_b64decode(
+        (value + padding).encode('ascii')
+    ).decode().split('|')
+    return datetime.fromisoformat(date_), UUID(id_)
@@ -66,6 +66,14 @@ class ShopUnitSchema(ShopUnitStatisticSchema):
 ShopUnitSchema.update_forward_refs()
 
 
+class ShopUnitIdsSchema(BaseSchema):
+    ids: List[UUID]
+
+
+class ShopUnitsTreesSchema(BaseSchema):
+    items: List[ShopUnitSchema]
+
+
 class ShopUnitsListSchema(BaseSchema):
     items: List[ShopUnitStatisticSchema]
 
@@ -0,0 +1,55 @@
+from functools import partial
+import random
+from socket import socket
+from typing import List
+
+from uvicorn import Config, Server
+from uvicorn.subprocess import get_subprocess
+from uvicorn.supervisors import Multiprocess
+
+
+# Доля limit_max_requests, на которую случайно увеличивается лимит
+# каждого процесса, чтобы процессы не перезапускались одновременно
+MAX_REQUESTS_JITTER = 0.1
+
+
+def run_worker(config: Config, sockets: List[socket]) -> None:
+    if config.limit_max_requests:
+        config.limit_max_requests += random.randint(
+            0, int(config.limit_max_requests * MAX_REQUESTS_JITTER)
+        )
+    Server(config).run(sockets=sockets)
+
+
+class RecyclingMultiprocess(Multiprocess):
+    """
+    Запускает config.workers процессов на общем сокете и перезапускает
+    процессы, которые завершились, например, после обработки
+    limit_max_requests запросов.
+    """
+
+    def run(self) -> None:
+        self.startup()
+        while not self.should_exit.wait(0.5):
+            self.restart_exited()
+        self.shutdown()
+
+    def restart_exited(self) -> None:
+        for idx, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            process.join()
+            process = get_subprocess(
+                config=self.config, target=self.target, sockets=self.sockets
+            )
+            process.start()
+            self.processes[idx] = process
+
+
+def serve(config: Config) -> None:
+    """Запускает несколько процессов-обработчиков приложения."""
+    sock = config.bind_socket()
+    supervisor = RecyclingMultiprocess(
+        config, target=partial(run_worker, config), sockets=[sock]
+    )
+    supervisor.run()
@@ -1,21 +1,114 @@
+import asyncio
 from datetime import datetime, timedelta
 from http import HTTPStatus
-from typing import List, Optional
-from uuid import UUID
+import logging
+import random
+from typing import (
+    Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Collection,
+    Dict, Iterable, List, Optional, Set, Tuple, TypeVar, Union
+)
+from uuid import UUID, uuid4
 
+import asyncpg
 from fastapi import Depends, HTTPException
+import sqlalchemy as sa
 from sqlalchemy import orm, sql
 from sqlalchemy.dialects import postgresql
 import sqlalchemy.exc
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql.expression import (
+    ColumnElement, FromClause, Select, Subquery
+)
 
+from market.cache import (
+    INVALIDATION_CHANNEL, SALES_CACHE_TAG, ResponseCache,
+    get_response_cache, invalidate_shop_units, make_invalidation_messages
+)
+from market.config import settings
 from market.db import get_session
-from market.db.models import ShopUnit, ShopUnitImport, ShopUnitType
+from market.db.models import (
+    CategoryAggregate, ImportJob, ImportJobStatus, ShopUnit,
+    ShopUnitClosure, ShopUnitImport, ShopUnitType, UnitPriceHistory
+)
+from market.db.models.shop_unit import ShopUnitTypeEnum
+from market.queries import (
+    SALES, SHOP_UNIT_EXISTS, SHOP_UNIT_NODES, SHOP_UNIT_NODES_BATCH,
+    SHOP_UNIT_NODES_TO_DEPTH, SHOP_UNIT_STATISTIC, SHOP_UNIT_TREE_JSON,
+    SHOP_UNIT_TYPES,
+    CompiledQuery, ListQueries
+)
 from market.schemas import (
-    ShopUnitsListImportSchema, ShopUnitSchema,
-    ShopUnitsListSchema, ShopUnitImportSchema
+    ImportJobSchema,
+    ShopUnitsListImportSchema,
+    ShopUnitImportSchema,
+    ShopUnitsImportStream
+)
+from market.schemas.encoders import (
+    dump_shop_unit_tree, dump_shop_unit_trees,
+    stream_shop_units_list, stream_shop_units_page
+)
+from market.schemas.import_stream import ShopUnitRecord
+from market.schemas.pagination import PageCursor
+
+
+logger = logging.getLogger(__name__)
+
+# Временная таблица, в которую большие импорты загружаются через COPY
+shop_unit_staging = sa.Table(
+    'shop_unit_staging', sa.MetaData(),
+    sa.Column('id', postgresql.UUID(as_uuid=True), primary_key=True),
+    sa.Column('type', ShopUnitTypeEnum, nullable=False),
+    sa.Column('parent_id', postgresql.UUID(as_uuid=True)),
+    sa.Column('parent_type', ShopUnitTypeEnum),
+    sa.Column('name', sa.Text, nullable=False),
+    sa.Column('price', sa.Integer),
+    prefixes=['TEMPORARY'],
+    postgresql_on_commit='DROP'
 )
 
+# Ошибки, после которых транзакцию можно повторить:
+# serialization_failure и deadlock_detected
+RETRYABLE_SQLSTATES = frozenset(('40001', '40P01'))
+
+# Очередь /imports/async в каждый момент обрабатывает один процесс
+IMPORT_QUEUE_LOCK_KEY = 0x696d706f72745f71
+
+# Блокировка всех деревьев сразу: изменения, которые блокируют
+# отдельные деревья, берут ее в разделяемом режиме
+ALL_TREES_LOCK_KEY = 0x616c6c5f74726565
+
+# Колонки import_job без элементов выгрузки
+IMPORT_JOB_COLUMNS = (
+    ImportJob.id,
+    ImportJob.status,
+    ImportJob.update_date,
+    ImportJob.created_at,
+    ImportJob.finished_at,
+    ImportJob.error
+)
+
+T = TypeVar('T')
+
+
+class _TreeLockConflict(Exception):
+    """Нужное дерево заблокировано, а ждать его нельзя."""
+
+
+class ImportValidationError(HTTPException):
+    """
+    Выгрузка отклонена. Клиент получает сообщение из спецификации,
+    а причина пишется в журнал и в ошибку задачи /imports/async.
+    """
+
+    def __init__(self, detail: str, reason: str) -> None:
+        super().__init__(HTTPStatus.BAD_REQUEST, detail)
+        self.reason = reason
+
+
+def _get_lock_key(shop_unit_id: UUID) -> int:
+    # Ключ advisory-блокировки - первые 8 байт идентификатора
+    return int.from_bytes(shop_unit_id.bytes[:8], 'big', signed=True)
+
 
 class MarketService:
     VALIDATION_ERROR = HTTPException(
@@ -24,85 +117,845 @@ class MarketService:
     NOT_FOUND_ERROR = HTTPException(
         HTTPStatus.NOT_FOUND, 'Item not found'
     )
+    CONCURRENT_UPDATE_ERROR = HTTPException(
+        HTTPStatus.SERVICE_UNAVAILABLE, 'Concurrent update, try again'
+    )
 
     def __init__(
         self,
-        session: AsyncSession = Depends(get_session)
+        session: AsyncSession = Depends(get_session),
+        cache: ResponseCache = Depends(get_response_cache)
     ) -> None:
         self.session = session
+        self.cache = cache
+        # Корни деревьев, которые нужно заблокировать для импорта
+        # или удаления, и корни уже заблокированных в текущей попытке
+        self._required_roots: Set[UUID] = set()
+        self._locked_roots: Set[UUID] = set()
+        self._locked_all_trees = False
+
+    @classmethod
+    def _validation_error(cls, reason: str) -> ImportValidationError:
+        logger.info('Import rejected: %s', reason)
+        return ImportValidationError(cls.VALIDATION_ERROR.detail, reason)
 
     @classmethod
     def _solve_insertion_order(
         cls,
         items: List[ShopUnitImportSchema]
     ) -> List[ShopUnitImportSchema]:
-        to_order = {
-            item.id: item
-            for item in items
-        }
-        if len(to_order) != len(items):
-            raise cls.VALIDATION_ERROR
+        """
+        Упорядочивает выгрузку так, чтобы родитель из той же выгрузки
+        шел раньше детей. Каждый элемент просматривается один раз:
+        цепочка родителей поднимается до уже упорядоченного элемента
+        или до родителя вне выгрузки. Циклы, товары-родители и ссылки
+        на себя внутри выгрузки отклоняются до обращения к базе данных.
+        """
+        by_id = {item.id: item for item in items}
+        if len(by_id) != len(items):
+            raise cls._validation_error('duplicate ids')
         ordered = []
+        ordered_ids: Set[UUID] = set()
         for item in items:
-            if to_order.pop(item.id, None) is None:
-                continue
-            dependencies = [item]
-            parent_id = item.parent_id
-            while parent_id is not None:
-                parent = to_order.pop(parent_id, None)
-                if parent is None:
-                    break
-                dependencies.append(parent)
-                parent_id = parent.id
-            dependencies.reverse()
-            ordered.extend(dependencies)
+            chain = []
+            chain_ids: Set[UUID] = set()
+            while item is not None and item.id not in ordered_ids:
+                if item.id in chain_ids:
+                    raise cls._validation_error(
+                        f'parent cycle through {item.id}'
+                    )
+                if item.parent_id == item.id:
+                    raise cls._validation_error(
+                        f'{item.id} is its own parent'
+                    )
+                chain.append(item)
+                chain_ids.add(item.id)
+                parent = by_id.get(item.parent_id)
+                if parent is not None and parent.type != ShopUnitType.CATEGORY:
+                    raise cls._validation_error(
+                        f'parent of {item.id} is not a category'
+                    )
+                item = parent
+            chain.reverse()
+            ordered.extend(chain)
+            ordered_ids.update(chain_ids)
         return ordered
 
+    @classmethod
+    def _get_records(
+        cls,
+        payload: ShopUnitsListImportSchema
+    ) -> List[ShopUnitRecord]:
+        return [
+            (item.id, item.type, item.parent_id,
+             cls._get_parent_type(item), item.name, item.price)
+            for item in cls._solve_insertion_order(payload.items)
+        ]
+
+    async def _check_references(
+        self,
+        batches: List[List[ShopUnitRecord]]
+    ) -> List[Optional[HTTPException]]:
+        """
+        Проверяет выгрузки до записи одним запросом: родители, которых
+        нет в выгрузке, должны существовать и быть категориями,
+        а тип существующего узла не меняется. Выгрузки проверяются
+        по порядку: следующей доступны узлы предыдущих. Возвращает
+        ошибку каждой выгрузки или None.
+
+        Проверка только отклоняет заведомо некорректные выгрузки
+        без блокировок и записи. Узлы могут измениться до записи,
+        поэтому ограничения в базе данных по-прежнему проверяются.
+        """
+        ids: Set[UUID] = set()
+        for records in batches:
+            for id_, _, parent_id, _, _, _ in records:
+                ids.add(id_)
+                if parent_id is not None:
+                    ids.add(parent_id)
+        types: Dict[UUID, str] = {}
+        if ids:
+            types = dict(await self._fetch(
+                SHOP_UNIT_TYPES, {'shop_unit_ids': list(ids)}
+            ))
+
+        errors: List[Optional[HTTPException]] = []
+        for records in batches:
+            errors.append(self._check_batch_references(records, types))
+        return errors
+
+    @classmethod
+    def _check_batch_references(
+        cls,
+        records: List[ShopUnitRecord],
+        types: Dict[UUID, str]
+    ) -> Optional[HTTPException]:
+        batch_types = {id_: type_ for id_, type_, _, _, _, _ in records}
+        for id_, type_, parent_id, _, _, _ in records:
+            if types.get(id_, type_) != type_:
+                return cls._validation_error(f'type of {id_} cannot be changed')
+            if parent_id is None or parent_id in batch_types:
+                # Родителей из выгрузки проверяет _solve_insertion_order
+                continue
+            parent_type = types.get(parent_id)
+            if parent_type is None:
+                return cls._validation_error(
+                    f'parent {parent_id} of {id_} not found'
+                )
+            if parent_type != ShopUnitType.CATEGORY:
+                return cls._validation_error(
+                    f'parent of {id_} is not a category'
+                )
+        types.update(batch_types)
+        return None
+
+    @staticmethod
+    def _get_parent_type(
+        item: ShopUnitImportSchema
+    ) -> Optional[ShopUnitType]:
+        if item.parent_id is None:
+            return None
+        return ShopUnitType.CATEGORY
+
+    @staticmethod
+    def _select_items(records: List[ShopUnitRecord]) -> FromClause:
+        """
+        Импортируемые узлы в виде таблицы с теми же колонками,
+        что и у shop_unit_staging: каждая колонка передается
+        одним массивом, независимо от количества узлов.
+        """
+        columns = shop_unit_staging.columns
+        return sql.func.unnest(*(
+            sql.cast(list(values), postgresql.ARRAY(column.type))
+            for column, values in zip(columns, zip(*records))
+        )).table_valued(*(
+            sql.column(column.name, column.type) for column in columns
+        )).render_derived()
+
+    async def _copy_to_staging(
+        self,
+        records: Union[Iterable[ShopUnitRecord], AsyncIterable[ShopUnitRecord]]
+    ) -> FromClause:
+        connection = await self.session.connection()
+        await connection.run_sync(shop_unit_staging.create)
+        raw_connection = await connection.get_raw_connection()
+        await raw_connection.driver_connection.copy_records_to_table(
+            shop_unit_staging.name,
+            columns=[column.name for column in shop_unit_staging.columns],
+            records=records
+        )
+        return shop_unit_staging
+
+    async def _detach_subtrees(self, shop_unit_ids: Select) -> None:
+        # Удаляем связи поддеревьев с предками их корней,
+        # после чего каждый корень становится корнем отдельного фрагмента
+        subtree = orm.aliased(ShopUnitClosure)
+        q = sql.delete(ShopUnitClosure).where(
+            subtree.ancestor_id.in_(shop_unit_ids),
+            ShopUnitClosure.descendant_id == subtree.descendant_id,
+            ShopUnitClosure.depth > subtree.depth
+        ).execution_options(synchronize_session=False)
+        await self.session.execute(q)
+
+    async def _attach_subtrees(self, items: FromClause) -> None:
+        # Корни фрагментов - импортируемые узлы, у которых есть родитель,
+        # но нет связи с ним: новые и отсоединенные при перемещении
+        parent_link = orm.aliased(ShopUnitClosure)
+        fragments = sql.select(
+            ShopUnit.id,
+            ShopUnit.parent_id
+        ).join_from(
+            items,
+            ShopUnit,
+            ShopUnit.id == items.c.id
+        ).where(
+            ShopUnit.parent_id.is_not(None),
+            ~sql.exists().where(
+                parent_link.descendant_id == ShopUnit.id,
+                parent_link.depth == 1
+            )
+        ).cte('fragments')
+
+        # Предки корня фрагмента - это предки его нового родителя внутри
+        # родительского фрагмента. Если родительский фрагмент тоже
+        # перемещается, поднимаемся дальше через его корень, поэтому число
+        # итераций ограничено количеством фрагментов, а не глубиной.
+        parent_paths = orm.aliased(ShopUnitClosure)
+        ancestors = sql.select(
+            fragments.c.id.label('shop_unit_id'),
+            parent_paths.ancestor_id,
+            (parent_paths.depth + 1).label('depth'),
+            sql.literal(1).label('hops')
+        ).join_from(
+            fragments,
+            parent_paths,
+            parent_paths.descendant_id == fragments.c.parent_id
+        ).cte(recursive=True)
+        tmp = sql.select(
+            ancestors.c.shop_unit_id,
+            parent_paths.ancestor_id,
+            ancestors.c.depth + parent_paths.depth + 1,
+            ancestors.c.hops + 1
+        ).join_from(
+            ancestors,
+            fragments,
+            fragments.c.id == ancestors.c.ancestor_id
+        ).join(
+            parent_paths,
+            parent_paths.descendant_id == fragments.c.parent_id
+        ).where(
+            ancestors.c.hops < sql.select(
+                sql.func.count()
+            ).select_from(fragments).scalar_subquery()
+        )
+        ancestors = ancestors.union_all(tmp)
+
+        subtree = orm.aliased(ShopUnitClosure)
+        q = postgresql.insert(ShopUnitClosure).from_select(
+            ['ancestor_id', 'descendant_id', 'depth'],
+            sql.select(
+                ancestors.c.ancestor_id,
+                subtree.descendant_id,
+                ancestors.c.depth + subtree.depth
+            ).join_from(
+                ancestors,
+                subtree,
+                subtree.ancestor_id == ancestors.c.shop_unit_id
+            )
+        )
+        # Цикл в иерархии приводит к повторной вставке пары узлов
+        await self.session.execute(q)
+
     async def _update_shop_units(
         self,
-        payload: ShopUnitsListImportSchema
+        items: FromClause,
+        update_date: datetime
     ) -> None:
-        q = postgresql.insert(ShopUnit).values([
-            {**item.dict(include={'id', 'type', 'parent_id'}),
-             'parent_type': ShopUnitType.CATEGORY
-             if item.parent_id is not None else None}
-            for item in self._solve_insertion_order(payload.items)
-        ])
+        moved = sql.select(items.c.id).join_from(
+            items,
+            ShopUnit,
+            ShopUnit.id == items.c.id
+        ).where(
+            ShopUnit.parent_id.is_distinct_from(items.c.parent_id)
+        )
+        await self._detach_subtrees(moved)
+
+        q = postgresql.insert(ShopUnit).from_select(
+            [*shop_unit_staging.c.keys(), 'date'],
+            sql.select(items, sql.literal(update_date, sa.DateTime))
+        )
         q = q.on_conflict_do_update(
             index_elements=['id'],
             set_={'parent_id': q.excluded.parent_id,
-                  'parent_type': q.excluded.parent_type}
+                  'parent_type': q.excluded.parent_type,
+                  'name': q.excluded.name,
+                  'price': q.excluded.price,
+                  'date': q.excluded.date}
         )
         try:
             await self.session.execute(q)
+            q = postgresql.insert(ShopUnitClosure).from_select(
+                ['ancestor_id', 'descendant_id', 'depth'],
+                sql.select(items.c.id, items.c.id, sql.literal(0))
+            ).on_conflict_do_nothing()
+            await self.session.execute(q)
+            await self._attach_subtrees(items)
         except sqlalchemy.exc.IntegrityError:
             raise self.VALIDATION_ERROR
 
     async def _create_shop_unit_imports(
         self,
-        payload: ShopUnitsListImportSchema
+        items: FromClause,
+        update_date: datetime
     ) -> None:
-        q = postgresql.insert(ShopUnitImport).values([
-            {**item.dict(), 'date': payload.update_date}
-            for item in payload.items
-        ]).returning(ShopUnitImport.id)
+        # Закрываем предыдущие версии и добавляем новые одним запросом.
+        # Внешний ключ (id, expiration_date) проверяется в конце запроса,
+        # когда новые версии уже добавлены.
+        expired = sql.update(ShopUnitImport).values(
+            expiration_date=update_date
+        ).where(
+            ShopUnitImport.id.in_(sql.select(items.c.id)),
+            ShopUnitImport.expiration_date.is_(None),
+            ShopUnitImport.date < update_date
+        ).returning(ShopUnitImport.id).cte('expired')
+        q = postgresql.insert(ShopUnitImport).from_select(
+            ['id', 'type', 'parent_id', 'name', 'price', 'date'],
+            sql.select(
+                items.c.id,
+                items.c.type,
+                items.c.parent_id,
+                items.c.name,
+                items.c.price,
+                sql.literal(update_date, sa.DateTime)
+            )
+        ).add_cte(expired)
         try:
             await self.session.execute(q)
         except sqlalchemy.exc.IntegrityError:
             raise self.VALIDATION_ERROR
 
-        subq = sql.select(ShopUnitImport.id).where(
-            ShopUnitImport.date == payload.update_date
-        ).scalar_subquery()
-        q = sql.update(ShopUnitImport).values(
-            expiration_date=payload.update_date
+    @staticmethod
+    def _select_ancestors(
+        shop_unit_ids: Select,
+        stop_ids: Optional[Select] = None
+    ) -> Subquery:
+        """
+        Пары (узел, предок) для цепочек предков заданных узлов.
+        Если переданы stop_ids, подъем по цепочке прекращается
+        на первом предке из этого списка.
+        """
+        q = sql.select(
+            ShopUnitClosure.descendant_id.label('shop_unit_id'),
+            ShopUnitClosure.ancestor_id,
+            ShopUnitClosure.depth.label('level')
         ).where(
-            ShopUnitImport.date < payload.update_date,
-            ShopUnitImport.expiration_date.is_(None),
-            ShopUnitImport.id == sql.any_(subq)
+            ShopUnitClosure.descendant_id.in_(shop_unit_ids),
+            ShopUnitClosure.depth > 0
+        )
+        if stop_ids is None:
+            return q.subquery()
+
+        stop_level = sql.func.min(sql.case(
+            (ShopUnitClosure.ancestor_id.in_(stop_ids),
+             ShopUnitClosure.depth)
+        )).over(partition_by=ShopUnitClosure.descendant_id)
+        subq = q.add_columns(stop_level.label('stop_level')).subquery()
+        return sql.select(
+            subq.c.shop_unit_id,
+            subq.c.ancestor_id,
+            subq.c.level
+        ).where(
+            subq.c.level <= sql.func.coalesce(subq.c.stop_level, subq.c.level)
+        ).subquery()
+
+    @staticmethod
+    def _select_history_ancestors(shop_unit_ids: Select) -> Select:
+        """
+        Узлы, которые когда-либо были предками заданных узлов,
+        по истории импортов.
+        """
+        ancestors = sql.select(
+            ShopUnitImport.parent_id.label('id')
+        ).where(
+            ShopUnitImport.id.in_(shop_unit_ids),
+            ShopUnitImport.parent_id.isnot(None)
+        ).cte(recursive=True)
+        parents = sql.select(
+            ShopUnitImport.parent_id
+        ).join(
+            ancestors,
+            ancestors.c.id == ShopUnitImport.id
+        ).where(
+            ShopUnitImport.parent_id.isnot(None)
+        )
+        ancestors = ancestors.union(parents)
+        return sql.select(ancestors.c.id)
+
+    @staticmethod
+    def _select_contributions(
+        shop_unit_ids: Select,
+        with_dates: bool = False
+    ) -> Subquery:
+        """
+        Вклад узлов в агрегаты их предков: товар вносит свою цену,
+        категория - сумму цен и количество товаров своего поддерева.
+
+        Если with_dates, добавляется дата, которую узел вносит в дату
+        новых предков: у товара это его дата, у категории - последняя
+        дата товаров ее поддерева. Собственная дата категории на даты
+        предков не влияет.
+        """
+        columns = [
+            ShopUnit.id,
+            sql.case(
+                (ShopUnit.type == ShopUnitType.OFFER, ShopUnit.price),
+                else_=sql.func.coalesce(CategoryAggregate.sum_price, 0)
+            ).label('sum_price'),
+            sql.case(
+                (ShopUnit.type == ShopUnitType.OFFER, 1),
+                else_=sql.func.coalesce(CategoryAggregate.offer_count, 0)
+            ).label('offer_count')
+        ]
+        if with_dates:
+            offer = orm.aliased(ShopUnit)
+            offers_date = sql.select(
+                sql.func.max(offer.date)
+            ).join_from(
+                ShopUnitClosure,
+                offer,
+                offer.id == ShopUnitClosure.descendant_id
+            ).where(
+                ShopUnitClosure.ancestor_id == ShopUnit.id,
+                offer.type == ShopUnitType.OFFER
+            ).scalar_subquery()
+            columns.append(sql.case(
+                (ShopUnit.type == ShopUnitType.OFFER, ShopUnit.date),
+                else_=offers_date
+            ).label('date'))
+        return sql.select(*columns).join(
+            CategoryAggregate,
+            CategoryAggregate.id == ShopUnit.id,
+            isouter=True
+        ).where(
+            ShopUnit.id.in_(shop_unit_ids)
+        ).subquery()
+
+    async def _update_ancestors_aggregates(
+        self,
+        ancestors: Subquery,
+        contributions: Subquery,
+        sign: int,
+        update_date: Optional[datetime] = None
+    ) -> None:
+        columns = [
+            ancestors.c.ancestor_id.label('id'),
+            sql.func.coalesce(
+                sql.func.sum(contributions.c.sum_price), 0
+            ).label('sum_price'),
+            sql.func.coalesce(
+                sql.func.sum(contributions.c.offer_count), 0
+            ).label('offer_count')
+        ]
+        if 'date' in contributions.c:
+            columns.append(sql.func.max(contributions.c.date).label('date'))
+        deltas = sql.select(*columns).join_from(
+            ancestors,
+            contributions,
+            contributions.c.id == ancestors.c.shop_unit_id,
+            isouter=True
+        ).group_by(
+            ancestors.c.ancestor_id
+        ).subquery()
+        values = {
+            'sum_price': CategoryAggregate.sum_price
+            + sign * deltas.c.sum_price,
+            'offer_count': CategoryAggregate.offer_count
+            + sign * deltas.c.offer_count
+        }
+        if update_date is not None:
+            values['last_change_date'] = update_date
+        elif 'date' in deltas.c:
+            # greatest пропускает NULL: категория без товаров дату не меняет
+            values['last_change_date'] = sql.func.greatest(
+                CategoryAggregate.last_change_date, deltas.c.date
+            )
+        q = sql.update(CategoryAggregate).values(values).where(
+            CategoryAggregate.id == deltas.c.id
+        ).execution_options(synchronize_session=False)
+        await self.session.execute(q)
+
+    async def _detach_shop_units(
+        self,
+        items: FromClause,
+        update_date: datetime
+    ) -> None:
+        # Вычитаем узлы из агрегатов прежних предков. Подъем останавливается
+        # на первом импортируемом предке, так как выше по цепочке
+        # его поддерево будет вычтено целиком.
+        shop_unit_ids = sql.select(items.c.id)
+        await self._update_ancestors_aggregates(
+            self._select_ancestors(shop_unit_ids, stop_ids=shop_unit_ids),
+            self._select_contributions(shop_unit_ids),
+            -1,
+            update_date
+        )
+
+    async def _create_category_aggregates(
+        self,
+        items: FromClause,
+        update_date: datetime
+    ) -> None:
+        q = postgresql.insert(CategoryAggregate).from_select(
+            ['id', 'last_change_date'],
+            sql.select(
+                items.c.id,
+                sql.literal(update_date, sa.DateTime)
+            ).where(
+                items.c.type == ShopUnitType.CATEGORY
+            )
+        )
+        q = q.on_conflict_do_update(
+            index_elements=['id'],
+            set_={'last_change_date': q.excluded.last_change_date}
+        )
+        await self.session.execute(q)
+
+    async def _attach_shop_units(
+        self,
+        items: FromClause,
+        update_date: datetime
+    ) -> None:
+        # После отсоединения агрегат категории учитывает только
+        # неимпортируемые узлы ее поддерева, поэтому каждый импортируемый
+        # узел прибавляется ко всей новой цепочке предков. Дату новых
+        # предков меняют только товары: импорт с прежним родителем уже
+        # обновил ее при отсоединении.
+        shop_unit_ids = sql.select(items.c.id)
+        await self._update_ancestors_aggregates(
+            self._select_ancestors(shop_unit_ids),
+            self._select_contributions(shop_unit_ids, with_dates=True),
+            1
+        )
+
+    @staticmethod
+    def _select_affected_ids(
+        items: FromClause,
+        update_date: datetime
+    ) -> Select:
+        """
+        Импортируемые узлы, их прежние и новые предки - узлы, цену
+        и ответы для которых меняет импорт. Запрос выполняется после
+        импорта: прежние предки узла, которые не поменялись, остаются
+        предками его прежнего родителя.
+        """
+        previous_parent_ids = sql.select(ShopUnitImport.parent_id).where(
+            ShopUnitImport.id.in_(sql.select(items.c.id)),
+            ShopUnitImport.expiration_date == update_date
+        )
+        return sql.select(ShopUnitClosure.ancestor_id).where(
+            ShopUnitClosure.descendant_id.in_(
+                sql.union(sql.select(items.c.id), previous_parent_ids)
+            )
+        ).distinct()
+
+    async def _get_affected_ids(
+        self,
+        items: FromClause,
+        update_date: datetime
+    ) -> Optional[Set[UUID]]:
+        """
+        Узлы, ответы для которых меняет импорт. None, если их слишком
+        много, чтобы сбрасывать кэш выборочно.
+        """
+        if not self.cache.enabled:
+            return None
+        limit = settings.response_cache_invalidation_limit
+        q = self._select_affected_ids(items, update_date).limit(limit + 1)
+        shop_unit_ids = set((await self.session.scalars(q)).all())
+        if len(shop_unit_ids) > limit:
+            return None
+        return shop_unit_ids
+
+    async def _rebuild_price_history(
+        self,
+        shop_unit_ids: ColumnElement
+    ) -> None:
+        # Пересчитывает историю цен узлов из массива shop_unit_ids
+        q = sql.select(sql.func.unit_price_history_rebuild(shop_unit_ids))
+        await self.session.execute(q)
+
+    async def _update_price_history(
+        self,
+        items: FromClause,
+        update_date: datetime
+    ) -> bool:
+        """
+        Дописывает историю цен затронутых импортом узлов: текущий период
+        закрывается, а с даты импорта начинается новый. Возвращает True,
+        если история была пересчитана заново.
+        """
+        affected_ids = self._select_affected_ids(items, update_date)
+
+        # Импорт задним числом меняет уже записанную историю всех узлов,
+        # которые когда-либо были предками импортируемых, поэтому она
+        # пересчитывается целиком
+        q = sql.select(sql.exists().where(
+            UnitPriceHistory.id.in_(affected_ids),
+            UnitPriceHistory.valid_to.is_(None),
+            UnitPriceHistory.valid_from > update_date
+        ))
+        if await self.session.scalar(q):
+            shop_unit_ids = sql.union(
+                sql.select(items.c.id),
+                self._select_history_ancestors(sql.select(items.c.id))
+            )
+            # Бывшие предки могут находиться в других деревьях
+            await self._lock_trees(shop_unit_ids)
+            shop_unit_ids = shop_unit_ids.subquery()
+            await self._rebuild_price_history(sql.select(
+                sql.func.array_agg(shop_unit_ids.c.id)
+            ).scalar_subquery())
+            return True
+
+        q = sql.update(UnitPriceHistory).values(
+            valid_to=update_date
+        ).where(
+            UnitPriceHistory.id.in_(affected_ids),
+            UnitPriceHistory.valid_to.is_(None),
+            UnitPriceHistory.valid_from < update_date
         ).execution_options(synchronize_session=False)
         await self.session.execute(q)
 
+        # Узлы с той же датой могли быть импортированы раньше,
+        # тогда цена с этой даты уточняется
+        q = postgresql.insert(UnitPriceHistory).from_select(
+            ['id', 'valid_from', 'price'],
+            sql.select(
+                ShopUnit.id,
+                sql.literal(update_date, sa.DateTime),
+                sql.func.coalesce(CategoryAggregate.price, ShopUnit.price)
+            ).join(
+                CategoryAggregate,
+                CategoryAggregate.id == ShopUnit.id,
+                isouter=True
+            ).where(
+                ShopUnit.id.in_(affected_ids)
+            )
+        )
+        q = q.on_conflict_do_update(
+            index_elements=['id', 'valid_from'],
+            set_={'price': q.excluded.price}
+        )
+        await self.session.execute(q)
+        return False
+
+    @staticmethod
+    def _select_tree_roots(shop_unit_ids: Select) -> Select:
+        """
+        Корни деревьев, в которых находятся узлы. Узлы, которых еще
+        нет, считаются корнями собственных деревьев.
+        """
+        shop_unit_ids = shop_unit_ids.subquery()
+        shop_unit_id, = shop_unit_ids.c
+        existing_roots = sql.select(
+            ShopUnitClosure.ancestor_id
+        ).join(
+            ShopUnit,
+            ShopUnit.id == ShopUnitClosure.ancestor_id
+        ).where(
+            ShopUnitClosure.descendant_id.in_(sql.select(shop_unit_id)),
+            ShopUnit.parent_id.is_(None)
+        )
+        new_ids = sql.select(shop_unit_id).where(
+            shop_unit_id.is_not(None),
+            ~sql.exists().where(ShopUnit.id == shop_unit_id)
+        )
+        return sql.union(existing_roots, new_ids)
+
+    async def _lock_trees(self, shop_unit_ids: Select) -> None:
+        """
+        Блокирует до конца транзакции деревья, в которых находятся узлы.
+        Пока блокировка ожидалась, дерево могло стать частью другого,
+        поэтому корни проверяются заново, пока не окажутся заблокированы.
+        """
+        while True:
+            roots = set((await self.session.scalars(
+                self._select_tree_roots(shop_unit_ids)
+            )).all())
+            if roots <= self._locked_roots:
+                return
+            await self._lock_roots(roots)
+
+    async def _lock_roots(self, roots: Collection[UUID]) -> None:
+        """
+        Ждать блокировку можно, только пока других блокировок нет,
+        тогда они берутся по возрастанию ключа и взаимоблокировки
+        не возникают. Иначе блокировка берется без ожидания, а если
+        дерево занято, попытка начинается заново со всеми нужными
+        деревьями сразу.
+
+        Каждая advisory-блокировка занимает место в общей таблице
+        блокировок PostgreSQL, поэтому больше
+        tree_lock_escalation_threshold деревьев блокируются одной
+        исключительной блокировкой всех деревьев.
+        """
+        self._required_roots.update(roots)
+        if self._locked_all_trees:
+            self._locked_roots.update(roots)
+            return
+
+        can_wait = not self._locked_roots
+        if len(self._locked_roots | set(roots)) > \
+                settings.tree_lock_escalation_threshold:
+            key = sql.literal(ALL_TREES_LOCK_KEY, sa.BigInteger)
+            if can_wait:
+                await self.session.execute(
+                    sql.select(sql.func.pg_advisory_xact_lock(key))
+                )
+            elif not await self.session.scalar(
+                sql.select(sql.func.pg_try_advisory_xact_lock(key))
+            ):
+                raise _TreeLockConflict
+            self._locked_all_trees = True
+            self._locked_roots.update(roots)
+            return
+
+        keys = sql.func.unnest(sql.cast(
+            sorted({
+                _get_lock_key(root) for root in roots
+                if root not in self._locked_roots
+            }),
+            postgresql.ARRAY(sa.BigInteger)
+        ))
+        if can_wait:
+            # Разделяемая блокировка берется раньше блокировок деревьев,
+            # иначе ожидание исключительной приводит к взаимоблокировке
+            await self.session.execute(sql.select(
+                sql.func.pg_advisory_xact_lock_shared(
+                    sql.literal(ALL_TREES_LOCK_KEY, sa.BigInteger)
+                )
+            ))
+            await self.session.execute(
+                sql.select(sql.func.pg_advisory_xact_lock(keys))
+            )
+        elif not all((await self.session.scalars(
+            sql.select(sql.func.pg_try_advisory_xact_lock(keys))
+        )).all()):
+            raise _TreeLockConflict
+        self._locked_roots.update(roots)
+
+    async def _run_with_retry(
+        self,
+        operation: Callable[[], Awaitable[T]],
+        attempts: Optional[int] = None
+    ) -> T:
+        """
+        Выполняет operation в точке сохранения и повторяет ее, если
+        нужное дерево занято, после взаимоблокировки или ошибки
+        сериализации. Откат к точке сохранения снимает взятые в ней
+        блокировки.
+        """
+        if attempts is None:
+            attempts = settings.import_retry_attempts
+        # Блокировки, взятые до точки сохранения, откат не снимает
+        locked_roots = self._locked_roots
+        locked_all_trees = self._locked_all_trees
+        for attempt in range(1, attempts + 1):
+            self._locked_roots = set(locked_roots)
+            self._locked_all_trees = locked_all_trees
+            try:
+                async with self.session.begin_nested():
+                    # Деревья, которые понадобились предыдущей попытке,
+                    # блокируются сразу
+                    if self._required_roots:
+                        await self._lock_roots(self._required_roots)
+                    return await operation()
+            except _TreeLockConflict:
+                pass
+            except sqlalchemy.exc.DBAPIError as e:
+                if getattr(e.orig, 'pgcode', None) not in RETRYABLE_SQLSTATES:
+                    self._locked_roots = locked_roots
+                    self._locked_all_trees = locked_all_trees
+                    raise
+            except Exception:
+                self._locked_roots = locked_roots
+                self._locked_all_trees = locked_all_trees
+                raise
+            if attempt == attempts:
+                self._locked_roots = locked_roots
+                self._locked_all_trees = locked_all_trees
+                raise self.CONCURRENT_UPDATE_ERROR
+            await asyncio.sleep(random.uniform(
+                0, settings.import_retry_delay * 2 ** (attempt - 1)
+            ))
+
+    async def _import_items(
+        self,
+        items: FromClause,
+        update_date: datetime
+    ) -> Optional[Set[UUID]]:
+        # Импорты в разные деревья выполняются параллельно, а в одно -
+        # по очереди. Деревья всех узлов, которые читает и меняет импорт,
+        # содержат импортируемые узлы или их новых родителей.
+        await self._lock_trees(sql.union(
+            sql.select(items.c.id), sql.select(items.c.parent_id)
+        ))
+        await self._detach_shop_units(items, update_date)
+        await self._update_shop_units(items, update_date)
+        await self._create_shop_unit_imports(items, update_date)
+        await self._create_category_aggregates(items, update_date)
+        await self._attach_shop_units(items, update_date)
+        if await self._update_price_history(items, update_date):
+            # Статистика бывших предков изменилась в прошлом,
+            # поэтому кэш сбрасывается целиком
+            return None
+        return await self._get_affected_ids(items, update_date)
+
+    async def _notify_cache_invalidation(
+        self,
+        shop_unit_ids: Optional[Collection[UUID]],
+        update_date: Optional[datetime] = None
+    ) -> None:
+        # Уведомления доставляются другим процессам только после фиксации
+        # транзакции, поэтому вызываются внутри нее
+        if not self.cache.enabled:
+            return
+        messages = make_invalidation_messages(shop_unit_ids, update_date)
+        payloads = sql.cast(messages, postgresql.ARRAY(sa.Text))
+        q = sql.select(
+            sql.func.pg_notify(INVALIDATION_CHANNEL, sql.func.unnest(payloads))
+        )
+        await self.session.execute(q)
+
+    def _invalidate_cache(
+        self,
+        shop_unit_ids: Optional[Iterable[UUID]],
+        update_date: Optional[datetime] = None
+    ) -> None:
+        # Вызывается после фиксации транзакции, иначе кэш может заново
+        # заполниться данными, которые еще не изменились
+        invalidate_shop_units(self.cache, shop_unit_ids, update_date)
+
+    async def _import_records(
+        self,
+        records: List[ShopUnitRecord],
+        update_date: datetime,
+        is_first: bool
+    ) -> Optional[Set[UUID]]:
+        # Большой импорт всегда идет первым в транзакции,
+        # поэтому staging создается не больше одного раза
+        if is_first and len(records) >= settings.import_copy_threshold:
+            items = await self._copy_to_staging(records)
+        else:
+            items = self._select_items(records)
+        # Следующие импорты не ждут блокировок деревьев, так как
+        # уже держат блокировки предыдущих: занятое дерево
+        # откладывает их до следующей транзакции
+        return await self._run_with_retry(
+            lambda: self._import_items(items, update_date),
+            attempts=None if is_first else 1
+        )
+
     async def import_shop_units(
         self,
         payload: ShopUnitsListImportSchema
@@ -110,301 +963,561 @@ class MarketService:
         if not payload.items:
             return
 
+        records = self._get_records(payload)
+        # Некорректная выгрузка отклоняется до транзакции с записью,
+        # не дожидаясь блокировок деревьев
         async with self.session.begin():
-            await self.session.connection(execution_options={
-                'isolation_level': 'SERIALIZABLE'
-            })
-            await self._update_shop_units(payload)
-            await self._create_shop_unit_imports(payload)
+            error, = await self._check_references([records])
+        if error is not None:
+            raise error
+        async with self.session.begin():
+            affected_ids = await self._import_records(
+                records, payload.update_date, True
+            )
+            await self._notify_cache_invalidation(
+                affected_ids, payload.update_date
+            )
+        self._invalidate_cache(affected_ids, payload.update_date)
+
+    async def import_shop_units_group(
+        self,
+        payloads: List[ShopUnitsListImportSchema]
+    ) -> List[Optional[Exception]]:
+        """
+        Применяет несколько импортов по возрастанию даты обновления
+        одной транзакцией, каждый - в своей точке сохранения.
+        Возвращает ошибку каждого импорта или None, если он применен:
+        ошибка одного импорта не мешает остальным.
+        """
+        results: List[Optional[Exception]] = [None] * len(payloads)
+        records: Dict[int, List[ShopUnitRecord]] = {}
+        for index, payload in enumerate(payloads):
+            if not payload.items:
+                continue
+            try:
+                records[index] = self._get_records(payload)
+            except HTTPException as e:
+                results[index] = e
+        pending = sorted(
+            records, key=lambda index: payloads[index].update_date
+        )
+        if pending:
+            # Отдельная транзакция: до блокировок и записи
+            async with self.session.begin():
+                errors = await self._check_references(
+                    [records[index] for index in pending]
+                )
+            for index, error in zip(pending, errors):
+                results[index] = error
+            pending = [
+                index for index, error in zip(pending, errors)
+                if error is None
+            ]
+
+        while pending:
+            applied: List[Tuple[Optional[Set[UUID]], datetime]] = []
+            deferred: List[int] = []
+            self._required_roots = set()
+            self._locked_roots = set()
+            self._locked_all_trees = False
+            async with self.session.begin():
+                for position, index in enumerate(pending):
+                    payload = payloads[index]
+                    try:
+                        affected_ids = await self._import_records(
+                            records[index], payload.update_date, position == 0
+                        )
+                    except HTTPException as e:
+                        if position and e.status_code != HTTPStatus.BAD_REQUEST:
+                            # Остальные импорты применяются следующей
+                            # транзакцией, чтобы не нарушить порядок дат
+                            deferred = pending[position:]
+                            break
+                        results[index] = e
+                    except sqlalchemy.exc.DBAPIError as e:
+                        results[index] = e
+                    else:
+                        await self._notify_cache_invalidation(
+                            affected_ids, payload.update_date
+                        )
+                        applied.append((affected_ids, payload.update_date))
+            for affected_ids, update_date in applied:
+                self._invalidate_cache(affected_ids, update_date)
+            pending = deferred
+        return results
+
+    async def import_shop_units_stream(
+        self,
+        stream: ShopUnitsImportStream
+    ) -> None:
+        async with self.session.begin():
+            # Элементы загружаются в staging по мере разбора тела запроса.
+            # При повторе импорта они читаются из staging, а не из запроса
+            try:
+                items = await self._copy_to_staging(stream)
+            except (ValueError, asyncpg.IntegrityConstraintViolationError):
+                raise self.VALIDATION_ERROR
+            if not stream.count:
+                return
+            affected_ids = await self._run_with_retry(
+                lambda: self._import_items(items, stream.update_date)
+            )
+            await self._notify_cache_invalidation(
+                affected_ids, stream.update_date
+            )
+        self._invalidate_cache(affected_ids, stream.update_date)
+
+    @staticmethod
+    def _dump_records(records: List[ShopUnitRecord]) -> List[List[Any]]:
+        return [
+            [str(id_), type_, parent_id and str(parent_id),
+             parent_type, name, price]
+            for id_, type_, parent_id, parent_type, name, price in records
+        ]
+
+    @staticmethod
+    def _load_records(values: List[List[Any]]) -> List[ShopUnitRecord]:
+        return [
+            (UUID(id_), ShopUnitType(type_), parent_id and UUID(parent_id),
+             parent_type and ShopUnitType(parent_type), name, price)
+            for id_, type_, parent_id, parent_type, name, price in values
+        ]
+
+    async def create_import_job(
+        self,
+        payload: ShopUnitsListImportSchema
+    ) -> ImportJobSchema:
+        # Выгрузка проверяется сразу, а ошибки, для которых нужны
+        # данные в базе, попадают в статус задачи
+        records = self._get_records(payload)
+        q = sql.insert(ImportJob).values(
+            id=uuid4(),
+            update_date=payload.update_date,
+            items=self._dump_records(records),
+            item_count=len(records)
+        ).returning(*IMPORT_JOB_COLUMNS)
+        async with self.session.begin():
+            job = (await self.session.execute(q)).one()
+        return ImportJobSchema.from_orm(job)
+
+    async def get_import_job(self, job_id: UUID) -> ImportJobSchema:
+        q = sql.select(*IMPORT_JOB_COLUMNS).where(ImportJob.id == job_id)
+        async with self.session.begin():
+            job = (await self.session.execute(q)).one_or_none()
+        if job is None:
+            raise self.NOT_FOUND_ERROR
+        return ImportJobSchema.from_orm(job)
+
+    async def _select_import_jobs(self) -> List[Any]:
+        """
+        Очередные ожидающие выгрузки: первая и следующие за ней,
+        пока суммарно в них не больше import_queue_batch_size элементов.
+        """
+        batch_size = settings.import_queue_batch_size
+        q = sql.select(
+            ImportJob.id,
+            ImportJob.item_count
+        ).where(
+            ImportJob.status == ImportJobStatus.PENDING
+        ).order_by(
+            ImportJob.update_date, ImportJob.created_at, ImportJob.id
+        ).limit(batch_size)
+        job_ids = []
+        total = 0
+        for job_id, item_count in (await self.session.execute(q)).all():
+            total += item_count
+            if job_ids and total > batch_size:
+                break
+            job_ids.append(job_id)
+
+        q = sql.select(
+            ImportJob.id,
+            ImportJob.update_date,
+            ImportJob.items
+        ).where(
+            ImportJob.id.in_(job_ids)
+        ).order_by(
+            ImportJob.update_date, ImportJob.created_at, ImportJob.id
+        )
+        return (await self.session.execute(q)).all()
+
+    async def _finish_import_job(
+        self,
+        job_id: UUID,
+        status: ImportJobStatus,
+        error: Optional[str] = None
+    ) -> None:
+        q = sql.update(ImportJob).values(
+            status=status,
+            error=error,
+            finished_at=sql.func.timezone('UTC', sql.func.now())
+        ).where(
+            ImportJob.id == job_id
+        ).execution_options(synchronize_session=False)
+        await self.session.execute(q)
+
+    async def apply_import_jobs(self) -> int:
+        """
+        Применяет очередные выгрузки из очереди одной транзакцией,
+        каждую - как отдельный импорт. Возвращает количество обработанных
+        выгрузок: 0, если очередь пуста или ее обрабатывает другой процесс.
+        """
+        applied: List[Tuple[Optional[Set[UUID]], datetime]] = []
+        processed = 0
+        async with self.session.begin():
+            q = sql.select(
+                sql.func.pg_try_advisory_xact_lock(
+                    sql.literal(IMPORT_QUEUE_LOCK_KEY, sa.BigInteger)
+                )
+            )
+            if not await self.session.scalar(q):
+                return 0
+
+            jobs = await self._select_import_jobs()
+            batches = [self._load_records(job.items) for job in jobs]
+            errors = await self._check_references(batches)
+            for index, (job, records, error) in enumerate(
+                zip(jobs, batches, errors)
+            ):
+                affected_ids: Optional[Set[UUID]] = set()
+                try:
+                    if error is not None:
+                        raise error
+                    if records:
+                        affected_ids = await self._import_records(
+                            records, job.update_date, index == 0
+                        )
+                except HTTPException as e:
+                    if e.status_code != HTTPStatus.BAD_REQUEST:
+                        # Выгрузки применяются по порядку, поэтому
+                        # остальные ждут следующей транзакции
+                        break
+                    message = e.detail
+                    if isinstance(e, ImportValidationError):
+                        message = f'{message}: {e.reason}'
+                    await self._finish_import_job(
+                        job.id, ImportJobStatus.FAILED, message
+                    )
+                except sqlalchemy.exc.DBAPIError:
+                    # Иначе выгрузка, которую нельзя применить,
+                    # навсегда останавливает очередь
+                    logger.exception('Failed to apply import job %s', job.id)
+                    await self._finish_import_job(
+                        job.id, ImportJobStatus.FAILED, 'Internal error'
+                    )
+                else:
+                    await self._notify_cache_invalidation(
+                        affected_ids, job.update_date
+                    )
+                    await self._finish_import_job(
+                        job.id, ImportJobStatus.DONE
+                    )
+                    applied.append((affected_ids, job.update_date))
+                processed += 1
+        for affected_ids, update_date in applied:
+            self._invalidate_cache(affected_ids, update_date)
+        return processed
 
     async def _check_is_shop_unit_exists(self, shop_unit_id: UUID) -> None:
-        subq = sql.exists(ShopUnit.id).where(ShopUnit.id == shop_unit_id)
-        q = sql.select(subq)
-        if not await self.session.scalar(q):
+        exists = await self.session.scalar(
+            SHOP_UNIT_EXISTS, {'shop_unit_id': shop_unit_id}
+        )
+        if not exists:
             raise self.NOT_FOUND_ERROR
 
+    async def _refresh_category_date(self, category_id: UUID) -> None:
+        # Дата категории - это максимум из даты ее собственного импорта,
+        # дат текущих дочерних узлов и дат, когда дочерние узлы
+        # перестали быть актуальными
+        child_aggregate = orm.aliased(CategoryAggregate)
+        own_date = sql.select(ShopUnit.date).where(
+            ShopUnit.id == category_id
+        ).scalar_subquery()
+        children_date = sql.select(
+            sql.func.max(sql.func.coalesce(
+                child_aggregate.last_change_date, ShopUnit.date
+            ))
+        ).join_from(
+            ShopUnit,
+            child_aggregate,
+            child_aggregate.id == ShopUnit.id,
+            isouter=True
+        ).where(
+            ShopUnit.parent_id == category_id
+        ).scalar_subquery()
+        removed_children_date = sql.select(
+            sql.func.max(ShopUnitImport.expiration_date)
+        ).where(
+            ShopUnitImport.parent_id == category_id
+        ).scalar_subquery()
+        q = sql.update(CategoryAggregate).values(
+            last_change_date=sql.func.greatest(
+                own_date, children_date, removed_children_date
+            )
+        ).where(
+            CategoryAggregate.id == category_id
+        ).execution_options(synchronize_session=False)
+        await self.session.execute(q)
+
     async def delete_shop_unit(self, shop_unit_id: UUID) -> None:
         async with self.session.begin():
-            await self._check_is_shop_unit_exists(shop_unit_id)
-
-            q = sql.delete(ShopUnit).where(
-                ShopUnit.id == shop_unit_id
+            affected_ids = await self._run_with_retry(
+                lambda: self._delete_shop_unit(shop_unit_id)
             )
-            await self.session.execute(q)
+            await self._notify_cache_invalidation(affected_ids)
+        self._invalidate_cache(affected_ids)
+
+    async def _delete_shop_unit(
+        self,
+        shop_unit_id: UUID
+    ) -> Optional[List[UUID]]:
+        await self._lock_trees(sql.select(
+            sql.literal(shop_unit_id, postgresql.UUID(as_uuid=True))
+        ))
+        await self._check_is_shop_unit_exists(shop_unit_id)
+
+        shop_unit_ids = sql.select(ShopUnit.id).where(
+            ShopUnit.id == shop_unit_id
+        )
+        ancestors = self._select_ancestors(shop_unit_ids)
+        q = sql.select(ancestors.c.ancestor_id).order_by(
+            ancestors.c.level
+        )
+        ancestors_ids = (await self.session.scalars(q)).all()
+        await self._update_ancestors_aggregates(
+            ancestors, self._select_contributions(shop_unit_ids), -1
+        )
+
+        subtree = sql.select(ShopUnitClosure.descendant_id).where(
+            ShopUnitClosure.ancestor_id == shop_unit_id
+        )
+        # История цен пересчитывается так, будто удаленных узлов
+        # никогда не было, поэтому меняется она у всех их бывших предков
+        history_ancestors = self._select_history_ancestors(
+            subtree
+        ).subquery()
+        q = sql.select(history_ancestors.c.id).where(
+            history_ancestors.c.id.not_in(subtree)
+        )
+        # Бывшие предки могут находиться в других деревьях
+        await self._lock_trees(q)
+        history_ancestors_ids = (await self.session.scalars(q)).all()
+
+        q = sql.delete(ShopUnit).where(
+            ShopUnit.id.in_(subtree)
+        ).returning(
+            ShopUnit.id
+        ).execution_options(synchronize_session=False)
+        deleted_ids = (await self.session.scalars(q)).all()
 
-    async def get_shop_unit_nodes(self, shop_unit_id: UUID) -> ShopUnitSchema:
+        # Пересчитываем даты снизу вверх, так как дата категории
+        # зависит от дат ее дочерних категорий
+        for ancestor_id in ancestors_ids:
+            await self._refresh_category_date(ancestor_id)
+
+        await self._rebuild_price_history(sql.cast(
+            history_ancestors_ids,
+            postgresql.ARRAY(postgresql.UUID(as_uuid=True))
+        ))
+
+        affected_ids = [*history_ancestors_ids, *deleted_ids]
+        if len(affected_ids) > settings.response_cache_invalidation_limit:
+            return None
+        return affected_ids
+
+    async def _fetch(
+        self,
+        query: CompiledQuery,
+        params: Dict[str, Any]
+    ) -> List[asyncpg.Record]:
+        # Запрос выполняется на том же соединении, что и сессия. Если
+        # сессия еще ничего не выполняла, asyncpg выполнит его вне
+        # транзакции, что для одного запроса не меняет результат
+        connection = await self.session.connection()
+        raw_connection = await connection.get_raw_connection()
+        return await query.fetch(raw_connection.driver_connection, params)
+
+    async def get_shop_unit_nodes(
+        self,
+        shop_unit_id: UUID,
+        depth: Optional[int] = None
+    ) -> bytes:
+        return await self.cache.get_or_load(
+            ('nodes', shop_unit_id, depth),
+            lambda: self._get_shop_unit_nodes(shop_unit_id, depth),
+            tags=[shop_unit_id]
+        )
+
+    async def _get_shop_unit_nodes(
+        self,
+        shop_unit_id: UUID,
+        depth: Optional[int]
+    ) -> bytes:
         async with self.session.begin():
             await self._check_is_shop_unit_exists(shop_unit_id)
 
-            nodes_history = sql.select(
-                ShopUnitImport,
-                sql.literal(1).label('level')
-            ).where(
-                ShopUnitImport.id == shop_unit_id,
-                ShopUnitImport.expiration_date.is_(None)
-            ).cte(recursive=True)
-            parent = orm.aliased(ShopUnitImport, nodes_history)
-            tmp = sql.select(
-                ShopUnitImport,
-                (nodes_history.c.level + 1).label('level')
-            ).join(
-                nodes_history,
-                sql.and_(
-                    ShopUnitImport.parent_id == parent.id,
-                    parent.actuality_period
-                    .op('&&')(ShopUnitImport.actuality_period)
+            if depth is not None:
+                rows = await self._fetch(
+                    SHOP_UNIT_NODES_TO_DEPTH,
+                    {'shop_unit_id': shop_unit_id, 'max_depth': depth}
                 )
-            )
-            nodes_history = nodes_history.union_all(tmp)
-            node_import = orm.aliased(ShopUnitImport, nodes_history)
+                if not rows:
+                    raise self.NOT_FOUND_ERROR
+                return dump_shop_unit_tree(rows, depth)
 
-            expiration_dates = sql.select(
-                node_import.id,
-                node_import.parent_id,
-                node_import.expiration_date
-            ).where(
-                node_import.expiration_date.is_not(None)
-            ).cte(recursive=True)
-            tmp = sql.select(
-                node_import.id,
-                node_import.parent_id,
-                sql.func.greatest(
-                    node_import.expiration_date,
-                    expiration_dates.c.expiration_date
-                ).label('expiration_date')
-            ).join(
-                expiration_dates,
-                sql.and_(
-                    expiration_dates.c.parent_id == node_import.id,
-                    node_import.actuality_period.op('@>')(expiration_dates.c.expiration_date)
+            if settings.nodes_tree_in_db:
+                # Ответ собран функцией shop_unit_tree
+                # и передается клиенту без разбора
+                content = await self.session.scalar(
+                    SHOP_UNIT_TREE_JSON, {'shop_unit_id': shop_unit_id}
                 )
-            )
-            expiration_dates = expiration_dates.union_all(tmp)
-
-            expiration_dates = sql.select(
-                expiration_dates.c.id,
-                sql.func.max(
-                    expiration_dates.c.expiration_date
-                ).label('expiration_date')
-            ).group_by(
-                expiration_dates.c.id
-            ).subquery()
-
-            prices = sql.select(
-                node_import.id,
-                node_import.parent_id,
-                node_import.date,
-                node_import.price
-            ).where(
-                node_import.type == ShopUnitType.OFFER,
-                node_import.expiration_date.is_(None)
-            ).cte(recursive=True)
-            tmp = sql.select(
-                node_import.id,
-                node_import.parent_id,
-                prices.c.date,
-                prices.c.price
-            ).join(
-                prices,
-                node_import.id == prices.c.parent_id
-            ).where(
-                node_import.expiration_date.is_(None)
-            )
-            prices = prices.union_all(tmp)
-            prices = sql.select(
-                prices.c.id.label('shop_unit_id'),
-                sql.func.max(prices.c.date).label('date'),
-                sql.func.avg(prices.c.price).label('price')
-            ).group_by(
-                prices.c.id
-            ).subquery()
-
-            subq = sql.select(
-                node_import.id,
-                node_import.type,
-                sql.func.greatest(
-                    node_import.date, prices.c.date, 
-                    expiration_dates.c.expiration_date
-                ).label('date'),
-                node_import.parent_id,
-                node_import.name,
-                prices.c.price,
-                nodes_history.c.level
-            ).join(
-                prices,
-                node_import.id == prices.c.shop_unit_id,
-                isouter=True
-            ).join(
-                expiration_dates,
-                node_import.id == expiration_dates.c.id,
-                isouter=True
-            ).where(
-                node_import.expiration_date.is_(None)
-            ).subquery()
-            node = orm.aliased(ShopUnitImport, subq, adapt_on_names=True)
-            q = sql.select(node).order_by(
-                subq.c.level, node.parent_id, node.id
-            )
+                if content is None:
+                    raise self.NOT_FOUND_ERROR
+                return content.encode()
 
-            result = await self.session.scalars(q)
-            records = result.all()
-            if not records:
+            rows = await self._fetch(
+                SHOP_UNIT_NODES, {'shop_unit_id': shop_unit_id}
+            )
+            if not rows:
                 raise self.NOT_FOUND_ERROR
-            return ShopUnitSchema.from_nodes(map(
-                ShopUnitSchema.from_orm, records
-            ))
+            # Ответ собирается из строк напрямую, минуя pydantic-модели
+            return dump_shop_unit_tree(rows)
 
-    async def get_sales(self, date_: datetime) -> ShopUnitsListSchema:
+    async def get_shop_unit_nodes_batch(
+        self,
+        shop_unit_ids: Iterable[UUID]
+    ) -> bytes:
+        # Повторы не меняют ответ, порядок первых вхождений сохраняется
+        shop_unit_ids = list(dict.fromkeys(shop_unit_ids))
+        if len(shop_unit_ids) > settings.nodes_batch_max_size:
+            raise self.VALIDATION_ERROR
+        trees = await self.cache.get_or_load_many(
+            [('nodes', shop_unit_id, None) for shop_unit_id in shop_unit_ids],
+            self._get_shop_unit_nodes_batch,
+            tags=lambda key: [key[1]]
+        )
+        return b'{"items":[' + b','.join(trees) + b']}'
+
+    async def _get_shop_unit_nodes_batch(
+        self,
+        keys: List[Any]
+    ) -> List[bytes]:
+        # Ключи кэша совпадают с ключами /nodes/{id}: ответы для одного
+        # узла одинаковы, поэтому записи общие
+        shop_unit_ids = [shop_unit_id for _, shop_unit_id, _ in keys]
         async with self.session.begin():
-            await self.session.connection(execution_options={
-                'isolation_level': 'REPEATABLE READ'
-            })
-            date_start = date_ - timedelta(days=1)
-            date_end = date_
-            period = sql.func.tsrange(date_start, date_end, '[]')
-            q = sql.select(
-                ShopUnitImport
-            ).where(
-                ShopUnitImport.type == ShopUnitType.OFFER,
-                period.op('@>')(ShopUnitImport.date),
-                ShopUnitImport.actuality_period.op('@>')(date_end)
+            # Все поддеревья читаются одним запросом, поэтому
+            # согласованы между собой
+            rows = await self._fetch(
+                SHOP_UNIT_NODES_BATCH, {'shop_unit_ids': shop_unit_ids}
             )
-            result = await self.session.scalars(q)
-            return ShopUnitsListSchema(items=result.all())
+        try:
+            return dump_shop_unit_trees(rows, shop_unit_ids)
+        except KeyError:
+            raise self.NOT_FOUND_ERROR
+
+    async def _cursor(
+        self,
+        query: CompiledQuery,
+        params: Dict[str, Any]
+    ) -> AsyncIterator[List[asyncpg.Record]]:
+        # Курсор на стороне сервера существует только внутри транзакции.
+        # Если сессия еще ничего не выполняла, транзакцию открывает asyncpg
+        connection = await self.session.connection()
+        raw_connection = await connection.get_raw_connection()
+        driver_connection = raw_connection.driver_connection
+        batches = query.cursor(
+            driver_connection, params, settings.stream_fetch_size
+        )
+        if driver_connection.is_in_transaction():
+            async for rows in batches:
+                yield rows
+            return
+        async with driver_connection.transaction(
+            isolation='repeatable_read', readonly=True
+        ):
+            async for rows in batches:
+                yield rows
+
+    def _stream_shop_units_list(
+        self,
+        queries: ListQueries,
+        params: Dict[str, Any],
+        limit: Optional[int],
+        cursor: Optional[PageCursor]
+    ) -> AsyncIterator[bytes]:
+        if limit is None and cursor is None:
+            return stream_shop_units_list(self._cursor(queries.full, params))
+
+        # На одну строку больше, чтобы узнать, есть ли следующая страница
+        params = dict(params, limit=None if limit is None else limit + 1)
+        if cursor is None:
+            batches = self._cursor(queries.first_page, params)
+        else:
+            params['cursor_date'], params['cursor_id'] = cursor
+            batches = self._cursor(queries.next_page, params)
+        return stream_shop_units_page(batches, limit)
+
+    def get_sales(
+        self,
+        date_: datetime,
+        limit: Optional[int] = None,
+        cursor: Optional[PageCursor] = None
+    ) -> AsyncIterator[bytes]:
+        return self.cache.get_or_stream(
+            ('sales', date_, limit, cursor),
+            lambda: self._stream_sales(date_, limit, cursor),
+            tags=[SALES_CACHE_TAG]
+        )
+
+    async def _stream_sales(
+        self,
+        date_: datetime,
+        limit: Optional[int],
+        cursor: Optional[PageCursor]
+    ) -> AsyncIterator[bytes]:
+        async with self.session.begin():
+            chunks = self._stream_shop_units_list(SALES, {
+                'date_start': date_ - timedelta(days=1),
+                'date_end': date_
+            }, limit, cursor)
+            async for chunk in chunks:
+                yield chunk
+
+    def get_shop_unit_statistic(
+        self,
+        shop_unit_id: UUID,
+        date_start: Optional[datetime],
+        date_end: Optional[datetime],
+        limit: Optional[int] = None,
+        cursor: Optional[PageCursor] = None
+    ) -> AsyncIterator[bytes]:
+        return self.cache.get_or_stream(
+            ('statistic', shop_unit_id, date_start, date_end, limit, cursor),
+            lambda: self._stream_shop_unit_statistic(
+                shop_unit_id, date_start, date_end, limit, cursor
+            ),
+            tags=[shop_unit_id]
+        )
 
-    async def get_shop_unit_statistic(
+    async def _stream_shop_unit_statistic(
         self,
         shop_unit_id: UUID,
         date_start: Optional[datetime],
-        date_end: Optional[datetime]
-    ) -> ShopUnitsListSchema:
+        date_end: Optional[datetime],
+        limit: Optional[int],
+        cursor: Optional[PageCursor]
+    ) -> AsyncIterator[bytes]:
         async with self.session.begin():
             await self.session.connection(execution_options={
                 'isolation_level': 'REPEATABLE READ'
             })
             await self._check_is_shop_unit_exists(shop_unit_id)
 
-            period = sql.func.tsrange(date_start, date_end, '[)')
-
-            # Получим все узлы и их детей,
-            # которые менялись в течение заднного периода
-            nodes_history = sql.select(
-                ShopUnitImport,
-                ShopUnitImport.actuality_period
-                .op('*')(period).label('actuality_period')
-            ).where(
-                ShopUnitImport.actuality_period.op('&&')(period),
-                ShopUnitImport.id == shop_unit_id
-            ).cte(recursive=True)
-            tmp = sql.select(
-                ShopUnitImport,
-                ShopUnitImport.actuality_period
-                .op('*')(nodes_history.c.actuality_period)
-            ).join(
-                nodes_history,
-                sql.and_(
-                    nodes_history.c.id == ShopUnitImport.parent_id,
-                    ShopUnitImport.actuality_period
-                    .op('&&')(nodes_history.c.actuality_period)
-                )
-            )
-            nodes_history = nodes_history.union_all(tmp)
-
-            # Цена меняется тогда, когда меняются дочерние узлы
-            adding_children_dates = sql.select(
-                nodes_history.c.date.label('date')
-            ).distinct()
-            # Очень важно учесть случай, когда узел перестает быть дочерним
-            # это можно отследить по дате истечения актуальности импорта
-            removing_children_dates = sql.select(
-                nodes_history.c.expiration_date.label('date')
-            ).distinct()
-            tmp = adding_children_dates.union(
-                removing_children_dates).subquery()
-            price_change = sql.select(
-                sql.func.row_number().over(
-                    order_by=[tmp.c.date],
-                    range_=(None, None)
-                ).label('row_num'),
-                tmp.c.date.label('date')
-            ).cte()
-            next_price_change = sql.alias(price_change)
-            # Получим интервалы, в которые потенциально могла измениться цена
-            price_change_periods = sql.select(
-                sql.func.tsrange(
-                    price_change.c.date, next_price_change.c.date, '[)'
-                ).label('period')
-            ).join_from(
-                price_change,
-                next_price_change,
-                price_change.c.row_num + 1 == next_price_change.c.row_num
-            ).subquery()
-
-            # Сопоставим периоды изменения цены и детей
-            # для того, чтобы в дальнейшем саггрегировать
-            # цену за каждый из периодов
-            offers = sql.select(
-                nodes_history.c.id,
-                nodes_history.c.price,
-                price_change_periods.c.period
-            ).join_from(
-                price_change_periods,
-                nodes_history,
-                price_change_periods.c.period
-                .op('&&')(nodes_history.c.actuality_period)
-            ).where(
-                nodes_history.c.type == ShopUnitType.OFFER
-            ).subquery()
-
-            price_periods = sql.select(
-                offers.c.period,
-                sql.func.avg(offers.c.price).label('price')
-            ).group_by(offers.c.period).subquery()
-
-            # Изменения состоят из изменений цены
-            price_changes = sql.select(
-                nodes_history.c.id,
-                nodes_history.c.type,
-                nodes_history.c.parent_id,
-                nodes_history.c.name,
-                sql.func.lower(price_periods.c.period).label('date'),
-                price_periods.c.price
-            ).join_from(
-                price_periods,
-                nodes_history,
-                nodes_history.c.actuality_period
-                .op('@>')(sql.func.lower(price_periods.c.period))
-            ).where(
-                nodes_history.c.id == shop_unit_id,
-                period.op('@>')(sql.func.lower(price_periods.c.period))
-            )
-
-            # А также из изменения полей самого узла
-            nodes_changes = sql.select(
-                nodes_history.c.id,
-                nodes_history.c.type,
-                nodes_history.c.parent_id,
-                nodes_history.c.name,
-                nodes_history.c.date,
-                price_periods.c.price
-            ).join_from(
-                nodes_history,
-                price_periods,
-                price_periods.c.period
-                .op('@>')(nodes_history.c.date),
-                isouter=True
-            ).where(
-                nodes_history.c.id == shop_unit_id,
-                period.op('@>')(nodes_history.c.date)
-            )
-
-            changes = price_changes.union(nodes_changes).subquery()
-            node = orm.aliased(ShopUnitImport, changes, adapt_on_names=True)
-
-            # Выбираем уникальные изменения, ведь дата изменения цены
-            # могла совпасть с датой изменения узла
-            q = sql.select(node).order_by(
-                node.date
-            )
-            result = await self.session.scalars(q)
-            return ShopUnitsListSchema(items=result.all())
+            chunks = self._stream_shop_units_list(SHOP_UNIT_STATISTIC, {
+                'shop_unit_id': shop_unit_id,
+                'date_start': date_start,
+                'date_end': date_end
+            }, limit, cursor)
+            async for chunk in chunks:
+                yield chunk
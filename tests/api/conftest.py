@@ -1,14 +1,15 @@
 from typing import AsyncGenerator
 import uuid
 
+from fastapi import FastAPI
 from httpx import AsyncClient
 import pytest
 from sqlalchemy.engine import make_url
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 
 from market.app import get_app
-from market.db.connection import get_session
+from market.db.connection import create_engine, get_engine, get_session
 from market.db.utils import tmp_database
 
 
@@ -20,8 +21,14 @@ def migrated_database_url(template_db_url: str):
 
 
 @pytest.fixture()
-def get_mock_session(migrated_database_url: str):
-    engine = create_async_engine(migrated_database_url)
+async def engine(migrated_database_url: str) -> AsyncEngine:
+    engine = create_engine(migrated_database_url)
+    yield engine
+    await engine.dispose()
+
+
+@pytest.fixture()
+def get_mock_session(engine: AsyncEngine):
     Session = sessionmaker(bind=engine, class_=AsyncSession, 
                            autocommit=False, autoflush=False)
     async def get_session() -> AsyncGenerator[AsyncSession, None]:
@@ -31,9 +38,15 @@ def get_mock_session(migrated_database_url: str):
 
 
 @pytest.fixture()
-async def api_client(get_mock_session) -> AsyncClient:
+def app(engine: AsyncEngine, get_mock_session) -> FastAPI:
     app = get_app()
     app.dependency_overrides[get_session] = get_mock_session
+    app.dependency_overrides[get_engine] = lambda: engine
+    return app
+
+
+@pytest.fixture()
+async def api_client(app: FastAPI) -> AsyncClient:
     base_url = f'http://{uuid.uuid4()}'
     async with AsyncClient(app=app, base_url=base_url) as client:
         yield client
@@ -0,0 +1,144 @@
+import asyncio
+from datetime import datetime
+from uuid import UUID
+
+import asyncpg
+from httpx import AsyncClient
+import pytest
+from sqlalchemy.engine import make_url
+
+from market.cache import (
+    SALES_CACHE_TAG, CacheInvalidationListener, ResponseCache
+)
+
+from .utils import make_delete_request, make_imports_request
+
+
+CATEGORY_ID = UUID('069cb8d7-bbdd-47d3-ad8f-82ef4c269df1')
+OFFER_ID = UUID('863e1a7a-1304-42ae-943b-179184c077e3')
+OTHER_ID = UUID('98883e8f-0507-482f-bce2-2fb306cf6483')
+
+
+@pytest.fixture()
+def dsn(migrated_database_url: str) -> str:
+    url = make_url(migrated_database_url).set(drivername='postgresql')
+    return url.render_as_string(hide_password=False)
+
+
+@pytest.fixture()
+async def listener(dsn: str):
+    # Кэш другого процесса, который узнает об изменениях только
+    # через уведомления
+    cache = ResponseCache(max_size=1024, ttl=60)
+    listener = CacheInvalidationListener(cache, dsn, reconnect_delay=0.1)
+    await listener.start()
+    yield listener
+    await listener.stop()
+
+
+@pytest.fixture()
+def cache(listener: CacheInvalidationListener) -> ResponseCache:
+    return listener.cache
+
+
+async def _wait_for(condition) -> None:
+    for _ in range(100):
+        if condition():
+            return
+        await asyncio.sleep(0.05)
+    assert condition()
+
+
+def _fill(cache: ResponseCache) -> None:
+    cache.set(('nodes', CATEGORY_ID), b'1', tags=[CATEGORY_ID])
+    cache.set(('nodes', OFFER_ID), b'2', tags=[OFFER_ID])
+    cache.set(('nodes', OTHER_ID), b'3', tags=[OTHER_ID])
+    for date_ in (datetime(2022, 2, 2, 12), datetime(2022, 2, 5, 12)):
+        cache.set(('sales', date_), b'4', tags=[SALES_CACHE_TAG])
+
+
+@pytest.mark.asyncio
+async def test_import_notification(
+    api_client: AsyncClient,
+    cache: ResponseCache
+):
+    _fill(cache)
+    await make_imports_request(api_client, [
+        {
+            'type': 'CATEGORY',
+            'name': 'Смартфоны',
+            'id': str(CATEGORY_ID),
+            'parentId': None
+        },
+        {
+            'type': 'OFFER',
+            'name': 'jPhone 13',
+            'id': str(OFFER_ID),
+            'parentId': str(CATEGORY_ID),
+            'price': 79999
+        }
+    ], '2022-02-02T00:00:00.000Z')
+
+    await _wait_for(lambda: cache.get(('nodes', CATEGORY_ID)) is None)
+    assert cache.get(('nodes', OFFER_ID)) is None
+    assert cache.get(('nodes', OTHER_ID)) == b'3'
+    assert cache.get(('sales', datetime(2022, 2, 2, 12))) is None
+    assert cache.get(('sales', datetime(2022, 2, 5, 12))) == b'4'
+
+    _fill(cache)
+    await make_delete_request(api_client, str(OFFER_ID))
+
+    await _wait_for(lambda: cache.get(('nodes', OFFER_ID)) is None)
+    assert cache.get(('nodes', CATEGORY_ID)) is None
+    assert cache.get(('nodes', OTHER_ID)) == b'3'
+    assert cache.get(('sales', datetime(2022, 2, 5, 12))) is None
+
+
+@pytest.mark.asyncio
+async def test_large_import_notification(
+    api_client: AsyncClient,
+    cache: ResponseCache,
+    monkeypatch
+):
+    monkeypatch.setattr(
+        'market.cache.settings.response_cache_invalidation_limit', 0
+    )
+    _fill(cache)
+    await make_imports_request(api_client, [{
+        'type': 'CATEGORY',
+        'name': 'Смартфоны',
+        'id': str(CATEGORY_ID),
+        'parentId': None
+    }], '2022-02-02T00:00:00.000Z')
+
+    await _wait_for(lambda: len(cache) == 0)
+
+
+@pytest.mark.asyncio
+async def test_listener_reconnect(
+    dsn: str,
+    listener: CacheInvalidationListener
+):
+    cache = listener.cache
+    _fill(cache)
+    connection = await asyncpg.connect(dsn)
+    try:
+        await connection.execute(
+            'SELECT pg_terminate_backend(pid) FROM pg_stat_activity '
+            'WHERE datname = current_database() AND query LIKE $1',
+            'LISTEN%'
+        )
+        await _wait_for(lambda: len(cache) == 0)
+        await _wait_for(lambda: listener._connection is not None)
+
+        # После переподключения уведомления снова доходят до кэша
+        _fill(cache)
+        await connection.execute(
+            "SELECT pg_notify('response_cache_invalidation', $1)",
+            f'{{"ids": ["{OTHER_ID}"], "date": null}}'
+        )
+        await _wait_for(lambda: cache.get(('nodes', OTHER_ID)) is None)
+        assert cache.get(('nodes', CATEGORY_ID)) == b'1'
+        assert cache.get(('sales', datetime(2022, 2, 2, 12))) is None
+    finally:
+        await connection.close()
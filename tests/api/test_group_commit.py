@@ -0,0 +1,123 @@
+import asyncio
+from datetime import datetime
+from http import HTTPStatus
+from uuid import uuid4
+
+from fastapi import HTTPException
+from httpx import AsyncClient
+import pytest
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from market.cache import ResponseCache
+from market.group_commit import ImportGroupCommit
+from market.schemas import ShopUnitsListImportSchema
+from market.services import MarketService
+
+from .utils import make_nodes_request
+
+
+CATEGORY_ID = '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1'
+
+
+def _payload(items, update_date: datetime) -> ShopUnitsListImportSchema:
+    return ShopUnitsListImportSchema.parse_obj({
+        'items': items,
+        'updateDate': update_date.isoformat(timespec='milliseconds') + 'Z'
+    })
+
+
+def _offer(price: int, parent_id=CATEGORY_ID):
+    return {
+        'type': 'OFFER', 'name': 'Товар', 'id': str(uuid4()),
+        'parentId': parent_id, 'price': price
+    }
+
+
+@pytest.fixture()
+def Session(engine: AsyncEngine):
+    return sessionmaker(bind=engine, class_=AsyncSession,
+                        autocommit=False, autoflush=False)
+
+
+@pytest.fixture()
+def groups(monkeypatch):
+    # Размеры групп, которые применялись одной транзакцией
+    sizes = []
+    import_shop_units_group = MarketService.import_shop_units_group
+
+    async def wrapper(self, payloads):
+        sizes.append(len(payloads))
+        return await import_shop_units_group(self, payloads)
+
+    monkeypatch.setattr(MarketService, 'import_shop_units_group', wrapper)
+    return sizes
+
+
+async def _import(Session, group_commit, payload) -> None:
+    async with Session() as session:
+        service = MarketService(session, ResponseCache(max_size=0, ttl=0))
+        await group_commit.import_shop_units(payload, service)
+
+
+@pytest.mark.asyncio
+async def test_group_commit(api_client: AsyncClient, Session, groups):
+    group_commit = ImportGroupCommit(delay=0.05, max_items=100, siblings=0)
+    category = {
+        'type': 'CATEGORY', 'name': 'Категория',
+        'id': CATEGORY_ID, 'parentId': None
+    }
+    # Импорты применяются по дате обновления, поэтому категория
+    # создается раньше товаров, хотя пришла последней
+    offer = _offer(100)
+    payloads = [
+        _payload([offer], datetime(2022, 2, 2, 1)),
+        _payload([_offer(200), _offer(300)], datetime(2022, 2, 2, 2)),
+        # Родитель - товар из другого импорта
+        _payload([_offer(400, offer['id'])], datetime(2022, 2, 2, 3)),
+        _payload([category], datetime(2022, 2, 2))
+    ]
+    results = await asyncio.gather(*(
+        _import(Session, group_commit, payload) for payload in payloads
+    ), return_exceptions=True)
+
+    assert groups == [4]
+    assert results[:2] == [None, None]
+    assert isinstance(results[2], HTTPException)
+    assert results[2].status_code == HTTPStatus.BAD_REQUEST
+    assert results[3] is None
+
+    response = await make_nodes_request(api_client, CATEGORY_ID)
+    assert response.status_code == HTTPStatus.OK
+    assert response.json()['price'] == 200
+    assert len(response.json()['children']) == 3
+
+
+@pytest.mark.asyncio
+async def test_group_commit_max_items(Session, groups):
+    group_commit = ImportGroupCommit(delay=0.05, max_items=2, siblings=0)
+    date_ = datetime(2022, 2, 2)
+    await asyncio.gather(
+        # Больше max_items - применяется отдельно
+        _import(Session, group_commit, _payload(
+            [_offer(100, None) for _ in range(3)], date_
+        )),
+        _import(Session, group_commit, _payload([_offer(100, None)], date_)),
+        _import(Session, group_commit, _payload([_offer(100, None)], date_)),
+        # Не помещается в группу - начинает следующую
+        _import(Session, group_commit, _payload([_offer(100, None)], date_))
+    )
+    assert groups == [2, 1]
+
+
+@pytest.mark.asyncio
+async def test_group_commit_siblings(Session, groups):
+    # Пока другие импорты не применяются, импорт не ждет остальные
+    group_commit = ImportGroupCommit(delay=0.05, max_items=100)
+    await asyncio.gather(*(
+        _import(Session, group_commit, _payload(
+            [_offer(100, None)], datetime(2022, 2, 2)
+        ))
+        for _ in range(4)
+    ))
+    assert groups == [1, 3]
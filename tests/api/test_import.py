@@ -1,10 +1,38 @@
+import asyncio
 from http import HTTPStatus
 from itertools import permutations
+import json
+import logging
+from typing import Any, Dict, List, Tuple
+import uuid
 
 from httpx import AsyncClient
 import pytest
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncEngine
 
-from .utils import make_imports_request
+from market.config import settings
+from market.services import ALL_TREES_LOCK_KEY, MarketService
+
+from .utils import (
+    make_imports_request, make_imports_stream_request,
+    make_node_statistic_request, make_nodes_request, make_sales_request
+)
+
+
+@pytest.fixture()
+def rejections(caplog, monkeypatch):
+    # fileConfig в миграциях отключает уже созданные логгеры
+    monkeypatch.setattr(logging.getLogger('market.services'), 'disabled', False)
+    caplog.set_level(logging.INFO, logger='market.services')
+    return caplog
+
+
+def _assert_rejected(response, rejections, reason: str) -> None:
+    # Тело ответа совпадает со спецификацией, причина - только в журнале
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert response.json() == {'code': 400, 'message': 'Validation Failed'}
+    assert f'Import rejected: {reason}' in rejections.messages
 
 
 @pytest.mark.parametrize('items', permutations([
@@ -54,7 +82,7 @@ async def test_non_unique_ids(api_client: AsyncClient):
 
 
 @pytest.mark.asyncio
-async def test_parent_id_violation(api_client: AsyncClient):
+async def test_parent_id_violation(api_client: AsyncClient, rejections):
     response = await make_imports_request(api_client, [{
         'type': 'OFFER',
         'name': 'jPhone 13',
@@ -62,11 +90,42 @@ async def test_parent_id_violation(api_client: AsyncClient):
         'parentId': 'd515e43f-f3f6-4471-bb77-6b455017a2d2',
         'price': 79999
     }], '2022-02-04T00:00:00.000Z')
-    assert response.status_code == HTTPStatus.BAD_REQUEST
+    _assert_rejected(response, rejections, (
+        'parent d515e43f-f3f6-4471-bb77-6b455017a2d2 '
+        'of 863e1a7a-1304-42ae-943b-179184c077e3 not found'
+    ))
+
+
+@pytest.mark.asyncio
+async def test_rejected_before_locks(
+    api_client: AsyncClient,
+    engine: AsyncEngine,
+    rejections
+):
+    # Пока все деревья заблокированы, некорректная выгрузка
+    # отклоняется без ожидания блокировок
+    async with engine.connect() as connection:
+        async with connection.begin():
+            key = sa.literal(ALL_TREES_LOCK_KEY, sa.BigInteger)
+            await connection.execute(
+                sa.select(sa.func.pg_advisory_xact_lock(key))
+            )
+            request = make_imports_request(api_client, [{
+                'type': 'OFFER',
+                'name': 'jPhone 13',
+                'id': '863e1a7a-1304-42ae-943b-179184c077e3',
+                'parentId': 'd515e43f-f3f6-4471-bb77-6b455017a2d2',
+                'price': 79999
+            }], '2022-02-04T00:00:00.000Z')
+            response = await asyncio.wait_for(request, timeout=5)
+    _assert_rejected(response, rejections, (
+        'parent d515e43f-f3f6-4471-bb77-6b455017a2d2 '
+        'of 863e1a7a-1304-42ae-943b-179184c077e3 not found'
+    ))
 
 
 @pytest.mark.asyncio
-async def test_shop_unit_type_change(api_client: AsyncClient):
+async def test_shop_unit_type_change(api_client: AsyncClient, rejections):
     response = await make_imports_request(api_client, [{
         'type': 'OFFER',
         'name': 'jPhone 13',
@@ -85,9 +144,20 @@ async def test_shop_unit_type_change(api_client: AsyncClient):
     }], '2022-02-05T00:00:00.000Z')
     assert response.status_code == HTTPStatus.BAD_REQUEST
 
+    response = await make_imports_request(api_client, [{
+        'type': 'CATEGORY',
+        'name': 'jPhone 13',
+        'id': '863e1a7a-1304-42ae-943b-179184c077e3',
+        'parentId': None
+    }], '2022-02-05T00:00:00.000Z')
+    _assert_rejected(response, rejections, (
+        'type of 863e1a7a-1304-42ae-943b-179184c077e3 '
+        'cannot be changed'
+    ))
+
 
 @pytest.mark.asyncio
-async def test_parent_type_violation(api_client: AsyncClient):
+async def test_parent_type_violation(api_client: AsyncClient, rejections):
     response = await make_imports_request(api_client, [{
         'type': 'OFFER',
         'name': 'jPhone 13',
@@ -104,9 +174,82 @@ async def test_parent_type_violation(api_client: AsyncClient):
         'parentId': '863e1a7a-1304-42ae-943b-179184c077e3',
         'price': 59999
     }], '2022-02-05T00:00:00.000Z')
+    _assert_rejected(response, rejections, (
+        'parent of b1d8fd7d-2ae3-47d5-b2f9-0f094af800d4 '
+        'is not a category'
+    ))
+
+
+@pytest.mark.asyncio
+async def test_parent_cycle(api_client: AsyncClient):
+    response = await make_imports_request(api_client, [
+        {
+            'type': 'CATEGORY',
+            'name': 'Товары',
+            'id': '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1',
+            'parentId': None
+        },
+        {
+            'type': 'CATEGORY',
+            'name': 'Смартфоны',
+            'id': 'd515e43f-f3f6-4471-bb77-6b455017a2d2',
+            'parentId': '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1'
+        }
+    ], '2022-02-04T00:00:00.000Z')
+    assert response.status_code == HTTPStatus.OK
+
+    response = await make_imports_request(api_client, [{
+        'type': 'CATEGORY',
+        'name': 'Товары',
+        'id': '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1',
+        'parentId': 'd515e43f-f3f6-4471-bb77-6b455017a2d2'
+    }], '2022-02-05T00:00:00.000Z')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.asyncio
+async def test_parent_cycle_in_batch(api_client: AsyncClient):
+    response = await make_imports_request(api_client, [
+        {
+            'type': 'CATEGORY',
+            'name': 'Товары',
+            'id': '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1',
+            'parentId': 'd515e43f-f3f6-4471-bb77-6b455017a2d2'
+        },
+        {
+            'type': 'CATEGORY',
+            'name': 'Смартфоны',
+            'id': 'd515e43f-f3f6-4471-bb77-6b455017a2d2',
+            'parentId': '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1'
+        }
+    ], '2022-02-04T00:00:00.000Z')
     assert response.status_code == HTTPStatus.BAD_REQUEST
 
 
+@pytest.mark.asyncio
+async def test_offer_parent_in_batch(api_client: AsyncClient, rejections):
+    response = await make_imports_request(api_client, [
+        {
+            'type': 'OFFER',
+            'name': 'Xomiа Readme 10',
+            'id': 'b1d8fd7d-2ae3-47d5-b2f9-0f094af800d4',
+            'parentId': '863e1a7a-1304-42ae-943b-179184c077e3',
+            'price': 59999
+        },
+        {
+            'type': 'OFFER',
+            'name': 'jPhone 13',
+            'id': '863e1a7a-1304-42ae-943b-179184c077e3',
+            'parentId': None,
+            'price': 79999
+        }
+    ], '2022-02-04T00:00:00.000Z')
+    _assert_rejected(response, rejections, (
+        'parent of b1d8fd7d-2ae3-47d5-b2f9-0f094af800d4 '
+        'is not a category'
+    ))
+
+
 @pytest.mark.parametrize('items', [
     {
         'type': 'CATEGORY',
@@ -133,3 +276,416 @@ async def test_shop_unit_price_validation(api_client: AsyncClient, items):
 async def test_empty_shop_units_list(api_client: AsyncClient):
     response = await make_imports_request(api_client, [], '2022-02-04T00:00:00.000Z')
     assert response.status_code == HTTPStatus.OK
+
+
+@pytest.mark.asyncio
+async def test_batches_with_same_update_date(api_client: AsyncClient):
+    offer = {
+        'type': 'OFFER',
+        'name': 'jPhone 13',
+        'id': '863e1a7a-1304-42ae-943b-179184c077e3',
+        'parentId': None,
+        'price': 79999
+    }
+    response = await make_imports_request(api_client, [offer], '2022-02-04T00:00:00.000Z')
+    assert response.status_code == HTTPStatus.OK
+
+    response = await make_imports_request(api_client, [{
+        'type': 'OFFER',
+        'name': 'Xomiа Readme 10',
+        'id': 'b1d8fd7d-2ae3-47d5-b2f9-0f094af800d4',
+        'parentId': None,
+        'price': 59999
+    }], '2022-02-04T00:00:00.000Z')
+    assert response.status_code == HTTPStatus.OK
+
+    response = await make_imports_request(api_client, [offer], '2022-02-04T00:00:00.000Z')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+    response = await make_imports_request(
+        api_client, [{**offer, 'price': 69999}], '2022-02-05T00:00:00.000Z'
+    )
+    assert response.status_code == HTTPStatus.OK
+
+    response = await make_nodes_request(api_client, offer['id'])
+    assert response.status_code == HTTPStatus.OK
+    assert response.json()['price'] == 69999
+
+
+def _collect_prices(node: Dict[str, Any]) -> List[int]:
+    if node['children'] is None:
+        return [node['price']]
+    return [
+        price for child in node['children'] for price in _collect_prices(child)
+    ]
+
+
+# С порогом 1 импорты в несколько деревьев блокируют все деревья
+@pytest.mark.parametrize('escalation_threshold', [64, 1])
+@pytest.mark.asyncio
+async def test_concurrent_imports(
+    api_client: AsyncClient,
+    monkeypatch,
+    escalation_threshold
+):
+    monkeypatch.setattr(
+        settings, 'tree_lock_escalation_threshold', escalation_threshold
+    )
+    root_ids = [str(uuid.uuid4()) for _ in range(2)]
+    category_ids = [str(uuid.uuid4()) for _ in range(4)]
+    response = await make_imports_request(api_client, [
+        *({
+            'type': 'CATEGORY',
+            'name': 'Корень',
+            'id': root_id,
+            'parentId': None
+        } for root_id in root_ids),
+        *({
+            'type': 'CATEGORY',
+            'name': 'Категория',
+            'id': category_id,
+            'parentId': root_ids[0]
+        } for category_id in category_ids)
+    ], '2022-02-01T00:00:00.000Z')
+    assert response.status_code == HTTPStatus.OK
+
+    # Импорты в разные деревья и перенос категорий между ними
+    def make_items(i: int) -> List[Dict[str, Any]]:
+        items = [{
+            'type': 'OFFER',
+            'name': 'Товар',
+            'id': str(uuid.uuid4()),
+            'parentId': category_ids[i % 4] if i % 3 else root_ids[i % 2],
+            'price': i * 100
+        }]
+        if i % 5 == 0:
+            items.append({
+                'type': 'CATEGORY',
+                'name': 'Категория',
+                'id': category_ids[i // 5],
+                'parentId': root_ids[1]
+            })
+        return items
+
+    responses = await asyncio.gather(*(
+        make_imports_request(
+            api_client, make_items(i), f'2022-02-02T00:00:{i:02}.000Z'
+        )
+        for i in range(20)
+    ))
+    assert all(r.status_code == HTTPStatus.OK for r in responses)
+
+    offer_count = 0
+    for root_id in root_ids:
+        response = await make_nodes_request(api_client, root_id)
+        prices = _collect_prices(response.json())
+        offer_count += len(prices)
+        assert response.json()['price'] == sum(prices) // len(prices)
+    assert offer_count == 20
+
+
+@pytest.mark.asyncio
+async def test_tree_lock_escalation(
+    api_client: AsyncClient,
+    engine: AsyncEngine,
+    monkeypatch
+):
+    monkeypatch.setattr(settings, 'tree_lock_escalation_threshold', 2)
+
+    def make_offers(count: int) -> List[Dict[str, Any]]:
+        return [{
+            'type': 'OFFER',
+            'name': 'Товар',
+            'id': str(uuid.uuid4()),
+            'parentId': None,
+            'price': 100
+        } for _ in range(count)]
+
+    async with engine.connect() as connection:
+        async with connection.begin():
+            key = sa.literal(ALL_TREES_LOCK_KEY, sa.BigInteger)
+            await connection.execute(
+                sa.select(sa.func.pg_advisory_xact_lock_shared(key))
+            )
+            # Блокировки отдельных деревьев совместимы с разделяемой
+            response = await make_imports_request(
+                api_client, make_offers(2), '2022-02-01T00:00:00.000Z'
+            )
+            assert response.status_code == HTTPStatus.OK
+
+            # Три дерева блокируются одной исключительной блокировкой
+            task = asyncio.create_task(make_imports_request(
+                api_client, make_offers(3), '2022-02-02T00:00:00.000Z'
+            ))
+            await asyncio.sleep(0.2)
+            assert not task.done()
+    response = await task
+    assert response.status_code == HTTPStatus.OK
+
+
+STREAM_ITEMS = [
+    {
+        'type': 'OFFER',
+        'name': 'jPhone 13',
+        'id': '863e1a7a-1304-42ae-943b-179184c077e3',
+        'parentId': 'd515e43f-f3f6-4471-bb77-6b455017a2d2',
+        'price': 79999
+    },
+    {
+        'type': 'CATEGORY',
+        'name': 'Смартфоны',
+        'id': 'd515e43f-f3f6-4471-bb77-6b455017a2d2',
+        'parentId': '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1'
+    },
+    {
+        'type': 'CATEGORY',
+        'name': 'Товары',
+        'id': '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1',
+        'parentId': None
+    },
+    {
+        'type': 'OFFER',
+        'name': 'Xomiа Readme 10',
+        'id': 'b1d8fd7d-2ae3-47d5-b2f9-0f094af800d4',
+        'parentId': 'd515e43f-f3f6-4471-bb77-6b455017a2d2',
+        'price': 59999
+    }
+]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1 << 16])
+@pytest.mark.asyncio
+async def test_stream_import(api_client: AsyncClient, chunk_size):
+    response = await make_imports_stream_request(
+        api_client, STREAM_ITEMS, '2022-02-04T00:00:00.000Z', chunk_size
+    )
+    assert response.status_code == HTTPStatus.OK
+
+    response = await make_nodes_request(
+        api_client, '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1'
+    )
+    assert response.status_code == HTTPStatus.OK
+    root = response.json()
+    assert root['price'] == 69999
+    assert root['date'] == '2022-02-04T00:00:00.000Z'
+    assert root['children'][0]['name'] == 'Смартфоны'
+    assert len(root['children'][0]['children']) == 2
+
+
+@pytest.mark.asyncio
+async def test_stream_import_equals_regular(api_client: AsyncClient):
+    response = await make_imports_request(
+        api_client, STREAM_ITEMS, '2022-02-04T00:00:00.000Z'
+    )
+    assert response.status_code == HTTPStatus.OK
+    response = await make_nodes_request(
+        api_client, '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1'
+    )
+    expected = response.json()
+
+    moved = {**STREAM_ITEMS[0], 'parentId': None}
+    response = await make_imports_stream_request(
+        api_client, [moved], '2022-02-05T00:00:00.000Z'
+    )
+    assert response.status_code == HTTPStatus.OK
+    response = await make_imports_stream_request(
+        api_client, STREAM_ITEMS, '2022-02-04T00:00:00.000Z'
+    )
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    response = await make_imports_request(
+        api_client, [STREAM_ITEMS[0]], '2022-02-06T00:00:00.000Z'
+    )
+    assert response.status_code == HTTPStatus.OK
+
+    response = await make_nodes_request(
+        api_client, '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1'
+    )
+    assert response.status_code == HTTPStatus.OK
+    actual = response.json()
+    assert actual['price'] == expected['price']
+    assert actual['date'] == '2022-02-06T00:00:00.000Z'
+
+
+@pytest.mark.parametrize('body', [
+    b'',
+    b'[]',
+    b'{"items": []}',
+    b'{"items": [], "updateDate": "2022-02-04"}',
+    b'{"items": [], "updateDate": "2022-02-04T00:00:00.000Z"} []',
+    b'{"items": [{"type": "CATEGORY", "name": "A", '
+    b'"id": "069cb8d7-bbdd-47d3-ad8f-82ef4c269df1", "price": 1}], '
+    b'"updateDate": "2022-02-04T00:00:00.000Z"}',
+    b'{"items": [{"type": "OFFER", "name": "A", '
+    b'"id": "069cb8d7-bbdd-47d3-ad8f-82ef4c269df1"}], '
+    b'"updateDate": "2022-02-04T00:00:00.000Z"}',
+    b'{"items": [{"type": "OFFER", "name": "A", "id": "1", "price": 1}], '
+    b'"updateDate": "2022-02-04T00:00:00.000Z"}',
+    b'{"items": [{"type": "CATEGORY", "name": "A", '
+    b'"id": "069cb8d7-bbdd-47d3-ad8f-82ef4c269df1"}, '
+    b'{"type": "CATEGORY", "name": "B", '
+    b'"id": "069cb8d7-bbdd-47d3-ad8f-82ef4c269df1"}], '
+    b'"updateDate": "2022-02-04T00:00:00.000Z"}',
+    b'{"items": [{"type": "CATEGORY", "name": "A", '
+    b'"id": "069cb8d7-bbdd-47d3-ad8f-82ef4c269df1", '
+    b'"parentId": "d515e43f-f3f6-4471-bb77-6b455017a2d2"}], '
+    b'"updateDate": "2022-02-04T00:00:00.000Z"}',
+    b'{"items": [{"type": "CATEGORY", "name": "A", '
+    b'"id": "069cb8d7-bbdd-47d3-ad8f-82ef4c269df1"}'
+])
+@pytest.mark.asyncio
+async def test_stream_import_validation(api_client: AsyncClient, body):
+    response = await api_client.post('/imports/stream', content=body)
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.asyncio
+async def test_stream_import_empty_shop_units_list(api_client: AsyncClient):
+    response = await make_imports_stream_request(
+        api_client, [], '2022-02-04T00:00:00.000Z'
+    )
+    assert response.status_code == HTTPStatus.OK
+
+
+def _copy_scenario(ids: Dict[str, str]) -> List[Tuple[str, List[Dict[str, Any]]]]:
+    def category(key: str, parent_key: str = None) -> Dict[str, Any]:
+        return {
+            'type': 'CATEGORY', 'name': key, 'id': ids[key],
+            'parentId': parent_key and ids[parent_key]
+        }
+
+    def offer(key: str, parent_key: str, price: int) -> Dict[str, Any]:
+        return {
+            'type': 'OFFER', 'name': key, 'id': ids[key],
+            'parentId': parent_key and ids[parent_key], 'price': price
+        }
+
+    return [
+        ('2022-02-01T12:00:00.000Z', [
+            offer('offer-1', 'phones', 79999),
+            category('root'),
+            category('phones', 'root'),
+            offer('offer-2', 'phones', 59999),
+            category('tvs', 'root')
+        ]),
+        ('2022-02-02T12:00:00.000Z', [
+            offer('offer-3', 'tvs', 32999),
+            offer('offer-4', 'tvs', 49999),
+            offer('offer-2', 'phones', 54999)
+        ]),
+        # Перенос категории вместе с изменением ее товаров
+        ('2022-02-03T12:00:00.000Z', [
+            category('tvs', None),
+            offer('offer-3', 'tvs', 39999),
+            offer('offer-1', 'tvs', 69999)
+        ])
+    ]
+
+
+def _sort_children(node: Dict[str, Any]) -> Dict[str, Any]:
+    # Порядок детей в ответе /nodes не определен
+    if node['children'] is not None:
+        node['children'].sort(key=lambda child: child['name'])
+        for child in node['children']:
+            _sort_children(child)
+    return node
+
+
+async def _run_copy_scenario(api_client: AsyncClient) -> Dict[str, Any]:
+    """
+    Применяет сценарий с новыми идентификаторами и возвращает ответы
+    /nodes, /sales и статистики, в которых идентификаторы заменены
+    на ключи сценария.
+    """
+    keys = ('root', 'phones', 'tvs', 'offer-1', 'offer-2', 'offer-3', 'offer-4')
+    ids = {key: str(uuid.uuid4()) for key in keys}
+    for update_date, items in _copy_scenario(ids):
+        response = await make_imports_request(api_client, items, update_date)
+        assert response.status_code == HTTPStatus.OK
+
+    responses = {}
+    for key in ('root', 'tvs'):
+        response = await make_nodes_request(api_client, ids[key])
+        assert response.status_code == HTTPStatus.OK
+        responses[f'nodes {key}'] = _sort_children(response.json())
+        response = await make_node_statistic_request(api_client, ids[key])
+        assert response.status_code == HTTPStatus.OK
+        responses[f'statistic {key}'] = sorted(
+            response.json()['items'], key=lambda item: item['date']
+        )
+    response = await make_sales_request(api_client, '2022-02-03T12:00:00.000Z')
+    assert response.status_code == HTTPStatus.OK
+    responses['sales'] = sorted((
+        item for item in response.json()['items']
+        if item['id'] in ids.values()
+    ), key=lambda item: item['name'])
+
+    dump = json.dumps(responses)
+    for key, id_ in ids.items():
+        dump = dump.replace(id_, key)
+    return json.loads(dump)
+
+
+@pytest.mark.asyncio
+async def test_copy_import_equals_regular(api_client: AsyncClient, monkeypatch):
+    copies = []
+    copy_to_staging = MarketService._copy_to_staging
+
+    async def wrapper(self, records):
+        copies.append(len(records))
+        return await copy_to_staging(self, records)
+
+    monkeypatch.setattr(MarketService, '_copy_to_staging', wrapper)
+    expected = await _run_copy_scenario(api_client)
+    assert not copies
+
+    # Каждый импорт сценария загружается через COPY
+    monkeypatch.setattr(settings, 'import_copy_threshold', 1)
+    actual = await _run_copy_scenario(api_client)
+    assert copies == [5, 3, 3]
+    assert actual == expected
+    assert actual['nodes root']['price'] == 54999
+    assert actual['nodes tvs']['parentId'] is None
+
+
+@pytest.mark.asyncio
+async def test_copy_import_above_bind_parameter_limit(
+    api_client: AsyncClient,
+    monkeypatch
+):
+    # Через VALUES с параметром на каждое значение такой импорт
+    # не поместился бы в 32767 параметров запроса: 6 на каждый узел
+    monkeypatch.setattr(settings, 'import_copy_threshold', 1)
+    root_id = str(uuid.uuid4())
+    category_ids = [str(uuid.uuid4()) for _ in range(100)]
+    items = [
+        {'type': 'CATEGORY', 'name': 'Корень', 'id': root_id, 'parentId': None},
+        *(
+            {
+                'type': 'CATEGORY', 'name': 'Категория',
+                'id': category_id, 'parentId': root_id
+            }
+            for category_id in category_ids
+        ),
+        *(
+            {
+                'type': 'OFFER', 'name': 'Товар', 'id': str(uuid.uuid4()),
+                'parentId': category_ids[i % len(category_ids)],
+                'price': i
+            }
+            for i in range(10000)
+        )
+    ]
+    response = await make_imports_request(
+        api_client, items, '2022-02-01T12:00:00.000Z'
+    )
+    assert response.status_code == HTTPStatus.OK
+
+    response = await make_nodes_request(api_client, root_id)
+    assert response.status_code == HTTPStatus.OK
+    root = response.json()
+    assert root['price'] == sum(range(10000)) // 10000
+    assert len(root['children']) == 100
+    for category in root['children']:
+        prices = [offer['price'] for offer in category['children']]
+        assert len(prices) == 100
+        assert category['price'] == sum(prices) // len(prices)
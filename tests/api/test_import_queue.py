@@ -0,0 +1,186 @@
+import asyncio
+from http import HTTPStatus
+from uuid import UUID, uuid4
+
+from httpx import AsyncClient
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from market.cache import ResponseCache
+from market.config import settings
+from market.import_queue import ImportQueueWorker
+from market.services import _get_lock_key
+
+from .utils import (
+    make_import_job_request, make_imports_async_request,
+    make_imports_request, make_nodes_request
+)
+
+
+CATEGORY_ID = '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1'
+OFFER_ID = '863e1a7a-1304-42ae-943b-179184c077e3'
+
+
+@pytest.fixture()
+def import_queue(engine: AsyncEngine) -> ImportQueueWorker:
+    Session = sessionmaker(bind=engine, class_=AsyncSession,
+                           autocommit=False, autoflush=False)
+    return ImportQueueWorker(
+        Session, ResponseCache(max_size=0, ttl=0), poll_interval=0.05
+    )
+
+
+def _category(id_: str, parent_id=None):
+    return {
+        'type': 'CATEGORY', 'name': 'Категория',
+        'id': id_, 'parentId': parent_id
+    }
+
+
+def _offer(id_: str, parent_id: str, price: int):
+    return {
+        'type': 'OFFER', 'name': 'Товар',
+        'id': id_, 'parentId': parent_id, 'price': price
+    }
+
+
+async def _create_job(api_client: AsyncClient, items, update_date) -> str:
+    response = await make_imports_async_request(
+        api_client, items, update_date
+    )
+    assert response.status_code == HTTPStatus.ACCEPTED, response.text
+    job = response.json()
+    assert job['status'] == 'PENDING'
+    assert job['updateDate'] == update_date
+    assert job['finishedAt'] is None
+    return job['id']
+
+
+async def _get_job(api_client: AsyncClient, job_id: str):
+    response = await make_import_job_request(api_client, job_id)
+    assert response.status_code == HTTPStatus.OK
+    return response.json()
+
+
+# Сохраненная выгрузка применяется и обычным путем, и через COPY
+@pytest.mark.parametrize('copy_threshold', [1000, 1])
+@pytest.mark.asyncio
+async def test_import_async(
+    api_client: AsyncClient,
+    import_queue: ImportQueueWorker,
+    monkeypatch,
+    copy_threshold
+):
+    monkeypatch.setattr(settings, 'import_copy_threshold', copy_threshold)
+    job_id = await _create_job(api_client, [
+        _category(CATEGORY_ID),
+        _offer(OFFER_ID, CATEGORY_ID, 100)
+    ], '2022-02-02T00:00:00.000Z')
+    response = await make_nodes_request(api_client, CATEGORY_ID)
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+    assert await import_queue.apply() == 1
+    assert await import_queue.apply() == 0
+    job = await _get_job(api_client, job_id)
+    assert job['status'] == 'DONE'
+    assert job['finishedAt'] is not None
+
+    response = await make_nodes_request(api_client, CATEGORY_ID)
+    assert response.status_code == HTTPStatus.OK
+    assert response.json()['price'] == 100
+
+
+@pytest.mark.asyncio
+async def test_import_async_order(
+    api_client: AsyncClient,
+    import_queue: ImportQueueWorker
+):
+    # Выгрузки применяются по дате обновления, а не по порядку приема.
+    # Ошибочная выгрузка не мешает применить остальные
+    later_id = await _create_job(api_client, [
+        _offer(OFFER_ID, CATEGORY_ID, 200)
+    ], '2022-02-03T00:00:00.000Z')
+    failed_id = await _create_job(api_client, [
+        _offer(str(uuid4()), OFFER_ID, 300)
+    ], '2022-02-02T12:00:00.000Z')
+    earlier_id = await _create_job(api_client, [
+        _category(CATEGORY_ID),
+        _offer(OFFER_ID, CATEGORY_ID, 100)
+    ], '2022-02-02T00:00:00.000Z')
+
+    # Небольшие выгрузки применяются одной транзакцией
+    assert await import_queue.apply() == 3
+    assert (await _get_job(api_client, earlier_id))['status'] == 'DONE'
+    assert (await _get_job(api_client, later_id))['status'] == 'DONE'
+    failed = await _get_job(api_client, failed_id)
+    assert failed['status'] == 'FAILED'
+    assert failed['error'].startswith('Validation Failed: ')
+
+    response = await make_nodes_request(api_client, CATEGORY_ID)
+    assert response.json()['price'] == 200
+    assert response.json()['date'] == '2022-02-03T00:00:00.000Z'
+
+
+@pytest.mark.asyncio
+async def test_import_async_waits_for_tree(
+    api_client: AsyncClient,
+    engine: AsyncEngine,
+    import_queue: ImportQueueWorker
+):
+    await make_imports_request(api_client, [
+        _category(CATEGORY_ID)
+    ], '2022-02-01T00:00:00.000Z')
+    job_id = await _create_job(api_client, [
+        _offer(OFFER_ID, CATEGORY_ID, 100)
+    ], '2022-02-02T00:00:00.000Z')
+
+    # Пока дерево занято другим импортом, выгрузка остается в очереди
+    async with engine.connect() as connection:
+        async with connection.begin():
+            key = sa.literal(_get_lock_key(UUID(CATEGORY_ID)), sa.BigInteger)
+            await connection.execute(
+                sa.select(sa.func.pg_advisory_xact_lock(key))
+            )
+            task = asyncio.create_task(import_queue.apply())
+            await asyncio.sleep(0.2)
+            assert not task.done()
+    assert await task == 1
+    assert (await _get_job(api_client, job_id))['status'] == 'DONE'
+
+
+@pytest.mark.asyncio
+async def test_import_async_worker(
+    api_client: AsyncClient,
+    import_queue: ImportQueueWorker
+):
+    await import_queue.start()
+    try:
+        job_id = await _create_job(api_client, [
+            _category(CATEGORY_ID)
+        ], '2022-02-02T00:00:00.000Z')
+        import_queue.wake()
+        for _ in range(100):
+            job = await _get_job(api_client, job_id)
+            if job['status'] != 'PENDING':
+                break
+            await asyncio.sleep(0.05)
+        assert job['status'] == 'DONE'
+    finally:
+        await import_queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_import_async_validation(api_client: AsyncClient):
+    response = await make_imports_async_request(api_client, [
+        _category(CATEGORY_ID),
+        _category(CATEGORY_ID)
+    ], '2022-02-02T00:00:00.000Z')
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.asyncio
+async def test_import_job_not_found(api_client: AsyncClient):
+    response = await make_import_job_request(api_client, str(uuid4()))
+    assert response.status_code == HTTPStatus.NOT_FOUND
@@ -0,0 +1,60 @@
+from http import HTTPStatus
+import re
+
+from httpx import AsyncClient
+import pytest
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from market.db.metrics import InstrumentedPool, render_pool_metrics
+
+from .utils import make_nodes_request
+
+
+def _parse_metrics(text: str):
+    # Ключи без метки pid: db_pool_size, db_pool_checkout_seconds{le="1"}
+    metrics = {}
+    for line in text.splitlines():
+        if line.startswith('#'):
+            continue
+        name, value = line.rsplit(' ', 1)
+        name = re.sub(r'pid="\d+",?', '', name).replace('{}', '')
+        metrics[name] = float(value)
+    return metrics
+
+
+@pytest.mark.asyncio
+async def test_pool_metrics(api_client: AsyncClient):
+    for _ in range(3):
+        await make_nodes_request(
+            api_client, '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1'
+        )
+
+    response = await api_client.get('/metrics')
+    assert response.status_code == HTTPStatus.OK
+    metrics = _parse_metrics(response.text)
+    assert metrics['db_pool_checkout_seconds_count'] >= 3
+    assert metrics['db_pool_checkout_seconds_bucket{le="+Inf"}'] == \
+        metrics['db_pool_checkout_seconds_count']
+    assert metrics['db_pool_checked_out'] == 0
+    assert metrics['db_pool_checkout_timeouts_total'] == 0
+
+
+@pytest.mark.asyncio
+async def test_pool_metrics_timeout(migrated_database_url: str):
+    engine = create_async_engine(
+        migrated_database_url, poolclass=InstrumentedPool,
+        pool_size=1, max_overflow=0, pool_timeout=0.1
+    )
+    try:
+        async with engine.connect():
+            with pytest.raises(exc.TimeoutError):
+                async with engine.connect():
+                    pass
+            metrics = _parse_metrics(render_pool_metrics(engine.pool))
+            assert metrics['db_pool_checked_out'] == 1
+    finally:
+        await engine.dispose()
+
+    assert metrics['db_pool_checkout_timeouts_total'] == 1
+    assert metrics['db_pool_checkout_seconds_count'] == 1
@@ -311,6 +311,52 @@ async def test_state_duplicates(api_client: AsyncClient, import_batch):
     assert items == expected_statistic
 
 
+@pytest.mark.asyncio
+async def test_retroactive_import(api_client: AsyncClient):
+    # Импорт датой раньше последнего изменения категории
+    response = await make_imports_request(api_client, [{
+        'type': 'OFFER',
+        'name': 'Xomiа Readme 10',
+        'id': 'b3a1a7a2-52f4-4c3e-9d5e-4a0cf5c7e1d2',
+        'parentId': 'd515e43f-f3f6-4471-bb77-6b455017a2d2',
+        'price': 10000
+    }], '2022-02-03T13:00:00.000Z')
+    assert response.status_code == HTTPStatus.OK
+
+    response = await make_node_statistic_request(api_client, '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1')
+    assert response.status_code == HTTPStatus.OK
+
+    items = response.json()['items']
+    assert [(item['date'], item['price']) for item in items] == [
+        ('2022-02-01T12:00:00.000Z', None),
+        ('2022-02-02T12:00:00.000Z', 69999),
+        ('2022-02-03T12:00:00.000Z', 55749),
+        ('2022-02-03T13:00:00.000Z', 46599),
+        ('2022-02-03T15:00:00.000Z', 50499)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_pagination(api_client: AsyncClient):
+    dates = []
+    cursor = None
+    for _ in range(2):
+        response = await make_node_statistic_request(
+            api_client, '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1', limit=3, cursor=cursor
+        )
+        assert response.status_code == HTTPStatus.OK
+
+        payload = response.json()
+        dates.append([item['date'] for item in payload['items']])
+        cursor = payload['nextCursor']
+
+    assert dates == [
+        ['2022-02-01T12:00:00.000Z', '2022-02-02T12:00:00.000Z', '2022-02-03T12:00:00.000Z'],
+        ['2022-02-03T15:00:00.000Z']
+    ]
+    assert cursor is None
+
+
 @pytest.mark.parametrize('date_start,date_end', [
     (None, '2022-02-01T12:00:00.000Z'), ('2022-02-03T15:00:00.001Z', None)
 ])
@@ -1,12 +1,18 @@
 from http import HTTPStatus
 from typing import Any, Dict, List
 
+from fastapi import FastAPI
 from httpx import AsyncClient
 import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from market.config import settings
+from market.queries import SHOP_UNIT_TREE_JSON
 
 from .utils import (
     make_delete_request, make_imports_request, 
-    make_nodes_request
+    make_node_statistic_request, make_nodes_batch_request,
+    make_nodes_request, make_sales_request
 )
 
 
@@ -196,6 +202,141 @@ async def test_nodes_basic(api_client: AsyncClient, tree):
     assert payload == tree
 
 
+@pytest.mark.parametrize('shop_unit_id', [
+    '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1',
+    '1cc0129a-2bfe-474c-9ee6-d435bf5fc8f2',
+    '863e1a7a-1304-42ae-943b-179184c077e3'
+])
+@pytest.mark.asyncio
+async def test_nodes_tree_in_db(
+    app: FastAPI,
+    api_client: AsyncClient,
+    monkeypatch,
+    shop_unit_id
+):
+    statements = []
+    scalar = AsyncSession.scalar
+
+    async def spy(self, statement, *args, **kwargs):
+        statements.append(statement)
+        return await scalar(self, statement, *args, **kwargs)
+
+    monkeypatch.setattr(AsyncSession, 'scalar', spy)
+
+    response = await make_nodes_request(api_client, shop_unit_id)
+    assert response.status_code == HTTPStatus.OK
+    expected = response.json()
+    assert SHOP_UNIT_TREE_JSON not in statements
+
+    # Иначе второй ответ берется из кэша, а не из базы
+    app.state.response_cache.clear()
+    monkeypatch.setattr(settings, 'nodes_tree_in_db', True)
+    response = await make_nodes_request(api_client, shop_unit_id)
+    assert response.status_code == HTTPStatus.OK
+    assert SHOP_UNIT_TREE_JSON in statements
+    actual = response.json()
+    _deep_sort_children(actual)
+    _deep_sort_children(expected)
+    assert actual == expected
+
+
+def _truncate_tree(node: Dict[str, Any], depth: int) -> Dict[str, Any]:
+    node = dict(node)
+    if node['children'] is not None:
+        if depth == 0:
+            node['children'] = None
+        else:
+            node['children'] = [
+                _truncate_tree(child, depth - 1) for child in node['children']
+            ]
+    return node
+
+
+@pytest.mark.parametrize('depth', [0, 1, 2, 10])
+@pytest.mark.asyncio
+async def test_nodes_depth(api_client: AsyncClient, depth):
+    root_id = '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1'
+    response = await make_nodes_request(api_client, root_id)
+    expected = _truncate_tree(response.json(), depth)
+
+    response = await make_nodes_request(api_client, root_id, depth)
+    assert response.status_code == HTTPStatus.OK
+    assert response.json() == expected
+
+    # Цена обрезанной категории меняется вместе с ее поддеревом
+    await make_imports_request(api_client, [{
+        'type': 'OFFER',
+        'name': 'jPhone 13',
+        'id': '863e1a7a-1304-42ae-943b-179184c077e3',
+        'parentId': 'd515e43f-f3f6-4471-bb77-6b455017a2d2',
+        'price': 89999
+    }], '2022-02-04T00:00:00.000Z')
+    response = await make_nodes_request(api_client, root_id)
+    expected = _truncate_tree(response.json(), depth)
+    response = await make_nodes_request(api_client, root_id, depth)
+    assert response.json() == expected
+
+
+@pytest.mark.asyncio
+async def test_nodes_depth_validation(api_client: AsyncClient):
+    response = await make_nodes_request(
+        api_client, '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1', -1
+    )
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+    response = await make_nodes_request(
+        api_client, '00000000-0000-0000-0000-000000000000', 1
+    )
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.parametrize('shop_unit_ids', [
+    # Вложенные поддеревья и повторы
+    [
+        '1cc0129a-2bfe-474c-9ee6-d435bf5fc8f2',
+        '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1',
+        '863e1a7a-1304-42ae-943b-179184c077e3',
+        '1cc0129a-2bfe-474c-9ee6-d435bf5fc8f2'
+    ],
+    ['d515e43f-f3f6-4471-bb77-6b455017a2d2'],
+    []
+])
+@pytest.mark.asyncio
+async def test_nodes_batch(api_client: AsyncClient, shop_unit_ids):
+    response = await make_nodes_batch_request(api_client, shop_unit_ids)
+    assert response.status_code == HTTPStatus.OK
+
+    expected = []
+    for shop_unit_id in dict.fromkeys(shop_unit_ids):
+        expected.append(
+            (await make_nodes_request(api_client, shop_unit_id)).json()
+        )
+    assert response.json() == {'items': expected}
+
+    # Ответ из кэша совпадает с прочитанным из базы
+    response = await make_nodes_batch_request(api_client, shop_unit_ids)
+    assert response.json() == {'items': expected}
+
+
+@pytest.mark.asyncio
+async def test_nodes_batch_not_found(api_client: AsyncClient, monkeypatch):
+    response = await make_nodes_batch_request(api_client, [
+        '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1',
+        '00000000-0000-0000-0000-000000000000'
+    ])
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+    response = await make_nodes_batch_request(api_client, ['not a uuid'])
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+    monkeypatch.setattr(settings, 'nodes_batch_max_size', 1)
+    response = await make_nodes_batch_request(api_client, [
+        '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1',
+        '1cc0129a-2bfe-474c-9ee6-d435bf5fc8f2'
+    ])
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
 @pytest.mark.asyncio
 async def test_child_deletion(api_client: AsyncClient):
     response = await make_delete_request(api_client, '1cc0129a-2bfe-474c-9ee6-d435bf5fc8f2')
@@ -426,3 +567,185 @@ async def test_not_found_error(api_client: AsyncClient):
 
     response = await make_nodes_request(api_client, '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1')
     assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+def _collect_totals(tree: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        node['id']: (node['price'], node['date'])
+        for node in _gen_subtrees(tree)
+    }
+
+
+@pytest.mark.asyncio
+async def test_move_category_with_children_update(api_client: AsyncClient):
+    response = await make_imports_request(api_client, [
+        {
+            'type': 'OFFER',
+            'name': 'Samson 70\' LED UHD Smart',
+            'id': '98883e8f-0507-482f-bce2-2fb306cf6483',
+            'parentId': '1cc0129a-2bfe-474c-9ee6-d435bf5fc8f2',
+            'price': 42999
+        },
+        {
+            'type': 'OFFER',
+            'name': 'jPhone 13',
+            'id': '863e1a7a-1304-42ae-943b-179184c077e3',
+            'parentId': None,
+            'price': 79999
+        },
+        {
+            'type': 'CATEGORY',
+            'name': 'Телевизоры',
+            'id': '1cc0129a-2bfe-474c-9ee6-d435bf5fc8f2',
+            'parentId': 'd515e43f-f3f6-4471-bb77-6b455017a2d2'
+        }
+    ], '2022-06-26T15:00:00.000Z')
+    assert response.status_code == HTTPStatus.OK
+
+    response = await make_nodes_request(api_client, '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1')
+    assert response.status_code == HTTPStatus.OK
+
+    expected_totals = {
+        '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1': (55749, '2022-06-26T15:00:00.000Z'),
+        'd515e43f-f3f6-4471-bb77-6b455017a2d2': (55749, '2022-06-26T15:00:00.000Z'),
+        'b1d8fd7d-2ae3-47d5-b2f9-0f094af800d4': (59999, '2022-02-02T12:00:00.000Z'),
+        '1cc0129a-2bfe-474c-9ee6-d435bf5fc8f2': (54332, '2022-06-26T15:00:00.000Z'),
+        '98883e8f-0507-482f-bce2-2fb306cf6483': (42999, '2022-06-26T15:00:00.000Z'),
+        '74b81fda-9cdc-4b63-8927-c978afed5cf4': (49999, '2022-02-03T12:00:00.000Z'),
+        '73bc3b36-02d1-4245-ab35-3106c9ee1c65': (69999, '2022-02-03T15:00:00.000Z')
+    }
+    assert _collect_totals(response.json()) == expected_totals
+
+    response = await make_nodes_request(api_client, '863e1a7a-1304-42ae-943b-179184c077e3')
+    assert response.status_code == HTTPStatus.OK
+    assert response.json()['parentId'] is None
+
+
+@pytest.mark.asyncio
+async def test_offer_deletion_restores_date(api_client: AsyncClient):
+    response = await make_delete_request(api_client, '73bc3b36-02d1-4245-ab35-3106c9ee1c65')
+    assert response.status_code == HTTPStatus.OK
+
+    response = await make_nodes_request(api_client, '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1')
+    assert response.status_code == HTTPStatus.OK
+
+    totals = _collect_totals(response.json())
+    assert totals['069cb8d7-bbdd-47d3-ad8f-82ef4c269df1'] == (
+        55749, '2022-02-03T12:00:00.000Z'
+    )
+    assert totals['1cc0129a-2bfe-474c-9ee6-d435bf5fc8f2'] == (
+        41499, '2022-02-03T12:00:00.000Z'
+    )
+
+
+@pytest.mark.asyncio
+async def test_cached_responses_invalidation(api_client: AsyncClient):
+    root_id = '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1'
+    category_id = '1cc0129a-2bfe-474c-9ee6-d435bf5fc8f2'
+    offer_id = '73bc3b36-02d1-4245-ab35-3106c9ee1c65'
+    sales_date = '2022-02-05T00:00:00.000Z'
+
+    # Заполняем кэш
+    response = await make_nodes_request(api_client, root_id)
+    assert response.json()['price'] == 58599
+    response = await make_sales_request(api_client, sales_date)
+    assert offer_id not in {item['id'] for item in response.json()['items']}
+    response = await make_node_statistic_request(api_client, category_id)
+    assert len(response.json()['items']) == 2
+
+    await make_imports_request(api_client, [{
+        'type': 'OFFER',
+        'name': 'Goldstar 65\' LED UHD LOL Very Smart',
+        'id': offer_id,
+        'parentId': category_id,
+        'price': 59999
+    }], '2022-02-04T00:00:00.000Z')
+
+    response = await make_nodes_request(api_client, root_id)
+    assert response.json()['price'] == 56599
+    response = await make_sales_request(api_client, sales_date)
+    assert offer_id in {item['id'] for item in response.json()['items']}
+    response = await make_node_statistic_request(api_client, category_id)
+    assert len(response.json()['items']) == 3
+
+    # Перенос узла сбрасывает ответы и для прежних предков
+    await make_imports_request(api_client, [{
+        'type': 'CATEGORY',
+        'name': 'Телевизоры',
+        'id': category_id,
+        'parentId': None
+    }], '2022-02-05T00:00:00.000Z')
+
+    response = await make_nodes_request(api_client, root_id)
+    assert [child['id'] for child in response.json()['children']] == [
+        'd515e43f-f3f6-4471-bb77-6b455017a2d2'
+    ]
+
+    response = await make_delete_request(api_client, category_id)
+    assert response.status_code == HTTPStatus.OK
+    response = await make_nodes_request(api_client, category_id)
+    assert response.status_code == HTTPStatus.NOT_FOUND
+    response = await make_sales_request(api_client, sales_date)
+    assert offer_id not in {item['id'] for item in response.json()['items']}
+    response = await make_node_statistic_request(api_client, category_id)
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.asyncio
+async def test_new_category_keeps_ancestor_dates(api_client: AsyncClient):
+    # Новая пустая категория не меняет дату родителей: дата категории
+    # складывается из ее собственной даты, дат товаров в поддереве
+    # и дат замены ее детей
+    root_id = '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1'
+    category_id = '1cc0129a-2bfe-474c-9ee6-d435bf5fc8f2'
+    child_id = 'a8b1c2d3-0000-4000-8000-000000000001'
+    response = await make_imports_request(api_client, [
+        {
+            'type': 'CATEGORY',
+            'name': 'OLED',
+            'id': child_id,
+            'parentId': category_id
+        }
+    ], '2022-02-04T12:00:00.000Z')
+    assert response.status_code == HTTPStatus.OK
+
+    response = await make_nodes_request(api_client, root_id)
+    totals = _collect_totals(response.json())
+    assert totals[root_id] == (58599, '2022-02-03T15:00:00.000Z')
+    assert totals[category_id] == (50999, '2022-02-03T15:00:00.000Z')
+    assert totals[child_id] == (None, '2022-02-04T12:00:00.000Z')
+
+    # Перенесенная категория передает новым родителям только даты товаров
+    response = await make_imports_request(api_client, [
+        {
+            'type': 'CATEGORY',
+            'name': 'Смартфоны',
+            'id': 'd515e43f-f3f6-4471-bb77-6b455017a2d2',
+            'parentId': child_id
+        }
+    ], '2022-02-05T12:00:00.000Z')
+    assert response.status_code == HTTPStatus.OK
+
+    response = await make_nodes_request(api_client, root_id)
+    totals = _collect_totals(response.json())
+    assert totals[root_id] == (58599, '2022-02-05T12:00:00.000Z')
+    assert totals[category_id] == (58599, '2022-02-03T15:00:00.000Z')
+    assert totals[child_id] == (69999, '2022-02-04T12:00:00.000Z')
+
+    # Новый товар меняет дату всех родителей
+    response = await make_imports_request(api_client, [
+        {
+            'type': 'OFFER',
+            'name': 'Samson 55\' OLED',
+            'id': 'a8b1c2d3-0000-4000-8000-000000000002',
+            'parentId': child_id,
+            'price': 59999
+        }
+    ], '2022-02-06T12:00:00.000Z')
+    assert response.status_code == HTTPStatus.OK
+
+    response = await make_nodes_request(api_client, root_id)
+    totals = _collect_totals(response.json())
+    assert totals[root_id][1] == '2022-02-06T12:00:00.000Z'
+    assert totals[category_id][1] == '2022-02-06T12:00:00.000Z'
+    assert totals[child_id][1] == '2022-02-06T12:00:00.000Z'
@@ -4,6 +4,8 @@ from typing import Any, Dict, List
 from httpx import AsyncClient
 import pytest
 
+from market.config import settings
+
 from .test_nodes import import_nodes
 from .utils import (
     make_sales_request, make_imports_request, 
@@ -66,6 +68,52 @@ async def test_basic(api_client: AsyncClient):
     assert items == expected_sales
 
 
+@pytest.mark.asyncio
+async def test_streaming_batches(api_client: AsyncClient, monkeypatch):
+    # Каждая строка читается курсором и отправляется отдельной частью
+    monkeypatch.setattr(settings, 'stream_fetch_size', 1)
+    response = await make_sales_request(api_client, '2022-02-03T15:00:00.000Z')
+    assert response.status_code == HTTPStatus.OK
+
+    items = response.json()['items']
+    assert sorted(item['id'] for item in items) == [
+        '73bc3b36-02d1-4245-ab35-3106c9ee1c65',
+        '74b81fda-9cdc-4b63-8927-c978afed5cf4',
+        '98883e8f-0507-482f-bce2-2fb306cf6483'
+    ]
+
+
+@pytest.mark.asyncio
+async def test_pagination(api_client: AsyncClient):
+    response = await make_sales_request(api_client, '2022-02-03T15:00:00.000Z', limit=2)
+    assert response.status_code == HTTPStatus.OK
+
+    payload = response.json()
+    assert [item['id'] for item in payload['items']] == [
+        '74b81fda-9cdc-4b63-8927-c978afed5cf4',
+        '98883e8f-0507-482f-bce2-2fb306cf6483'
+    ]
+    assert payload['nextCursor'] is not None
+
+    response = await make_sales_request(
+        api_client, '2022-02-03T15:00:00.000Z', limit=2, cursor=payload['nextCursor']
+    )
+    assert response.status_code == HTTPStatus.OK
+
+    payload = response.json()
+    assert [item['id'] for item in payload['items']] == [
+        '73bc3b36-02d1-4245-ab35-3106c9ee1c65'
+    ]
+    assert payload['nextCursor'] is None
+
+
+@pytest.mark.parametrize('params', [{'limit': 0}, {'cursor': 'invalid'}])
+@pytest.mark.asyncio
+async def test_pagination_validation_error(api_client: AsyncClient, params):
+    response = await make_sales_request(api_client, '2022-02-03T15:00:00.000Z', **params)
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
 @pytest.mark.asyncio
 async def test_shop_unit_update(api_client: AsyncClient):
     response = await make_imports_request(api_client, [{
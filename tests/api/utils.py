@@ -1,3 +1,4 @@
+import json
 from typing import Any, Dict, List, Optional
 
 from httpx import AsyncClient, Response
@@ -14,25 +15,92 @@ async def make_imports_request(
     })
 
 
+async def make_imports_stream_request(
+    api_client: AsyncClient,
+    items: List[Dict[str, Any]],
+    update_date: str,
+    chunk_size: int = 64
+) -> Response:
+    body = json.dumps({
+        'updateDate': update_date,
+        'items': items
+    }, ensure_ascii=False).encode()
+
+    async def chunks():
+        for i in range(0, len(body), chunk_size):
+            yield body[i:i + chunk_size]
+
+    return await api_client.post('/imports/stream', content=chunks())
+
+
+async def make_imports_async_request(
+    api_client: AsyncClient,
+    items: List[Dict[str, Any]],
+    update_date: str
+) -> Response:
+    return await api_client.post('/imports/async', json={
+        'items': items,
+        'updateDate': update_date
+    })
+
+
+async def make_import_job_request(
+    api_client: AsyncClient,
+    job_id: str
+) -> Response:
+    return await api_client.get(f'/imports/{job_id}')
+
+
 async def make_delete_request(api_client: AsyncClient, shop_unit_id: str) -> Response:
     return await api_client.delete(f'/delete/{shop_unit_id}')
 
 
-async def make_nodes_request(api_client: AsyncClient, shop_unit_id: str) -> Response:
-    return await api_client.get(f'/nodes/{shop_unit_id}')
+async def make_nodes_request(
+    api_client: AsyncClient,
+    shop_unit_id: str,
+    depth: Optional[int] = None
+) -> Response:
+    params = {}
+    if depth is not None:
+        params['depth'] = depth
+    return await api_client.get(f'/nodes/{shop_unit_id}', params=params)
 
 
-async def make_sales_request(api_client: AsyncClient, date_: str) -> Response:
-    return await api_client.get('/sales', params={'date': date_})
+async def make_nodes_batch_request(
+    api_client: AsyncClient,
+    shop_unit_ids: List[str]
+) -> Response:
+    return await api_client.post('/nodes/batch', json={'ids': shop_unit_ids})
+
+
+def _page_params(limit: Optional[int], cursor: Optional[str]) -> Dict[str, Any]:
+    params = {}
+    if limit is not None:
+        params['limit'] = limit
+    if cursor is not None:
+        params['cursor'] = cursor
+    return params
+
+
+async def make_sales_request(
+    api_client: AsyncClient,
+    date_: str,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None
+) -> Response:
+    params = {'date': date_, **_page_params(limit, cursor)}
+    return await api_client.get('/sales', params=params)
 
 
 async def make_node_statistic_request(
     api_client: AsyncClient,
     shop_unit_id: str,
     date_start: Optional[str] = None,
-    date_end: Optional[str] = None
+    date_end: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None
 ) -> Response:
-    params = {}
+    params = _page_params(limit, cursor)
     if date_start is not None:
         params['dateStart'] = date_start
     if date_end is not None:
@@ -0,0 +1,86 @@
+"""
+Время упорядочивания выгрузки перед импортом в зависимости
+от ее размера и глубины деревьев.
+
+    python -m tests.benchmarks.insertion_order [количество элементов]
+"""
+import random
+import sys
+from timeit import timeit
+from typing import List
+import uuid
+
+from market.db.models import ShopUnitType
+from market.schemas import ShopUnitImportSchema
+from market.services import MarketService
+
+
+def make_import_items(
+    size: int,
+    depth: int = 10,
+    seed: int = 0
+) -> List[ShopUnitImportSchema]:
+    """
+    Выгрузка из нескольких деревьев в случайном порядке: каждый
+    десятый элемент - категория, цепочки категорий не длиннее depth.
+    """
+    rng = random.Random(seed)
+    items = []
+    categories = []
+    levels = {}
+    for i in range(size):
+        unit_id = uuid.UUID(int=rng.getrandbits(128))
+        candidates = [
+            category for category in rng.sample(
+                categories, min(len(categories), 3)
+            )
+            if levels[category] < depth
+        ]
+        parent_id = rng.choice(candidates) if candidates else None
+        level = levels[parent_id] + 1 if parent_id else 0
+        if not categories or rng.random() < 0.1:
+            items.append(ShopUnitImportSchema.construct(
+                id=unit_id, name=f'Категория {i}',
+                type=ShopUnitType.CATEGORY, parent_id=parent_id, price=None
+            ))
+            categories.append(unit_id)
+            levels[unit_id] = level
+        else:
+            items.append(ShopUnitImportSchema.construct(
+                id=unit_id, name=f'Товар {i}', type=ShopUnitType.OFFER,
+                parent_id=parent_id, price=rng.randrange(10 ** 6)
+            ))
+    rng.shuffle(items)
+    return items
+
+
+def make_import_chain(size: int) -> List[ShopUnitImportSchema]:
+    """Одна цепочка категорий, в которой дети идут раньше родителей."""
+    ids = [uuid.UUID(int=i + 1) for i in range(size)]
+    return [
+        ShopUnitImportSchema.construct(
+            id=unit_id, name=f'Категория {i}', type=ShopUnitType.CATEGORY,
+            parent_id=ids[i - 1] if i else None, price=None
+        )
+        for i, unit_id in reversed(list(enumerate(ids)))
+    ]
+
+
+def main() -> None:
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, make_items in (
+        ('глубина 1', lambda part: make_import_items(part, 1)),
+        ('глубина 10', lambda part: make_import_items(part, 10)),
+        ('одна цепочка', make_import_chain)
+    ):
+        for part in (size // 10, size // 2, size):
+            items = make_items(part)
+            elapsed = timeit(
+                lambda: MarketService._solve_insertion_order(items), number=3
+            ) / 3
+            print(f'{name}: {part} элементов, {elapsed:.3f} с, '
+                  f'{elapsed / part * 10 ** 6:.2f} мкс на элемент')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Сравнение сериализации ответов /nodes и /sales через pydantic-схемы
+и напрямую из строк запроса.
+
+    python -m tests.benchmarks.serialization [количество узлов]
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+import json
+import random
+import sys
+from timeit import timeit
+from typing import List
+import uuid
+
+from market.db.models import ShopUnitType
+from market.schemas import ShopUnitSchema, ShopUnitsListSchema
+from market.schemas.encoders import dump_shop_unit_tree, dump_shop_units_list
+
+
+Row = namedtuple('Row', ['id', 'name', 'type', 'parent_id', 'price', 'date'])
+
+
+def make_tree_rows(size: int, seed: int = 0) -> List[Row]:
+    """Строки дерева в порядке обхода в ширину, корень - категория."""
+    rng = random.Random(seed)
+    date = datetime(2022, 2, 1)
+    rows = [Row(uuid.UUID(int=rng.getrandbits(128)), 'Категория 0',
+                ShopUnitType.CATEGORY, None, None, date)]
+    categories = [rows[0].id]
+    for i in range(1, size):
+        parent_id = rng.choice(categories)
+        unit_date = date + timedelta(minutes=rng.randrange(10000))
+        unit_id = uuid.UUID(int=rng.getrandbits(128))
+        if rng.random() < 0.1:
+            rows.append(Row(unit_id, f'Категория {i}', ShopUnitType.CATEGORY,
+                            parent_id, rng.choice([None, rng.randrange(10 ** 6)]),
+                            unit_date))
+            categories.append(unit_id)
+        else:
+            rows.append(Row(unit_id, f'Товар {i}', ShopUnitType.OFFER,
+                            parent_id, rng.randrange(10 ** 6), unit_date))
+    levels = {rows[0].id: 0}
+    for row in rows[1:]:
+        levels[row.id] = levels[row.parent_id] + 1
+    return sorted(rows, key=lambda row: levels[row.id])
+
+
+def dump_shop_unit_tree_pydantic(rows: List[Row]) -> bytes:
+    root = ShopUnitSchema.from_nodes(map(ShopUnitSchema.from_orm, rows))
+    return root.json(by_alias=True).encode()
+
+
+def dump_shop_units_list_pydantic(rows: List[Row]) -> bytes:
+    return ShopUnitsListSchema(items=rows).json(by_alias=True).encode()
+
+
+def main() -> None:
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    rows = make_tree_rows(size)
+    for name, reference, fast in (
+        ('nodes', dump_shop_unit_tree_pydantic, dump_shop_unit_tree),
+        ('sales', dump_shop_units_list_pydantic, dump_shop_units_list)
+    ):
+        assert json.loads(reference(rows)) == json.loads(fast(rows))
+        reference_time = timeit(lambda: reference(rows), number=3) / 3
+        fast_time = timeit(lambda: fast(rows), number=3) / 3
+        print(f'{name}: {size} узлов, pydantic {reference_time:.3f} с, '
+              f'orjson {fast_time:.3f} с, '
+              f'ускорение {reference_time / fast_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+
+from market.cache import ResponseCache
+
+
+def test_lru_eviction():
+    cache = ResponseCache(max_size=6, ttl=60)
+    cache.set('a', b'aa')
+    cache.set('b', b'bb')
+    cache.set('c', b'cc')
+    assert cache.get('a') == b'aa'
+
+    cache.set('d', b'dd')
+    assert cache.get('b') is None
+    assert [cache.get(key) for key in 'acd'] == [b'aa', b'cc', b'dd']
+    assert cache.size == 6
+
+
+def test_value_larger_than_cache():
+    cache = ResponseCache(max_size=2, ttl=60)
+    cache.set('a', b'aaa')
+    assert cache.get('a') is None
+    assert cache.size == 0
+
+
+def test_ttl(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr('market.cache.time.monotonic', lambda: now)
+    cache = ResponseCache(max_size=10, ttl=5)
+    cache.set('a', b'a')
+
+    now += 4
+    assert cache.get('a') == b'a'
+    now += 1
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_invalidate():
+    cache = ResponseCache(max_size=10, ttl=60)
+    cache.set(('nodes', 1), b'1', tags=[1])
+    cache.set(('nodes', 2), b'2', tags=[2])
+    cache.set(('sales', 1), b'3', tags=['sales'])
+    cache.set(('sales', 2), b'4', tags=['sales'])
+
+    cache.invalidate([1, 3])
+    cache.invalidate(['sales'], lambda key: key[1] == 2)
+    assert cache.get(('nodes', 1)) is None
+    assert cache.get(('nodes', 2)) == b'2'
+    assert cache.get(('sales', 1)) == b'3'
+    assert cache.get(('sales', 2)) is None
+    assert cache.size == 2
+
+
+@pytest.mark.asyncio
+async def test_get_or_load_skips_stale_value():
+    cache = ResponseCache(max_size=10, ttl=60)
+    loaded = asyncio.Event()
+    invalidated = asyncio.Event()
+
+    async def load():
+        loaded.set()
+        await invalidated.wait()
+        return b'stale'
+
+    task = asyncio.create_task(cache.get_or_load('a', load, tags=['a']))
+    await loaded.wait()
+    cache.invalidate(['a'])
+    invalidated.set()
+    assert await task == b'stale'
+    assert cache.get('a') is None
+
+    async def load_fresh():
+        return b'fresh'
+
+    assert await cache.get_or_load('a', load_fresh) == b'fresh'
+    assert cache.get('a') == b'fresh'
+
+
+async def _stream(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+@pytest.mark.asyncio
+async def test_get_or_stream():
+    cache = ResponseCache(max_size=4, ttl=60)
+
+    chunks = cache.get_or_stream('a', lambda: _stream(b'a', b'b'))
+    assert [chunk async for chunk in chunks] == [b'a', b'b']
+    assert cache.get('a') == b'ab'
+    chunks = cache.get_or_stream('a', lambda: _stream(b'c'))
+    assert [chunk async for chunk in chunks] == [b'ab']
+
+    # Ответ больше кэша передается целиком, но не сохраняется
+    chunks = cache.get_or_stream('b', lambda: _stream(b'abc', b'de'))
+    assert [chunk async for chunk in chunks] == [b'abc', b'de']
+    assert cache.get('b') is None
+
+    # Как и ответ, чтение которого пересеклось со сбросом
+    chunks = cache.get_or_stream('c', lambda: _stream(b'a', b'b'), tags=['c'])
+    assert await chunks.__anext__() == b'a'
+    cache.invalidate(['c'])
+    assert [chunk async for chunk in chunks] == [b'b']
+    assert cache.get('c') is None
+
+
+@pytest.mark.asyncio
+async def test_get_or_load_many():
+    cache = ResponseCache(max_size=10, ttl=60)
+    cache.set('b', b'B')
+    requested = []
+
+    async def load(keys):
+        requested.append(keys)
+        return [key.encode() for key in keys]
+
+    values = await cache.get_or_load_many(
+        ['a', 'b', 'c'], load, tags=lambda key: [key]
+    )
+    assert values == [b'a', b'B', b'c']
+    assert requested == [['a', 'c']]
+    assert cache.get('c') == b'c'
+
+    cache.invalidate(['c'])
+    assert await cache.get_or_load_many(['a', 'c'], load) == [b'a', b'c']
+    assert requested == [['a', 'c'], ['c']]
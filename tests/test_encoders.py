@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from market.schemas.encoders import (
+    dump_shop_unit_tree, dump_shop_units_list,
+    stream_shop_units_list, stream_shop_units_page
+)
+from market.schemas.pagination import decode_cursor
+
+from .benchmarks.serialization import (
+    dump_shop_unit_tree_pydantic, dump_shop_units_list_pydantic,
+    make_tree_rows
+)
+
+
+@pytest.mark.parametrize('size', [1, 2, 100])
+def test_shop_unit_tree_equivalence(size):
+    rows = make_tree_rows(size, seed=size)
+    expected = json.loads(dump_shop_unit_tree_pydantic(rows))
+    assert json.loads(dump_shop_unit_tree(rows)) == expected
+
+
+@pytest.mark.parametrize('size', [0, 1, 100])
+def test_shop_units_list_equivalence(size):
+    rows = make_tree_rows(size, seed=size) if size else []
+    expected = json.loads(dump_shop_units_list_pydantic(rows))
+    assert json.loads(dump_shop_units_list(rows)) == expected
+
+
+@pytest.mark.parametrize('size,batch_size', [(0, 1), (1, 1), (100, 7)])
+@pytest.mark.asyncio
+async def test_shop_units_list_stream(size, batch_size):
+    rows = make_tree_rows(size, seed=size) if size else []
+
+    async def batches():
+        # Пустая пачка не должна ломать разделители
+        yield []
+        for i in range(0, len(rows), batch_size):
+            yield rows[i:i + batch_size]
+
+    chunks = [chunk async for chunk in stream_shop_units_list(batches())]
+    assert b''.join(chunks) == dump_shop_units_list(rows)
+
+
+@pytest.mark.parametrize('size,limit,has_next_page', [
+    (0, 3, False), (3, 3, False), (4, 3, True), (10, None, False)
+])
+@pytest.mark.asyncio
+async def test_shop_units_page_stream(size, limit, has_next_page):
+    rows = make_tree_rows(size, seed=size) if size else []
+
+    async def batches():
+        for i in range(0, len(rows), 2):
+            yield rows[i:i + 2]
+
+    chunks = [chunk async for chunk in stream_shop_units_page(batches(), limit)]
+    payload = json.loads(b''.join(chunks))
+    page = rows[:limit]
+    assert payload['items'] == json.loads(dump_shop_units_list(page))['items']
+    if has_next_page:
+        id_, *_, date_ = page[-1]
+        assert decode_cursor(payload['nextCursor']) == (date_, id_)
+    else:
+        assert payload['nextCursor'] is None
@@ -0,0 +1,55 @@
+from http import HTTPStatus
+from uuid import UUID
+
+from fastapi import HTTPException
+import pytest
+
+from market.db.models import ShopUnitType
+from market.schemas import ShopUnitImportSchema
+from market.services import MarketService
+
+from .benchmarks.insertion_order import make_import_chain, make_import_items
+
+
+def _category(id_: int, parent_id: int = None) -> ShopUnitImportSchema:
+    return ShopUnitImportSchema(
+        id=UUID(int=id_), name='Категория', type=ShopUnitType.CATEGORY,
+        parent_id=parent_id and UUID(int=parent_id)
+    )
+
+
+def _offer(id_: int, parent_id: int = None) -> ShopUnitImportSchema:
+    return ShopUnitImportSchema(
+        id=UUID(int=id_), name='Товар', type=ShopUnitType.OFFER,
+        parent_id=parent_id and UUID(int=parent_id), price=1
+    )
+
+
+@pytest.mark.parametrize('items', [
+    make_import_items(1000, depth=1),
+    make_import_items(1000, depth=10),
+    make_import_chain(1000),
+    # Родитель вне выгрузки
+    [_offer(1, 2), _category(3, 4)]
+])
+def test_insertion_order(items):
+    ordered = MarketService._solve_insertion_order(items)
+    assert sorted(item.id for item in ordered) == \
+        sorted(item.id for item in items)
+    positions = {item.id: i for i, item in enumerate(ordered)}
+    for i, item in enumerate(ordered):
+        assert positions.get(item.parent_id, -1) < i
+
+
+@pytest.mark.parametrize('items,message', [
+    ([_category(1), _offer(1)], 'duplicate ids'),
+    ([_category(1, 1)], f'{UUID(int=1)} is its own parent'),
+    ([_category(1, 3), _category(2, 1), _category(3, 2)], 'parent cycle'),
+    ([_offer(2, 1), _offer(1)], f'parent of {UUID(int=2)} is not a category')
+])
+def test_insertion_order_validation(items, message):
+    with pytest.raises(HTTPException) as e:
+        MarketService._solve_insertion_order(items)
+    assert e.value.status_code == HTTPStatus.BAD_REQUEST
+    assert e.value.detail == 'Validation Failed'
+    assert message in e.value.reason
@@ -0,0 +1,83 @@
+from datetime import datetime
+from uuid import UUID
+
+from alembic.command import upgrade
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.engine import make_url
+
+from market.config import settings
+from market.db.utils import create_alembic_config, tmp_database
+
+
+ROOT_ID = UUID(int=1)
+EMPTY_ID = UUID(int=2)
+FORMER_PARENT_ID = UUID(int=3)
+OFFER_ID = UUID(int=4)
+
+
+@pytest.fixture()
+def db_url() -> str:
+    with tmp_database(settings.db_url) as db_url:
+        yield db_url
+
+
+def _shop_unit(id_, type_, parent_id=None):
+    return {
+        'id': id_, 'type': type_, 'parent_id': parent_id,
+        'parent_type': parent_id and 'CATEGORY'
+    }
+
+
+def _import(id_, type_, date_, parent_id=None, price=None, expiration_date=None):
+    return {
+        'id': id_, 'type': type_, 'date': date_, 'parent_id': parent_id,
+        'name': 'Узел', 'price': price, 'expiration_date': expiration_date
+    }
+
+
+def test_category_aggregate_backfill(db_url: str):
+    alembic = create_alembic_config(db_url)
+    upgrade(alembic, 'f8e5309c9741')
+
+    engine = sa.create_engine(make_url(db_url).set(drivername='postgresql'))
+    with engine.begin() as connection:
+        connection.execute(sa.text(
+            'INSERT INTO shop_unit (id, type, parent_id, parent_type) '
+            'VALUES (:id, :type, :parent_id, :parent_type)'
+        ), [
+            _shop_unit(ROOT_ID, 'CATEGORY'),
+            _shop_unit(EMPTY_ID, 'CATEGORY', ROOT_ID),
+            _shop_unit(FORMER_PARENT_ID, 'CATEGORY', ROOT_ID),
+            _shop_unit(OFFER_ID, 'OFFER', ROOT_ID)
+        ])
+        connection.execute(sa.text(
+            'INSERT INTO shop_unit_import '
+            '(id, type, date, parent_id, name, price, expiration_date) '
+            'VALUES (:id, :type, :date, :parent_id, :name, :price, '
+            ':expiration_date)'
+        ), [
+            _import(ROOT_ID, 'CATEGORY', datetime(2022, 2, 1)),
+            _import(FORMER_PARENT_ID, 'CATEGORY', datetime(2022, 2, 1), ROOT_ID),
+            # Товар перенесен из подкатегории в корень. Дата окончания
+            # версии ссылается на следующую, поэтому та вставляется раньше
+            _import(OFFER_ID, 'OFFER', datetime(2022, 2, 3), ROOT_ID, 150),
+            _import(OFFER_ID, 'OFFER', datetime(2022, 2, 1), FORMER_PARENT_ID,
+                    100, datetime(2022, 2, 3)),
+            # Пустая подкатегория не меняет дату корня
+            _import(EMPTY_ID, 'CATEGORY', datetime(2022, 2, 4), ROOT_ID)
+        ])
+
+    upgrade(alembic, '2e77723d909a')
+    with engine.connect() as connection:
+        aggregates = connection.execute(sa.text(
+            'SELECT id, sum_price, offer_count, last_change_date '
+            'FROM category_aggregate'
+        )).all()
+    engine.dispose()
+
+    assert {row.id: tuple(row[1:]) for row in aggregates} == {
+        ROOT_ID: (150, 1, datetime(2022, 2, 3)),
+        EMPTY_ID: (0, 0, datetime(2022, 2, 4)),
+        FORMER_PARENT_ID: (0, 0, datetime(2022, 2, 3))
+    }
@@ -0,0 +1,240 @@
+from functools import partial
+import multiprocessing
+import os
+import sys
+
+import pytest
+from uvicorn import Config
+from uvicorn.subprocess import get_subprocess
+
+from market import __main__ as main_module
+from market import server
+from market.config import settings
+from market.db import connection
+
+
+@pytest.fixture()
+def started(monkeypatch):
+    # Чем main запустил приложение: uvicorn.run или serve
+    calls = []
+    monkeypatch.setattr(settings, 'is_debug', False)
+    monkeypatch.setattr(
+        main_module.uvicorn, 'run',
+        lambda app, **options: calls.append(('run', app, options))
+    )
+    monkeypatch.setattr(
+        main_module, 'serve', lambda config: calls.append(('serve', config))
+    )
+    return calls
+
+
+def _run_main(monkeypatch, *args: str) -> None:
+    monkeypatch.setattr(sys, 'argv', ['market-api', *args])
+    main_module.main()
+
+
+def test_main_single_worker(monkeypatch, started):
+    _run_main(monkeypatch, '--app-port', '8080', '--loop', 'asyncio')
+    (method, app, options), = started
+    assert method == 'run'
+    assert app == 'market.app:get_app'
+    assert options['factory']
+    assert options['port'] == 8080
+    assert options['loop'] == 'asyncio'
+    assert not options['reload']
+
+
+@pytest.mark.parametrize('args,workers,limit_max_requests', [
+    (['--workers', '4'], 4, None),
+    (['--limit-max-requests', '1000'], 1, 1000),
+    (['--workers', '2', '--limit-max-requests', '500'], 2, 500)
+])
+def test_main_multiprocess(
+    monkeypatch,
+    started,
+    args,
+    workers,
+    limit_max_requests
+):
+    _run_main(
+        monkeypatch, *args, '--app-host', '0.0.0.0', '--http', 'h11',
+        '--backlog', '128', '--timeout-keep-alive', '10'
+    )
+    (method, config), = started
+    assert method == 'serve'
+    assert config.app == 'market.app:get_app'
+    assert config.factory
+    assert config.workers == workers
+    assert config.limit_max_requests == limit_max_requests
+    assert config.host == '0.0.0.0'
+    assert config.port == settings.app_port
+    assert config.http == 'h11'
+    assert config.backlog == 128
+    assert config.timeout_keep_alive == 10
+
+
+def test_main_debug(monkeypatch, started):
+    # В режиме отладки нужна перезагрузка, поэтому процесс один
+    monkeypatch.setattr(settings, 'is_debug', True)
+    _run_main(monkeypatch, '--workers', '4')
+    (method, _, options), = started
+    assert method == 'run'
+    assert options['reload']
+
+
+@pytest.mark.parametrize('randint,expected', [(0, 1000), (100, 1100)])
+def test_run_worker_jitter(monkeypatch, randint, expected):
+    servers = []
+
+    class FakeServer:
+        def __init__(self, config: Config) -> None:
+            self.config = config
+
+        def run(self, sockets) -> None:
+            servers.append((self.config.limit_max_requests, sockets))
+
+    bounds = []
+
+    def fake_randint(a: int, b: int) -> int:
+        bounds.append((a, b))
+        return randint
+
+    monkeypatch.setattr(server, 'Server', FakeServer)
+    monkeypatch.setattr(server.random, 'randint', fake_randint)
+    server.run_worker(Config('app', limit_max_requests=1000), ['socket'])
+    server.run_worker(Config('app'), ['socket'])
+    assert bounds == [(0, 100)]
+    assert servers == [(expected, ['socket']), (None, ['socket'])]
+
+
+class FakeProcess:
+    def __init__(self, alive: bool = True) -> None:
+        self.alive = alive
+        self.started = False
+        self.joined = False
+
+    def is_alive(self) -> bool:
+        return self.alive
+
+    def start(self) -> None:
+        self.started = True
+
+    def join(self) -> None:
+        self.joined = True
+
+
+def test_restart_exited(monkeypatch):
+    created = []
+
+    def fake_get_subprocess(config, target, sockets):
+        assert config.workers == 3
+        assert sockets == ['socket']
+        created.append(FakeProcess())
+        return created[-1]
+
+    monkeypatch.setattr(server, 'get_subprocess', fake_get_subprocess)
+    supervisor = server.RecyclingMultiprocess(
+        Config('app', workers=3), target=print, sockets=['socket']
+    )
+    alive, exited = FakeProcess(), FakeProcess(alive=False)
+    supervisor.processes = [alive, exited, alive]
+
+    supervisor.restart_exited()
+    assert exited.joined
+    assert not alive.joined
+    assert len(created) == 1 and created[0].started
+    assert supervisor.processes == [alive, created[0], alive]
+
+    supervisor.restart_exited()
+    assert len(created) == 1
+
+
+def test_recycling_multiprocess_run(monkeypatch):
+    supervisor = server.RecyclingMultiprocess(
+        Config('app'), target=print, sockets=[]
+    )
+    calls = []
+    monkeypatch.setattr(supervisor, 'startup', lambda: calls.append('startup'))
+    monkeypatch.setattr(
+        supervisor, 'shutdown', lambda: calls.append('shutdown')
+    )
+
+    def restart_exited():
+        calls.append('restart')
+        supervisor.should_exit.set()
+
+    monkeypatch.setattr(supervisor, 'restart_exited', restart_exited)
+    supervisor.run()
+    assert calls == ['startup', 'restart', 'shutdown']
+
+
+def test_serve(monkeypatch):
+    supervisors = []
+    monkeypatch.setattr(
+        server.RecyclingMultiprocess, 'run',
+        lambda self: supervisors.append(self)
+    )
+    config = Config('app', host='127.0.0.1', port=0, workers=2)
+    server.serve(config)
+
+    supervisor, = supervisors
+    try:
+        assert supervisor.config is config
+        sock, = supervisor.sockets
+        assert sock.getsockname()[0] == '127.0.0.1'
+        assert supervisor.target.func is server.run_worker
+        assert supervisor.target.args == (config,)
+    finally:
+        sock.close()
+
+
+def _report_engine(queue, sockets) -> None:
+    # Выполняется в процессе-обработчике
+    created_before = connection._engine is not None
+    engine = connection.get_engine()
+    queue.put((
+        os.getpid(), created_before, engine is connection.get_engine(),
+        str(engine.url)
+    ))
+
+
+@pytest.fixture()
+def engine_globals(monkeypatch):
+    # Движок, созданный тестом, не остается в модуле после него
+    monkeypatch.setattr(connection, '_engine', None)
+    monkeypatch.setattr(connection, '_Session', None)
+
+
+def test_worker_creates_own_engine(engine_globals):
+    # Движок родительского процесса не передается обработчикам:
+    # каждый создает свой при первом обращении
+    connection.get_engine()
+    queue = multiprocessing.get_context('spawn').Queue()
+    processes = [
+        get_subprocess(
+            Config('app'), target=partial(_report_engine, queue), sockets=[]
+        )
+        for _ in range(2)
+    ]
+    for process in processes:
+        process.start()
+    reports = [queue.get(timeout=60) for _ in processes]
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    assert {pid for pid, *_ in reports} == {p.pid for p in processes}
+    for _, created_before, same_engine, url in reports:
+        assert not created_before
+        assert same_engine
+        assert url == str(connection.get_engine().url)
+
+
+@pytest.mark.asyncio
+async def test_dispose_engine(engine_globals):
+    engine = connection.get_engine()
+    assert connection.get_engine() is engine
+    await connection.dispose_engine()
+    assert connection._engine is None
+    assert connection.get_engine() is not engine
+    await connection.dispose_engine()